@@ -0,0 +1,7 @@
+#!/bin/bash
+status=0
+for benchmark in tests/benchmarks/bench_*.py
+do
+  PYTHONPATH=src:tests python "$benchmark" "$@" || status=1
+done
+exit $status
@@ -1,27 +1,154 @@
 import io
 import os
+import csv
+import json
+import time
+import base64
+import hashlib
+import asyncio
+import secrets
+import functools
+import numpy as np
 import torch
-import torchvision
 import uvicorn
+from prometheus_client import start_http_server
+from enum import Enum
 from http import HTTPStatus
+from typing import List
 from PIL import Image as pil
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import Query, FastAPI, Request, UploadFile, File
-from fastapi.responses import StreamingResponse, Response
-from monitoring import setup_prometheus_instrumentator
-from covidx.utils.plot import save_binary_attention_map
+from fastapi import Query, FastAPI, Request, UploadFile, File, Header, HTTPException
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from monitoring import setup_prometheus_instrumentator, register_cache_metrics, register_engine_metrics, \
+    register_memory_metrics, StageTimer
+from engine import BatchScheduler, BoundedExecutor, EngineOverloadedError, LoadShedder
+from cache import LRUCache
+from registry import ModelRegistry, ModelWatcher
+from profiling import RequestProfiler, ProfilerBusyError
+from jobs import JobStore, JobWorker
+from covidx.utils.plot import render_binary_attention_map, binary_attention_map, encode_image, IMAGE_ENCODINGS
+from covidx.utils.checkpoint import load_flat_model
 from covidx.ct.models import CTNet
+from covidx.ct.inference import prepare_model, OnnxModel
+from covidx.ct.embeddings import EmbeddingIndex, forward_embeddings, METADATA_FILENAME
+from covidx.ct.preprocessing import IMAGE_SIZE, crop_resize, normalize, BatchBuffer
 
 # Some global variables
 DEVICE = None
+READY = False
 MODELS_PATH = 'models'
 MODEL_NAME = 'ct_net.pt'
-MODEL_WRAPPERS = dict()
+DEFAULT_MODEL = os.path.splitext(MODEL_NAME)[0]
+BACKEND = os.environ.get('CT_COVID_BACKEND', 'fp32')
+CALIBRATION_PATH = os.environ.get('CT_COVID_CALIBRATION_PATH', os.path.join('data', 'ct', 'valid'))
+N_CALIBRATION_IMAGES = 64
+ONNX_THREADS = int(os.environ.get('CT_COVID_ONNX_THREADS', 0))
+MODEL_WRAPPERS = ModelRegistry(
+    MODELS_PATH, lambda filepath: load_model(filepath),
+    extensions=('.onnx', '.weights', '.pt') if BACKEND == 'onnx' else ('.weights', '.pt'),
+    max_memory=int(float(os.environ.get('CT_COVID_MODELS_MEMORY', 1024)) * 1024 * 1024)
+)
+RELOAD_INTERVAL = float(os.environ.get('CT_COVID_RELOAD_INTERVAL', 10))
+MODEL_WATCHER = ModelWatcher(
+    MODEL_WRAPPERS, interval=RELOAD_INTERVAL, warmup_fn=lambda model: warmup_model(model)
+) if RELOAD_INTERVAL > 0 else None
+SCHEDULERS = dict()
+MAX_BATCH_SIZE = int(os.environ.get('CT_COVID_MAX_BATCH_SIZE', 8))
+MAX_BATCH_WAIT = float(os.environ.get('CT_COVID_MAX_BATCH_WAIT', 0.005))
+EXECUTOR = BoundedExecutor(
+    max_workers=int(os.environ.get('CT_COVID_MAX_WORKERS', 2)),
+    max_pending=int(os.environ.get('CT_COVID_MAX_PENDING', 16))
+)
+MAX_BATCH_FILES = int(os.environ.get('CT_COVID_MAX_BATCH_FILES', 64))
+SHEDDER = LoadShedder(
+    latency_budget=float(os.environ.get('CT_COVID_LATENCY_BUDGET', 2.0)),
+    wait_budget=float(os.environ.get('CT_COVID_WAIT_BUDGET', 0.5)),
+    shed_factor=float(os.environ.get('CT_COVID_SHED_FACTOR', 2.0))
+)
+PREDICTIONS = LRUCache(
+    max_size=int(float(os.environ.get('CT_COVID_CACHE_SIZE', 128)) * 1024 * 1024),
+    sizeof=lambda x: len(x) if isinstance(x, bytes) else sum(v.nbytes for v in x.values())
+)
+MAX_UPLOAD_SIZE = int(float(os.environ.get('CT_COVID_MAX_UPLOAD_SIZE', 32)) * 1024 * 1024)
+MULTIPART_OVERHEAD = 16 * 1024
+MAX_IMAGE_PIXELS = int(float(os.environ.get('CT_COVID_MAX_IMAGE_PIXELS', 64)) * 1024 * 1024)
+JPEG_DRAFT = os.environ.get('CT_COVID_JPEG_DRAFT', '1') == '1'
+ADMIN_TOKEN = os.environ.get('CT_COVID_ADMIN_TOKEN', '')
+MAX_PROFILE_TIME = float(os.environ.get('CT_COVID_MAX_PROFILE_TIME', 60))
+PROFILER = RequestProfiler()
+JOBS_PATH = os.environ.get('CT_COVID_JOBS_PATH', 'jobs')
+JOBS = None
+JOB_BATCH_SIZE = int(os.environ.get('CT_COVID_JOB_BATCH_SIZE', 16))
+JOB_THREAD_BATCH_SIZE = int(os.environ.get('CT_COVID_JOB_THREAD_BATCH_SIZE', 1))
+JOB_POLL_INTERVAL = 1.0
+MAX_JOB_WAIT = float(os.environ.get('CT_COVID_MAX_JOB_WAIT', 60))
+JOB_WORKER = None
+JOB_THREAD = True
+JOB_BUFFER = BatchBuffer(JOB_BATCH_SIZE, size=IMAGE_SIZE)
+MAX_JOB_FILES = int(os.environ.get('CT_COVID_MAX_JOB_FILES', 10000))
+ARCHIVE_PATH = os.environ.get('CT_COVID_ARCHIVE_PATH', '')
+EMBEDDINGS_PATH = os.environ.get('CT_COVID_EMBEDDINGS_PATH', 'embeddings')
+EMBEDDINGS = None
+MAX_SIMILAR_CASES = 50
+METRICS_ADDRESS = None
+PNG_COMPRESSION = int(os.environ.get('CT_COVID_PNG_COMPRESSION', 1))
+IMAGE_QUALITY = int(os.environ.get('CT_COVID_IMAGE_QUALITY', 90))
 PREDICTION_TAGS = {
     0: 'Normal',
     1: 'Pneumonia',
     2: 'COVID - 19'
 }
+BINARY_PREDICTION_TAGS = {
+    0: 'Non COVID - 19',
+    1: 'COVID - 19'
+}
+
+
+class ImageEncoding(str, Enum):
+    png = 'png'
+    jpeg = 'jpeg'
+    webp = 'webp'
+
+
+def max_body_size(path: str):
+    """
+    A synchronous utility function used to get the maximum body size of the requests to an endpoint, i.e. the maximum
+    upload size of each file it accepts, including the multipart headers of the file.
+
+    :param path: The endpoint path.
+    :return: The maximum body size in bytes.
+    """
+    max_files = {'/predict/batch': MAX_BATCH_FILES, '/jobs': MAX_JOB_FILES}.get(path, 1)
+    return max_files * (MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD)
+
+
+class UploadSizeMiddleware:
+    """ASGI middleware rejecting the requests whose declared body size exceeds the limit of their endpoint."""
+    def __init__(self, app):
+        """
+        Instantiate the middleware.
+
+        :param app: The ASGI application.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Answer before receiving the body, as the uploaded files are spooled entirely before reaching the endpoints
+        # The bodies without a Content-Length (i.e. chunked ones) are checked while reading them
+        if scope['type'] == 'http':
+            content_length = Headers(scope=scope).get('content-length', '')
+            max_size = max_body_size(scope['path'])
+            if content_length.isdigit() and int(content_length) > max_size:
+                response = JSONResponse(
+                    {"detail": "The body exceeds {} bytes".format(max_size)},
+                    status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
 
 # Define the FastAPI application
 app = FastAPI(
@@ -30,6 +157,9 @@ app = FastAPI(
     version="0.1",
 )
 
+# Reject the oversized uploads early, behind the CORS middleware so that the browsers can read the rejection
+app.add_middleware(UploadSizeMiddleware)
+
 # Fix CORS errors (arising when testing the frontend)
 app.add_middleware(
     CORSMiddleware,
@@ -37,10 +167,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["prediction"],
+    expose_headers=["prediction", "Server-Timing", "X-Degraded"],
 )
 
 
+@app.exception_handler(EngineOverloadedError)
+async def overloaded_handler(request: Request, exc: EngineOverloadedError):
+    # A Service-Unavailable-status response when the inference engine is saturated
+    response = {
+        "message": HTTPStatus.SERVICE_UNAVAILABLE.phrase,
+        "status-code": HTTPStatus.SERVICE_UNAVAILABLE,
+        "detail": str(exc)
+    }
+    return JSONResponse(response, status_code=HTTPStatus.SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+
+
 @app.on_event("startup")
 async def expose_instrumentator():
     # Expose Prometheus FastAPI instrumentator
@@ -49,8 +190,19 @@ async def expose_instrumentator():
                                                       'response_size' : {},
                                                       'latency' : {},
                                                       'requests' : {},
-                                                      'model_output' : {'buckets' : tuple([float(x) for x in PREDICTION_TAGS.keys()])}})
-    instrumentator.instrument(app).expose(app, include_in_schema=False, should_gzip=True)
+                                                      'model_output' : {'buckets' : tuple([float(x) for x in PREDICTION_TAGS.keys()])},
+                                                      'stage_latency' : {},
+                                                      'request_peak_memory' : {}})
+    instrumentator.instrument(app)
+    if METRICS_ADDRESS is None:
+        instrumentator.expose(app, include_in_schema=False, should_gzip=True)
+    else:
+        # Pre-forked workers expose their metrics on their own port, as the shared port may reach any of them
+        host, port = METRICS_ADDRESS
+        start_http_server(port, addr=host)
+    register_cache_metrics(PREDICTIONS, 'prediction_cache')
+    register_engine_metrics(SCHEDULERS, MODEL_WRAPPERS, EXECUTOR, SHEDDER)
+    register_memory_metrics(MODEL_WRAPPERS, {'prediction_cache': PREDICTIONS})
 
 
 @app.on_event("startup")
@@ -60,18 +212,54 @@ def load_models():
     DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print("Using device: {}".format(DEVICE))
 
-    # Load the model, map_location makes it work also on CPU
-    model = CTNet(num_classes=3, pretrained=False)
-    state_filepath = os.path.join(MODELS_PATH, MODEL_NAME)
-    model_params = torch.load(state_filepath)['model']
-    model.load_state_dict(model_params)
-    MODEL_WRAPPERS['ctnet'] = model
+    # Load the default model, the other ones are loaded on demand
+    model = MODEL_WRAPPERS.get(DEFAULT_MODEL)
 
-    # Move the model to device
-    model.to(DEVICE)
+    # Warm up the default model and the heatmaps rendering, so that the first request does not pay
+    # for the lazy initializations (e.g. memory allocations, kernels selection and deferred imports)
+    _, att1, att2 = warmup_model(model)
+    render_binary_attention_map(np.zeros((224, 224), dtype=np.uint8), att1.cpu(), att2.cpu())
 
-    # Make sure the model is set to evaluation mode
-    model.eval()
+    # Load the index of the embeddings of the reference cases, if any, memory-mapping it
+    # The model embedding the queries is loaded on demand
+    global EMBEDDINGS
+    if os.path.isfile(os.path.join(EMBEDDINGS_PATH, METADATA_FILENAME)):
+        EMBEDDINGS = EmbeddingIndex(EMBEDDINGS_PATH)
+        print("Loaded {} reference cases embedded by {}".format(len(EMBEDDINGS), EMBEDDINGS.model))
+
+    # Watch the models directory, so that updated checkpoints are reloaded without restarting
+    if MODEL_WATCHER is not None:
+        MODEL_WATCHER.start()
+
+    # Process the jobs in a background thread, unless dedicated worker processes are processing them
+    # The items left running by a previous run are requeued, as no other worker is running yet
+    open_jobs()
+    if JOB_THREAD:
+        JOBS.recover()
+        JOB_WORKER.start()
+
+    # Report the service as ready
+    global READY
+    READY = True
+
+
+@app.on_event("shutdown")
+def stop_schedulers():
+    # Stop reporting the service as ready
+    global READY
+    READY = False
+
+    # Stop watching the models directory
+    if MODEL_WATCHER is not None:
+        MODEL_WATCHER.stop()
+
+    # Stop processing the jobs, after the current batch
+    if JOB_WORKER is not None:
+        JOB_WORKER.stop()
+
+    # Serve the pending requests and stop the schedulers worker threads
+    for scheduler in SCHEDULERS.values():
+        scheduler.stop()
 
 
 @app.get(
@@ -102,6 +290,34 @@ def index(request: Request):
     return response
 
 
+@app.get(
+    "/ready", tags=["General"],
+    summary="Check the service is ready, i.e. the default model is loaded and warmed up.",
+    responses={
+        200: {
+            "description": "An HTTP OK-status message, if the service is ready to serve the predictions.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "OK",
+                        "status-code": 200
+                    }
+                }
+            }
+        },
+        503: {"description": "An HTTP Service-Unavailable-status message, if the service is not ready yet."}
+    }
+)
+def ready(request: Request):
+    # A Service-Unavailable-status response until the default model is warmed up
+    status = HTTPStatus.OK if READY else HTTPStatus.SERVICE_UNAVAILABLE
+    response = {
+        "message": status.phrase,
+        "status-code": status
+    }
+    return JSONResponse(response, status_code=status)
+
+
 @app.get(
     "/models", tags=["Models"],
     summary="Get the list of available models in the system.",
@@ -113,7 +329,9 @@ def index(request: Request):
                     "example": {
                         "message": "OK",
                         "status-code": 200,
-                        "models": ["model1", "model2", "model3"]
+                        "models": ["model1", "model2", "model3"],
+                        "loaded": ["model1"],
+                        "default": "model1"
                     }
                 }
             }
@@ -122,13 +340,15 @@ def index(request: Request):
 )
 def get_models_list(request: Request):
     # Get the available models
-    available_models = list(MODEL_WRAPPERS.keys())
+    available_models = MODEL_WRAPPERS.keys()
 
     # Send an OK-status response with the list of available models
     response = {
         "message": HTTPStatus.OK.phrase,
         "status-code": HTTPStatus.OK,
-        "models": available_models
+        "models": available_models,
+        "loaded": MODEL_WRAPPERS.loaded(),
+        "default": DEFAULT_MODEL
     }
     return response
 
@@ -140,11 +360,28 @@ def get_models_list(request: Request):
     responses={
         200: {
             "description": "A disease prediction, i.e. one of {}, and also an heatmap. The red zone was the most"
-                           " relevant for the prediction.".format(list(PREDICTION_TAGS.values())),
+                           " relevant for the prediction. When the service is overloaded, the heatmap is skipped and"
+                           " the prediction is returned as JSON (like /predictions), with the X-Degraded header set:"
+                           " the heatmap can be requested later by the prediction identifier.".format(
+                               list(PREDICTION_TAGS.values())
+                           ),
             "content": {
-                "image/png": {"example": {"prediction": "COVID - 19"}}
+                "image/png": {"example": {"prediction": "COVID - 19"}},
+                "application/json": {
+                    "example": {
+                        "message": "OK",
+                        "status-code": 200,
+                        "prediction_id": "9f2c3a0d5e...b41e",
+                        "model": "ct_net",
+                        "prediction": "COVID - 19",
+                        "class": 2,
+                        "probabilities": {"Normal": 0.02, "Pneumonia": 0.08, "COVID - 19": 0.9}
+                    }
+                }
             }
-        }
+        },
+        404: {"description": "The model does not exist."},
+        503: {"description": "The service is saturated, retry later."}
     }
 )
 async def predict(
@@ -154,54 +391,1063 @@ async def predict(
     ymin: int = Query(0, ge=0, description="The top-left bounding box Y-coordinate."),
     xmax: int = Query(0, ge=0, description="The bottom-right bounding box X-coordinate."),
     ymax: int = Query(0, ge=0, description="The bottom-right bounding box Y-coordinate."),
+    encoding: ImageEncoding = Query(ImageEncoding.png, description="The image encoding of the heatmap."),
+    model: str = Query(DEFAULT_MODEL, description="The name of the model to use."),
+    file: UploadFile = File(..., description="The CT image to predict.")
+):
+    # Check the model exists
+    check_model(model)
+
+    # Reject the request early if too many requests are being served
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        # Read the uploaded file, off the event loop
+        bbox = (xmin, ymin, xmax, ymax)
+        with timer.stage('read'):
+            contents, digest = await EXECUTOR.run(read_upload, file)
+
+        # Obtain the prediction and the attention map, from the cache or by running the model
+        # The attention map is skipped if the service is overloaded, as a degraded answer is better than a timeout
+        key, entry = await get_prediction(digest, contents, bbox, model, timer)
+        if SHEDDER.degrade():
+            PROFILER.request_done()
+            return degraded_response(key, entry, model, timer)
+        heatmap = await get_heatmap(key, entry, encoding.value, timer)
+        prediction = torch.argmax(entry['logits'], dim=1).item()
+        tags = prediction_tags(entry['logits'])
+
+    # Send a response with the prediction, the attention map and the time spent in each stage
+    PROFILER.request_done()
+    return Response(heatmap, headers={"prediction": tags[prediction],
+                                      "X-prediction" : str(prediction),
+                                      "Server-Timing": timer.server_timing()}, media_type=IMAGE_ENCODINGS[encoding][1])
+
+
+@app.post(
+    "/predict/batch", tags=["Prediction"],
+    summary="Given many CT scans image files and their bounding boxes, tell for each one if the patient has COVID"
+            " and optionally return the heatmaps of the pixels on which the model focused.",
+    responses={
+        200: {
+            "description": "One JSON object per line for each image, in the same order of the uploaded files,"
+                           " with a disease prediction, i.e. one of {}, and optionally an heatmap encoded as"
+                           " base64 PNG.".format(list(PREDICTION_TAGS.values())),
+            "content": {
+                "application/x-ndjson": {
+                    "example": {"index": 0, "filename": "slice.png", "prediction": "COVID - 19", "class": 2,
+                                "heatmap": "iVBORw0KGgo..."}
+                }
+            }
+        },
+        404: {"description": "The model does not exist."},
+        422: {"description": "The number of bounding boxes does not match the number of files."},
+        503: {"description": "The service is saturated, or overloaded and rejecting the batches, retry later."}
+    }
+)
+async def predict_batch(
+    request: Request,
+    xmin: List[int] = Query(..., ge=0, description="The top-left bounding box X-coordinate of each file."),
+    ymin: List[int] = Query(..., ge=0, description="The top-left bounding box Y-coordinate of each file."),
+    xmax: List[int] = Query(..., ge=0, description="The bottom-right bounding box X-coordinate of each file."),
+    ymax: List[int] = Query(..., ge=0, description="The bottom-right bounding box Y-coordinate of each file."),
+    heatmap: bool = Query(True, description="Whether to return the heatmaps."),
+    encoding: ImageEncoding = Query(ImageEncoding.png, description="The image encoding of the heatmaps."),
+    model: str = Query(DEFAULT_MODEL, description="The name of the model to use."),
+    files: List[UploadFile] = File(..., description="The CT images to predict.")
+):
+    # Check the bounding boxes and the number of files
+    if not len(files) == len(xmin) == len(ymin) == len(xmax) == len(ymax):
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "A bounding box must be specified for each file")
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY, "At most {} files can be predicted at once".format(MAX_BATCH_FILES)
+        )
+    check_model(model)
+
+    # Reject the request early if too many requests are being served, or if the batches are being shed
+    # The time spent in each stage is accumulated over the files
+    SHEDDER.admit_low_priority()
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        # Read all the uploaded files, off the event loop
+        bboxes = list(zip(xmin, ymin, xmax, ymax))
+        with timer.stage('read'):
+            uploads = await asyncio.gather(*[EXECUTOR.run(read_upload, f) for f in files])
+
+        # Obtain the predictions, the scheduler splits the ones not in cache in batched forward passes
+        predictions = await asyncio.gather(*[
+            get_prediction(digest, contents, bbox, model, timer)
+            for ((contents, digest), bbox) in zip(uploads, bboxes)
+        ])
+
+        # Render the attention maps, off the event loop, unless the service is overloaded
+        heatmaps, degraded = [], heatmap and SHEDDER.degrade()
+        heatmap = heatmap and not degraded
+        if heatmap:
+            heatmaps = await asyncio.gather(*[
+                get_heatmap(key, entry, encoding.value, timer) for (key, entry) in predictions
+            ])
+
+    # Send a response with one line of JSON for each prediction
+    lines = []
+    for i, (f, (_, entry)) in enumerate(zip(files, predictions)):
+        prediction = torch.argmax(entry['logits'], dim=1).item()
+        line = {
+            "index": i,
+            "filename": f.filename,
+            "prediction": prediction_tags(entry['logits'])[prediction],
+            "class": prediction
+        }
+        if heatmap:
+            line["heatmap"] = base64.b64encode(heatmaps[i]).decode('ascii')
+        lines.append(json.dumps(line) + '\n')
+    headers = {"Server-Timing": timer.server_timing()}
+    if degraded:
+        headers["X-Degraded"] = "heatmap"
+    PROFILER.request_done()
+    return StreamingResponse(iter(lines), headers=headers, media_type="application/x-ndjson")
+
+
+@app.post(
+    "/predictions", tags=["Prediction"],
+    summary="Given the bounding box of the relevant area and the image file of a CT scan, tell if the patient has COVID"
+            " without rendering the heatmap, which can be requested later by the prediction identifier.",
+    responses={
+        200: {
+            "description": "A disease prediction, i.e. one of {}, the class probabilities and the prediction"
+                           " identifier.".format(list(PREDICTION_TAGS.values())),
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "OK",
+                        "status-code": 200,
+                        "prediction_id": "9f2c3a0d5e...b41e",
+                        "model": "ct_net",
+                        "prediction": "COVID - 19",
+                        "class": 2,
+                        "probabilities": {"Normal": 0.02, "Pneumonia": 0.08, "COVID - 19": 0.9}
+                    }
+                }
+            }
+        },
+        404: {"description": "The model does not exist."},
+        503: {"description": "The service is saturated, retry later."}
+    }
+)
+async def predict_json(
+    request: Request,
+    xmin: int = Query(0, ge=0, description="The top-left bounding box X-coordinate."),
+    ymin: int = Query(0, ge=0, description="The top-left bounding box Y-coordinate."),
+    xmax: int = Query(0, ge=0, description="The bottom-right bounding box X-coordinate."),
+    ymax: int = Query(0, ge=0, description="The bottom-right bounding box Y-coordinate."),
+    model: str = Query(DEFAULT_MODEL, description="The name of the model to use."),
     file: UploadFile = File(..., description="The CT image to predict.")
 ):
-    # Load and preprocess the image by upload
-    bbox = (xmin, ymin, xmax, ymax)
-    img = upload_file(bbox, file)
+    # Check the model exists
+    check_model(model)
+
+    # Reject the request early if too many requests are being served
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        # Read the uploaded file, off the event loop
+        bbox = (xmin, ymin, xmax, ymax)
+        with timer.stage('read'):
+            contents, digest = await EXECUTOR.run(read_upload, file)
+
+        # Obtain the prediction, from the cache or by running the model
+        # Its cache key identifies the prediction, so that the heatmap can be rendered on demand
+        prediction_id, entry = await get_prediction(digest, contents, bbox, model, timer)
+
+    # Send an OK-status response with the prediction and the class probabilities
+    PROFILER.request_done()
+    return prediction_response(prediction_id, entry, model, timer)
+
+
+@app.get(
+    "/predictions/{prediction_id}/heatmap", tags=["Prediction"],
+    summary="Get the heatmap of the pixels on which the model focused in order to provide a previous prediction.",
+    responses={
+        200: {
+            "description": "An heatmap. The red zone was the most relevant for the prediction.",
+            "content": {"image/png": {}}
+        },
+        404: {"description": "The prediction does not exist or it has expired."},
+        503: {"description": "The service is saturated, or overloaded and rejecting the heatmaps, retry later."}
+    }
+)
+async def get_prediction_heatmap(
+    request: Request,
+    prediction_id: str,
+    encoding: ImageEncoding = Query(ImageEncoding.png, description="The image encoding of the heatmap.")
+):
+    # Get the cached prediction
+    entry = PREDICTIONS.get(prediction_id)
+    if entry is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Prediction not found or expired")
+
+    # Render the attention map, unless it is already cached or the heatmaps are being shed
+    SHEDDER.admit_low_priority()
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        heatmap = await get_heatmap(prediction_id, entry, encoding.value, timer)
+    PROFILER.request_done()
+    return Response(heatmap, headers={"Server-Timing": timer.server_timing()}, media_type=IMAGE_ENCODINGS[encoding][1])
+
+
+@app.post(
+    "/predictions/raw", tags=["Prediction"],
+    summary="Given the raw pixels of one or many CT slices, already cropped and resized to {}x{} grayscale, tell if"
+            " the patient has COVID, without decoding any image file.".format(*IMAGE_SIZE),
+    responses={
+        200: {
+            "description": "The predictions of the slices, in the same order of the body, each one with a disease"
+                           " prediction, i.e. one of {}, the class probabilities and the prediction identifier."
+                           .format(list(PREDICTION_TAGS.values())),
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "OK",
+                        "status-code": 200,
+                        "model": "ct_net",
+                        "predictions": [{
+                            "index": 0,
+                            "prediction_id": "9f2c3a0d5e...b41e",
+                            "prediction": "COVID - 19",
+                            "class": 2,
+                            "probabilities": {"Normal": 0.02, "Pneumonia": 0.08, "COVID - 19": 0.9}
+                        }]
+                    }
+                }
+            }
+        },
+        404: {"description": "The model does not exist."},
+        413: {"description": "The body exceeds the maximum upload size."},
+        422: {"description": "The shape or the data type is not supported, or they do not match the body size."},
+        503: {"description": "The service is saturated, retry later."}
+    }
+)
+async def predict_raw(
+    request: Request,
+    model: str = Query(DEFAULT_MODEL, description="The name of the model to use."),
+    shape: str = Header(
+        None, alias='X-Tensor-Shape',
+        description="The shape of the body, i.e. 'H,W' for a single slice or 'N,H,W' for a batch of slices."
+                    " If not given, the body is a single slice."
+    ),
+    dtype: str = Header('uint8', alias='X-Tensor-Dtype', description="The data type of the pixels.")
+):
+    # Check the model exists
+    check_model(model)
+
+    # Reject the request early if too many requests are being served
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        # Read the body and view it as a batch of slices, without intermediate image objects
+        with timer.stage('read'):
+            body = await read_raw_body(request)
+        with timer.stage('decode'):
+            images = load_raw_images(body, shape, dtype)
+
+        # Obtain the predictions, the scheduler splits the ones not in cache in batched forward passes
+        # The slices are identified by their pixels, so that their predictions are shared with the other endpoints
+        predictions = await asyncio.gather(*[
+            get_prediction(hashlib.sha256(image.tobytes()).hexdigest(), None, None, model, timer, image=image)
+            for image in images
+        ])
+
+    # Send an OK-status response with the predictions and the class probabilities
+    results = []
+    for i, (prediction_id, entry) in enumerate(predictions):
+        probabilities = torch.softmax(entry['logits'], dim=1).squeeze(0).tolist()
+        prediction = torch.argmax(entry['logits'], dim=1).item()
+        tags = prediction_tags(entry['logits'])
+        results.append({
+            "index": i,
+            "prediction_id": prediction_id,
+            "prediction": tags[prediction],
+            "class": prediction,
+            "probabilities": {tags[j]: p for (j, p) in enumerate(probabilities)}
+        })
+    response = {
+        "message": HTTPStatus.OK.phrase,
+        "status-code": HTTPStatus.OK,
+        "model": model,
+        "predictions": results
+    }
+    PROFILER.request_done()
+    return JSONResponse(response, headers={"Server-Timing": timer.server_timing()})
+
+
+@app.post(
+    "/jobs", tags=["Jobs"], status_code=HTTPStatus.ACCEPTED,
+    summary="Submit many CT scans image files and their bounding boxes, or a manifest of images in the archive,"
+            " to be predicted in background. The results are polled or streamed by the job identifier.",
+    responses={
+        202: {
+            "description": "The job identifier and status.",
+            "content": {
+                "application/json": {
+                    "example": {"id": "3f0c9a4e...", "model": "ct_net", "created": 1650000000.0, "status": "queued",
+                                "items": 2, "pending": 2, "running": 0, "done": 0, "failed": 0}
+                }
+            }
+        },
+        404: {"description": "The model does not exist."},
+        413: {"description": "An uploaded file exceeds the maximum upload size."},
+        422: {"description": "The bounding boxes do not match the files, or the manifest is invalid."}
+    }
+)
+def create_job(
+    request: Request,
+    xmin: List[int] = Query(None, ge=0, description="The top-left bounding box X-coordinate of each file."),
+    ymin: List[int] = Query(None, ge=0, description="The top-left bounding box Y-coordinate of each file."),
+    xmax: List[int] = Query(None, ge=0, description="The bottom-right bounding box X-coordinate of each file."),
+    ymax: List[int] = Query(None, ge=0, description="The bottom-right bounding box Y-coordinate of each file."),
+    model: str = Query(DEFAULT_MODEL, description="The name of the model to use."),
+    files: List[UploadFile] = File(None, description="The CT images to predict."),
+    manifest: UploadFile = File(
+        None, description="A CSV file with the columns path, xmin, ymin, xmax and ymax, listing the images to"
+                          " predict by their path in the archive, instead of uploading them."
+    )
+):
+    # Check the model exists
+    check_model(model)
+
+    # Store the uploaded files, or the paths listed by the manifest, notice that this endpoint runs off the event loop
+    if (files is None) == (manifest is None):
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Either files or a manifest must be submitted")
+    if files is not None:
+        coordinates = [xmin or [], ymin or [], xmax or [], ymax or []]
+        if any(len(c) != len(files) for c in coordinates):
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "A bounding box must be specified for each file")
+        if len(files) > MAX_JOB_FILES:
+            raise HTTPException(
+                HTTPStatus.UNPROCESSABLE_ENTITY, "At most {} files can be submitted at once".format(MAX_JOB_FILES)
+            )
+        items = (
+            {'filename': f.filename, 'contents': read_upload(f)[0], 'bbox': bbox}
+            for (f, bbox) in zip(files, zip(*coordinates))
+        )
+    else:
+        items = read_manifest(manifest)
+    job_id = JOBS.create(model, items)
+
+    # Send an Accepted-status response with the job status, to be polled at its location
+    return JSONResponse(JOBS.get(job_id), status_code=HTTPStatus.ACCEPTED, headers={"Location": "/jobs/" + job_id})
+
+
+@app.get(
+    "/jobs/{job_id}", tags=["Jobs"],
+    summary="Get the status of a job, i.e. the number of its images by status.",
+    responses={
+        200: {
+            "description": "The job status, i.e. one of queued, running or done.",
+            "content": {
+                "application/json": {
+                    "example": {"id": "3f0c9a4e...", "model": "ct_net", "created": 1650000000.0, "status": "running",
+                                "items": 2, "pending": 0, "running": 1, "done": 1, "failed": 0}
+                }
+            }
+        },
+        404: {"description": "The job does not exist."}
+    }
+)
+def get_job(request: Request, job_id: str):
+    return JSONResponse(check_job(job_id))
+
+
+@app.get(
+    "/jobs/{job_id}/results", tags=["Jobs"],
+    summary="Get the results of the images of a job predicted so far, or stream them until the job is done.",
+    responses={
+        200: {
+            "description": "One JSON object per line for each predicted image, sorted by index, with a disease"
+                           " prediction, i.e. one of {}, and the class probabilities, or the error of the images"
+                           " that could not be predicted. A stream ends after the maximum wait even if the job is not"
+                           " done, then it can be resumed after the last received index.".format(
+                               list(PREDICTION_TAGS.values())
+                           ),
+            "content": {
+                "application/x-ndjson": {
+                    "example": {"index": 0, "filename": "slice.png", "status": "done", "prediction": "COVID - 19",
+                                "class": 2, "probabilities": {"Normal": 0.02, "Pneumonia": 0.08, "COVID - 19": 0.9}}
+                }
+            }
+        },
+        404: {"description": "The job does not exist."}
+    }
+)
+async def get_job_results(
+    request: Request,
+    job_id: str,
+    after: int = Query(-1, ge=-1, description="Return only the images whose index is greater than this one."),
+    wait: bool = Query(False, description="Whether to stream the results until the job is done."),
+    timeout: float = Query(
+        None, ge=0.0, description="The maximum time in seconds to stream the results, capped by the server."
+    )
+):
+    await run_in_threadpool(check_job, job_id)
+    timeout = MAX_JOB_WAIT if timeout is None else min(timeout, MAX_JOB_WAIT)
+    deadline = time.monotonic() + timeout
+
+    async def lines():
+        # The job store is read in the threadpool only briefly, so that the waiting clients do not hold its threads
+        # The stream ends after the maximum wait, then the client resumes it after the last received index
+        last = after
+        while True:
+            # Check the status before reading the results, so that no result is missed when the job is done
+            status = await run_in_threadpool(JOBS.get, job_id)
+            for result in await run_in_threadpool(JOBS.results, job_id, after=last):
+                last = result['index']
+                yield json.dumps(result) + '\n'
+            if not wait or status is None or status['status'] == 'done' or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(min(JOB_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.delete(
+    "/jobs/{job_id}", tags=["Jobs"],
+    summary="Cancel a job, deleting its uploaded images and its results.",
+    responses={
+        200: {"description": "The job was deleted."},
+        404: {"description": "The job does not exist."}
+    }
+)
+def delete_job(request: Request, job_id: str):
+    if not JOBS.delete(job_id):
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Job {} not found".format(job_id))
+    response = {
+        "message": HTTPStatus.OK.phrase,
+        "status-code": HTTPStatus.OK
+    }
+    return JSONResponse(response)
+
+
+@app.post(
+    "/similar", tags=["Prediction"],
+    summary="Given the bounding box of the relevant area and the image file of a CT scan, find the most similar"
+            " reference cases, by the cosine similarity of the attention-pooled embeddings of the model.",
+    responses={
+        200: {
+            "description": "The reference cases, sorted by decreasing similarity, each one with its image filename"
+                           " (relative to the data set directory), its class, i.e. one of {}, and its similarity."
+                           " The embedding of the query is returned too, if requested.".format(
+                               list(PREDICTION_TAGS.values())),
+            "content": {
+                "application/json": {
+                    "example": {
+                        "message": "OK",
+                        "status-code": 200,
+                        "model": "ct_net",
+                        "cases": [{"index": 812, "filename": "train/covid-0812.png", "class": 2,
+                                   "label": "COVID - 19", "similarity": 0.97}]
+                    }
+                }
+            }
+        },
+        404: {"description": "There is no index of reference cases, or the model which embedded them is missing (or"
+                              " it does not expose its embeddings, e.g. if it is served as an ONNX graph)."},
+        503: {"description": "The service is saturated, or overloaded and rejecting the searches, retry later."}
+    }
+)
+async def find_similar_cases(
+    request: Request,
+    xmin: int = Query(0, ge=0, description="The top-left bounding box X-coordinate."),
+    ymin: int = Query(0, ge=0, description="The top-left bounding box Y-coordinate."),
+    xmax: int = Query(0, ge=0, description="The bottom-right bounding box X-coordinate."),
+    ymax: int = Query(0, ge=0, description="The bottom-right bounding box Y-coordinate."),
+    k: int = Query(5, ge=1, le=MAX_SIMILAR_CASES, description="The number of similar cases."),
+    embedding: bool = Query(False, description="Whether to return the embedding of the query."),
+    file: UploadFile = File(..., description="The CT image whose similar cases to find.")
+):
+    # Check the reference cases are indexed, and that the model which embedded them exists
+    index = EMBEDDINGS
+    if index is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "No index of reference cases")
+    check_model(index.model)
 
-    # Get the required model
-    model = MODEL_WRAPPERS['ctnet']
+    # Reject the request early if too many requests are being served, or if the searches are being shed
+    SHEDDER.admit_low_priority()
+    timer = StageTimer()
+    with EXECUTOR.admit():
+        # Read and decode the uploaded file, off the event loop
+        bbox = (xmin, ymin, xmax, ymax)
+        with timer.stage('read'):
+            contents, _ = await EXECUTOR.run(read_upload, file)
+        with timer.stage('decode'):
+            image = await EXECUTOR.run(load_image, bbox, contents)
 
-    # Convert the input image to a tensor, normalize it,
-    # move it to device and unsqueeze the batch dimension
-    tensor = torchvision.transforms.functional.to_tensor(img)
-    tensor = torchvision.transforms.functional.normalize(tensor, (0.5,), (0.5,))
-    tensor = tensor.unsqueeze(0).to(DEVICE)
+        # Embed the image and search the most similar reference cases, off the event loop
+        with timer.stage('embed'):
+            query = await EXECUTOR.run(embed_image, index.model, image)
+        with timer.stage('search'):
+            indices, similarities = await EXECUTOR.run(index.search, query, k)
 
-    # Obtain the prediction by the model
+    # Send an OK-status response with the similar cases
+    cases = []
+    for i, similarity in zip(indices[0].tolist(), similarities[0].tolist()):
+        case = index.cases[i]
+        cases.append({
+            "index": i,
+            "filename": case['filename'],
+            "class": int(case['class']),
+            "label": PREDICTION_TAGS.get(int(case['class'])),
+            "similarity": similarity
+        })
+    response = {
+        "message": HTTPStatus.OK.phrase,
+        "status-code": HTTPStatus.OK,
+        "model": index.model,
+        "cases": cases
+    }
+    if embedding:
+        response["embedding"] = query[0].tolist()
+    PROFILER.request_done()
+    return JSONResponse(response, headers={"Server-Timing": timer.server_timing()})
+
+
+@app.post(
+    "/admin/profile", tags=["Admin"],
+    summary="Profile the service over the next requests, returning the aggregated operators and a Chrome trace.",
+    responses={
+        200: {
+            "description": "The capture duration, the number of served requests, the top operators and named ranges"
+                           " (e.g. the submodules of the model, decoding and rendering) by self CPU time and the"
+                           " Chrome trace, to be opened by chrome://tracing or Perfetto.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "duration": 2.5,
+                        "requests": 10,
+                        "all_threads": True,
+                        "top": [{"name": "aten::mkldnn_convolution", "calls": 530, "self_cpu_time_ms": 812.4,
+                                 "cpu_time_ms": 861.2}],
+                        "trace": {"traceEvents": []}
+                    }
+                }
+            }
+        },
+        401: {"description": "The admin token is missing or wrong."},
+        404: {"description": "The admin endpoints are disabled, i.e. no admin token is configured."},
+        409: {"description": "Another profiling capture is running."}
+    }
+)
+async def profile_requests(
+    request: Request,
+    seconds: float = Query(10.0, gt=0.0, le=MAX_PROFILE_TIME, description="The maximum duration of the capture."),
+    requests: int = Query(None, ge=1, description="The number of requests to capture, if less than the duration."),
+    top: int = Query(25, ge=1, description="The number of operators of the aggregated table."),
+    trace: bool = Query(True, description="Whether to include the Chrome trace."),
+    authorization: str = Header(None, description="The admin token, as 'Bearer <token>'.")
+):
+    # Check the admin token, the admin endpoints are disabled if it is not configured
+    check_admin(authorization)
+
+    # Profile the process off the event loop, while it keeps serving the requests
+    models = [MODEL_WRAPPERS.get(name) for name in MODEL_WRAPPERS.loaded()]
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, functools.partial(
+            PROFILER.capture, seconds, n_requests=requests, models=models, row_limit=top, trace=trace
+        ))
+    except ProfilerBusyError as e:
+        raise HTTPException(HTTPStatus.CONFLICT, str(e))
+    return JSONResponse(result)
+
+
+async def get_prediction(
+    digest: str, contents: bytes, bbox: tuple, name: str, timer: StageTimer = None, image: np.ndarray = None
+):
+    """
+    Get the prediction of an uploaded image, from the cache or by running the model.
+    Concurrent requests of the same prediction share a single computation.
+
+    :param digest: The SHA-256 digest of the uploaded file contents, or of the pixels of the preprocessed image.
+    :param contents: The uploaded file contents.
+    :param bbox: The image bounding box, or None if the image is already preprocessed.
+    :param name: The model name.
+    :param timer: An optional timer of the stages of the request.
+    :param image: The preprocessed image as a uint8 array, if any. If not None, the contents are not decoded.
+    :return: The cache key and the cached entry, i.e. a dictionary of input image, logits and attention maps.
+    """
+    # Identify the prediction by the uploaded image, the bounding box and the model checkpoint
+    key = hashlib.sha256(json.dumps(
+        [digest, list(bbox) if bbox is not None else None, MODEL_WRAPPERS.identity(name)]
+    ).encode()).hexdigest()
+
+    timer = timer if timer is not None else StageTimer()
+
+    async def compute():
+        # Time the stages of this prediction alone, to observe the load of the service
+        stages = StageTimer()
+        if image is None:
+            with stages.stage('decode'):
+                preprocessed = await EXECUTOR.run(load_image, bbox, contents)
+        else:
+            preprocessed = image
+        with stages.stage('load'):
+            await EXECUTOR.run(MODEL_WRAPPERS.get, name)  # Load the model lazily, off the event loop
+        outputs = await get_scheduler(name).submit(preprocessed, timer=stages)
+        logits, att1, att2 = [o.cpu().clone() for o in outputs]
+        for stage, duration in stages.durations.items():
+            timer.add(stage, duration)
+        SHEDDER.observe(sum(stages.durations.values()), wait=stages.durations.get('queue', 0.0))
+        return {'image': preprocessed, 'logits': logits, 'att1': att1, 'att2': att2}
+
+    return key, await PREDICTIONS.get_or_compute(key, compute)
+
+
+async def get_heatmap(key: str, entry: dict, encoding: str = 'png', timer: StageTimer = None):
+    """
+    Get the encoded attention map of a prediction, from the cache or by rendering it.
+
+    :param key: The cache key of the prediction.
+    :param entry: The cached entry of the prediction.
+    :param encoding: The image encoding.
+    :param timer: An optional timer of the stages of the request.
+    :return: The encoded image bytes.
+    """
+    timer = timer if timer is not None else StageTimer()
+
+    async def compute():
+        return await EXECUTOR.run(render_heatmap, entry, encoding, timer)
+
+    return await PREDICTIONS.get_or_compute('{}/heatmap.{}'.format(key, encoding), compute)
+
+
+def prediction_response(prediction_id: str, entry: dict, model: str, timer: StageTimer):
+    """
+    A synchronous utility function used to build the JSON response of a prediction.
+
+    :param prediction_id: The prediction identifier, i.e. its cache key.
+    :param entry: The cached entry of the prediction.
+    :param model: The model name.
+    :param timer: The timer of the stages of the request.
+    :return: The JSON response, with the prediction and the class probabilities.
+    """
+    probabilities = torch.softmax(entry['logits'], dim=1).squeeze(0).tolist()
+    prediction = torch.argmax(entry['logits'], dim=1).item()
+    tags = prediction_tags(entry['logits'])
+    response = {
+        "message": HTTPStatus.OK.phrase,
+        "status-code": HTTPStatus.OK,
+        "prediction_id": prediction_id,
+        "model": model,
+        "prediction": tags[prediction],
+        "class": prediction,
+        "probabilities": {tags[i]: p for (i, p) in enumerate(probabilities)}
+    }
+    return JSONResponse(response, headers={
+        "prediction": tags[prediction], "X-prediction": str(prediction), "Server-Timing": timer.server_timing()
+    })
+
+
+def degraded_response(prediction_id: str, entry: dict, model: str, timer: StageTimer):
+    """
+    A synchronous utility function used to build the response of a prediction whose heatmap is skipped, as the
+    service is overloaded.
+
+    :param prediction_id: The prediction identifier, i.e. its cache key.
+    :param entry: The cached entry of the prediction.
+    :param model: The model name.
+    :param timer: The timer of the stages of the request.
+    :return: The JSON response, with the prediction and the class probabilities, flagged by the X-Degraded header.
+    """
+    # The status is still OK, as the clients tell the degraded responses by their header and their content type
+    response = prediction_response(prediction_id, entry, model, timer)
+    response.headers["X-Degraded"] = "heatmap"
+    return response
+
+
+def render_heatmap(entry: dict, encoding: str, timer: StageTimer):
+    """
+    A synchronous utility function used to render and encode the attention map of a prediction.
+
+    :param entry: The cached entry of the prediction.
+    :param encoding: The image encoding.
+    :param timer: The timer of the stages of the request.
+    :return: The encoded image bytes.
+    """
+    with timer.stage('render'), PROFILER.record('render'):
+        img = binary_attention_map(entry['image'], entry['att1'], entry['att2'])
+    with timer.stage('encode'), PROFILER.record('encode'):
+        return encode_image(img, encoding=encoding, compression=PNG_COMPRESSION, quality=IMAGE_QUALITY)
+
+
+def forward_model(name: str, inputs: torch.Tensor):
+    """
+    A synchronous utility function used to run a batched forward pass of a model.
+
+    :param name: The model name.
+    :param inputs: The batch of input tensors.
+    :return: The batched predictions and attention maps.
+    """
+    model = MODEL_WRAPPERS[name]
     with torch.no_grad():  # Disable gradient graph building
-        prediction, att1, att2 = model(tensor, attention=True)
-        prediction = torch.argmax(prediction, dim=1).item()
+        return model(inputs.to(DEVICE), attention=True)
 
-    # Send a response with the prediction and the attention map
-    stream = io.BytesIO()
-    tensor = torchvision.transforms.functional.normalize(tensor, (-1,), (2,))
-    save_binary_attention_map(stream, tensor, att1, att2)
-    stream.seek(0)
-    return StreamingResponse(stream, headers={"prediction": PREDICTION_TAGS[prediction],
-                                              "X-prediction" : str(prediction)}, media_type="image/png")
 
+def embed_image(name: str, image: np.ndarray):
+    """
+    A synchronous utility function used to compute the embedding of a preprocessed image, by the served model.
 
-def upload_file(bbox: tuple, file: UploadFile = File(...)):
+    :param name: The name of the model which embedded the reference cases.
+    :param image: The preprocessed image as a uint8 array.
+    :return: The (1, D) array of the embedding.
     """
-    A synchronous utility function used to upload an image file.
+    model = MODEL_WRAPPERS[name]
+    try:
+        with torch.no_grad():  # Disable gradient graph building
+            embeddings, _ = forward_embeddings(model, normalize(image).unsqueeze(0).to(DEVICE))
+    except ValueError:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Model {} does not expose its embeddings".format(name))
+    return embeddings.cpu().numpy()
+
+
+def load_model(filepath: str):
+    """
+    A synchronous utility function used to load a model checkpoint.
+
+    :param filepath: The checkpoint filepath.
+    :return: The model, moved to device and set to evaluation mode.
+    """
+    # Serve the exported ONNX graphs through ONNX Runtime
+    extension = os.path.splitext(filepath)[1]
+    if extension == '.onnx':
+        return OnnxModel(filepath, num_threads=ONNX_THREADS)
+
+    # Instantiate the model, the number of classes is given by the checkpoint
+    if extension == '.weights':
+        # The parameters of flat checkpoints are memory-mapped, without unpickling and copying them
+        model = load_flat_model(
+            lambda state_dict: CTNet(num_classes=state_dict['fc.weight'].shape[0], pretrained=False), filepath
+        )
+    else:
+        # Load the model parameters, map_location makes it work also on CPU
+        model_params = torch.load(filepath, map_location='cpu')['model']
+        model = CTNet(num_classes=model_params['fc.weight'].shape[0], pretrained=False)
+        model.load_state_dict(model_params)
+
+    # Move the model to device
+    model.to(DEVICE)
+
+    # Make sure the model is set to evaluation mode
+    model.eval()
+
+    # Prepare the model for the selected inference backend
+    # PyTorch checkpoints are served in fp32 if the ONNX backend is selected but the model was not exported
+    backend = 'fp32' if BACKEND == 'onnx' else BACKEND
+    calibration_data = load_calibration_data() if backend == 'static' else None
+    return prepare_model(model, backend=backend, calibration_data=calibration_data)
+
+
+def load_calibration_data():
+    """
+    A synchronous utility function used to load the images used to calibrate the static quantization of a model.
+
+    :return: A batch of normalized tensors.
+    """
+    filenames = sorted(os.listdir(CALIBRATION_PATH))[:N_CALIBRATION_IMAGES]
+    if not filenames:
+        raise ValueError("No calibration images found in {}".format(CALIBRATION_PATH))
+    tensors = []
+    for filename in filenames:
+        with pil.open(os.path.join(CALIBRATION_PATH, filename)) as img:
+            tensors.append(normalize(crop_resize(img)))
+    return torch.stack(tensors)
+
+
+def warmup_model(model: torch.nn.Module):
+    """
+    A synchronous utility function used to warm up a model, by a forward pass of a blank input.
+
+    :param model: The model.
+    :return: The predictions and the attention maps of the blank input.
+    """
+    with torch.no_grad():
+        return model(torch.zeros(1, 1, 224, 224, device=DEVICE), attention=True)
+
+
+def check_model(name: str):
+    """
+    A synchronous utility function used to check a model exists.
+
+    :param name: The model name.
+    """
+    if name not in MODEL_WRAPPERS:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Model {} not found".format(name))
+
+
+def check_admin(authorization: str):
+    """
+    A synchronous utility function used to check the admin token of a request.
+
+    :param authorization: The Authorization header of the request.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Not Found")
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(HTTPStatus.UNAUTHORIZED, "Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+
+def open_jobs():
+    """
+    A synchronous utility function used to open the job store and to instantiate its worker, unless already opened.
+    The store is not opened at import time, as it creates its database.
+    """
+    global JOBS, JOB_WORKER
+    if JOBS is None:
+        # A background thread shares the CPUs with the interactive requests, hence it predicts smaller batches
+        # and only while no interactive request is being served
+        JOBS = JobStore(JOBS_PATH)
+        JOB_WORKER = JobWorker(
+            JOBS, lambda name, items: predict_job_items(name, items),
+            batch_size=JOB_THREAD_BATCH_SIZE if JOB_THREAD else JOB_BATCH_SIZE, poll_interval=JOB_POLL_INTERVAL,
+            throttle_fn=interactive_pending if JOB_THREAD else None
+        )
+
+
+def interactive_pending():
+    """
+    A synchronous utility function used to check if any interactive request is being served.
+
+    :return: True if a request is admitted or waiting for a batch, False otherwise.
+    """
+    return EXECUTOR.pending > 0 or any(scheduler.queue_depth > 0 for scheduler in list(SCHEDULERS.values()))
+
+
+def check_job(job_id: str):
+    """
+    A synchronous utility function used to check a job exists.
+
+    :param job_id: The job identifier.
+    :return: The job status.
+    """
+    status = JOBS.get(job_id)
+    if status is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Job {} not found".format(job_id))
+    return status
+
+
+def get_scheduler(name: str):
+    """
+    A synchronous utility function used to get the micro-batching scheduler in front of a model.
+
+    :param name: The model name.
+    :return: The batch scheduler.
+    """
+    if name not in SCHEDULERS:
+        # The uploaded images are normalized directly into the preallocated batch of the scheduler
+        SCHEDULERS[name] = BatchScheduler(
+            lambda inputs: forward_model(name, inputs),
+            max_batch_size=MAX_BATCH_SIZE, max_wait_time=MAX_BATCH_WAIT,
+            collate_fn=BatchBuffer(MAX_BATCH_SIZE, size=IMAGE_SIZE)
+        )
+    return SCHEDULERS[name]
+
+
+def prediction_tags(logits: torch.Tensor):
+    """
+    A synchronous utility function used to get the prediction tags of a model output.
+
+    :param logits: The model output logits.
+    :return: A dictionary mapping classes to prediction tags.
+    """
+    if logits.shape[1] == len(BINARY_PREDICTION_TAGS):
+        return BINARY_PREDICTION_TAGS
+    return PREDICTION_TAGS
+
+
+def read_upload(file: UploadFile = File(...)):
+    """
+    A synchronous utility function used to read an uploaded file, up to the maximum upload size.
+    The size of the whole request body is checked before parsing it, the size of each file is checked here.
 
-    :param bbox: The image bounding box.
     :param file: The FastAPI file uploader object.
+    :return: The file contents and their SHA-256 digest.
+    """
+    contents = file.file.read(MAX_UPLOAD_SIZE + 1)
+    if len(contents) > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The uploaded file exceeds {} bytes".format(MAX_UPLOAD_SIZE)
+        )
+    return contents, hashlib.sha256(contents).hexdigest()
+
+
+def upload_file(bbox: tuple, contents: bytes):
+    """
+    A synchronous utility function used to decode an uploaded image file.
+    The image is decoded at a reduced scale if possible, and it is cropped before any other processing.
+
+    :param bbox: The image bounding box.
+    :param contents: The uploaded file contents.
     :return: A preprocessed PIL image.
     """
-    # Read the file contents
-    contents = file.file.read()
+    try:
+        # Open it as a PIL image, notice that only its header is read
+        with pil.open(io.BytesIO(contents)) as img:
+            # Reject the images exceeding the pixels budget, before decoding them
+            if img.width * img.height > MAX_IMAGE_PIXELS:
+                raise HTTPException(
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                    "The uploaded image exceeds {} pixels".format(MAX_IMAGE_PIXELS)
+                )
 
-    # Open it as a PIL image and preprocess it
-    with pil.open(io.BytesIO(contents)) as img:
-        # Preprocess the image using Crop + Resize (with bicubic interpolation)
-        img = img.convert(mode='L').crop(bbox).resize((224, 224), resample=pil.BICUBIC)
+            # Preprocess the image using Crop + Resize (with bicubic interpolation)
+            img = crop_resize(img, bbox, size=IMAGE_SIZE, draft=JPEG_DRAFT)
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, str(e))
+    except pil.DecompressionBombError:
+        raise HTTPException(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The uploaded image has too many pixels")
+    except OSError:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "The uploaded file is not a valid image")
 
     return img
 
 
+def load_image(bbox: tuple, contents: bytes):
+    """
+    A synchronous utility function used to decode and preprocess an uploaded image file.
+
+    :param bbox: The image bounding box.
+    :param contents: The uploaded file contents.
+    :return: The preprocessed image as a uint8 array, which is normalized when batched by the scheduler.
+    """
+    with PROFILER.record('decode'):
+        return np.asarray(upload_file(bbox, contents))
+
+
+async def read_raw_body(request: Request):
+    """
+    Read the body of a request, up to the maximum upload size.
+
+    :param request: The request.
+    :return: The body contents.
+    """
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The body exceeds {} bytes".format(MAX_UPLOAD_SIZE)
+            )
+    return body
+
+
+def load_raw_images(body: bytearray, shape: str = None, dtype: str = 'uint8'):
+    """
+    A synchronous utility function used to view a body of raw pixels as preprocessed images, without copying
+    or decoding them.
+
+    :param body: The body contents, i.e. the C-ordered pixels of the images.
+    :param shape: The shape of the body, i.e. 'H,W' for a single image or 'N,H,W' for a batch of images.
+                  If None, the body is a single image.
+    :param dtype: The data type of the pixels, only uint8 pixels are supported.
+    :return: The list of (H, W) uint8 arrays.
+    """
+    if dtype != 'uint8':
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Unsupported data type {}".format(dtype))
+    height, width = IMAGE_SIZE[1], IMAGE_SIZE[0]
+    try:
+        dims = [int(d) for d in shape.split(',')] if shape is not None else [height, width]
+    except ValueError:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Invalid shape {}".format(shape))
+    if len(dims) == 2:
+        dims = [1] + dims
+    if len(dims) != 3 or dims[1:] != [height, width]:
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY, "The shape must be {},{} or N,{},{}".format(height, width, height, width)
+        )
+    if not 1 <= dims[0] <= MAX_BATCH_FILES:
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY, "At most {} images can be predicted at once".format(MAX_BATCH_FILES)
+        )
+    if len(body) != dims[0] * height * width:
+        raise HTTPException(
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            "The body has {} bytes, but the shape {} requires {}".format(
+                len(body), ','.join(map(str, dims)), dims[0] * height * width
+            )
+        )
+
+    # Copy each slice, as the cached predictions would otherwise keep the whole body alive
+    return [image.copy() for image in np.frombuffer(body, dtype=np.uint8).reshape(dims)]
+
+
+def read_manifest(manifest: UploadFile):
+    """
+    A synchronous utility function used to read a manifest of images in the archive, i.e. a CSV file with the
+    columns path, xmin, ymin, xmax and ymax.
+
+    :param manifest: The FastAPI file uploader object.
+    :return: A generator of dictionaries of filename, path and bounding box of each image.
+    """
+    if not ARCHIVE_PATH:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Manifests are disabled, as no archive is configured")
+    archive = os.path.realpath(ARCHIVE_PATH)
+    reader = csv.DictReader(io.TextIOWrapper(manifest.file, encoding='utf-8'))
+    for i, row in enumerate(reader):
+        if i >= MAX_JOB_FILES:
+            raise HTTPException(
+                HTTPStatus.UNPROCESSABLE_ENTITY, "At most {} images can be submitted at once".format(MAX_JOB_FILES)
+            )
+        try:
+            bbox = tuple(int(row[k]) for k in ('xmin', 'ymin', 'xmax', 'ymax'))
+            path = os.path.realpath(os.path.join(archive, row['path']))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Invalid manifest row {}".format(i + 1))
+
+        # Only the images in the archive can be read
+        if not path.startswith(archive + os.sep) or not os.path.isfile(path):
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, "Image {} not found".format(row['path']))
+        yield {'filename': row['path'], 'path': path, 'bbox': bbox}
+
+
+def predict_job_items(name: str, items: list):
+    """
+    A synchronous utility function used by the job workers to predict a batch of job items in a single forward pass.
+
+    :param name: The model name.
+    :param items: The list of claimed items, i.e. dictionaries of path and bounding box.
+    :return: The list of results, i.e. dictionaries of prediction and class probabilities, or of error.
+    """
+    # Decode the images, the invalid ones fail without failing the whole batch
+    results, images = [None] * len(items), []
+    for i, item in enumerate(items):
+        try:
+            with open(item['path'], 'rb') as f:
+                contents = f.read(MAX_UPLOAD_SIZE + 1)
+            if len(contents) > MAX_UPLOAD_SIZE:
+                raise HTTPException(
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "The image exceeds {} bytes".format(MAX_UPLOAD_SIZE)
+                )
+            images.append((i, load_image(item['bbox'], contents)))
+        except HTTPException as e:
+            results[i] = {'error': e.detail}
+        except OSError:
+            results[i] = {'error': "The image cannot be read"}
+    if not images:
+        return results
+
+    # Predict the batch without the attention maps, which are not returned by the jobs
+    model = MODEL_WRAPPERS.get(name)
+    with torch.no_grad():
+        logits = model(JOB_BUFFER([img for (_, img) in images]).to(DEVICE)).cpu()
+    tags = prediction_tags(logits)
+    for (i, _), probabilities in zip(images, torch.softmax(logits, dim=1).tolist()):
+        prediction = int(np.argmax(probabilities))
+        results[i] = {
+            "prediction": tags[prediction],
+            "class": prediction,
+            "probabilities": {tags[j]: p for (j, p) in enumerate(probabilities)}
+        }
+    return results
+
+
 if __name__ == "__main__":
     # Run uvicorn when running this script
-    uvicorn.run("api:app", host="0.0.0.0", port=5000, reload=True, reload_dirs=["src", "models"])
+    # Updated model checkpoints are reloaded by the application itself, without restarting the server
+    uvicorn.run("api:app", host="0.0.0.0", port=5000, reload=True, reload_dirs=["src"])
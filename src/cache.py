@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache:
+    """Thread-safe key-value cache with least-recently-used eviction, bounded by the total size of its entries."""
+    def __init__(self, max_size=256, sizeof=None):
+        """
+        Instantiate a LRU cache.
+
+        :param max_size: The maximum total size of the entries.
+        :param sizeof: A function returning the size of a value, e.g. in bytes. If None, each entry has size one.
+        """
+        if max_size <= 0:
+            raise ValueError("The maximum size must be positive")
+        self.max_size = max_size
+        self.sizeof = sizeof if sizeof is not None else lambda _: 1
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._inflight = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Get an entry, marking it as the most recently used one.
+
+        :param key: The key.
+        :param default: The value to return if the key is not in the cache.
+        :return: The value associated to the key.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """
+        Insert or replace an entry, evicting the least recently used entries if needed.
+        Values larger than the maximum size are not inserted.
+
+        :param key: The key.
+        :param value: The value.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    async def get_or_compute(self, key, compute_fn):
+        """
+        Get an entry, or compute and insert it if missing. Concurrent requests of the same missing key
+        share a single in-flight computation.
+
+        :param key: The key.
+        :param compute_fn: An asynchronous function without arguments, computing the value.
+        :return: The value associated to the key.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._inflight[key] = Future()
+            else:
+                self.hits += 1
+
+        # Wait for the computation made by another request
+        if not owner:
+            return await asyncio.wrap_future(future)
+
+        # Compute the value and share it with the waiting requests
+        try:
+            value = await compute_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
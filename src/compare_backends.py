@@ -0,0 +1,64 @@
+import os
+import copy
+import json
+import yaml
+import torch
+import numpy as np
+from covidx.ct.dataset import load_datasets
+from covidx.ct.models import CTNet
+from covidx.ct.inference import BACKENDS, prepare_model, compare_models
+
+MODELS_PATH = 'models'
+MODEL_NAME = 'ct_net.pt'
+
+# Usage example:
+#   python src/compare_backends.py
+#
+if __name__ == '__main__':
+    # Load the experiment's parameters
+    with open("params.yaml", "r") as params_file:
+        params = yaml.safe_load(params_file)
+        params = params['backends']
+    data_path = params['data_path']
+    n_samples = int(params['n_samples'])
+    n_calibration = int(params['n_calibration'])
+    batch_size = int(params['batch_size'])
+    seed = int(params['seed'])
+
+    # Load the validation data set (used for calibration) and the held-out test data set
+    _, valid_data, test_data = load_datasets(data_path, num_classes=3, augment=False)
+
+    # Sample the calibration and the held-out examples
+    random_state = np.random.RandomState(seed)
+    calibration_indices = random_state.choice(len(valid_data), size=min(n_calibration, len(valid_data)), replace=False)
+    test_indices = random_state.choice(len(test_data), size=min(n_samples, len(test_data)), replace=False)
+    calibration_data = torch.stack([valid_data[i][0] for i in calibration_indices])
+    inputs = torch.stack([test_data[i][0] for i in test_indices])
+    targets = np.array([test_data[i][1] for i in test_indices])
+
+    # Instantiate the reference model and load from folder
+    model = CTNet(num_classes=3, pretrained=False)
+    state_filepath = os.path.join(MODELS_PATH, MODEL_NAME)
+    model.load_state_dict(torch.load(state_filepath, map_location='cpu')['model'])
+    model.eval()
+
+    # Compare each inference backend against the fp32 reference model
+    metrics = dict()
+    for backend in BACKENDS:
+        candidate = prepare_model(copy.deepcopy(model), backend=backend, calibration_data=calibration_data)
+        results = compare_models(model, candidate, inputs, batch_size=batch_size)
+        reference_preds = np.array(results.pop('reference_predictions'))
+        candidate_preds = np.array(results.pop('candidate_predictions'))
+        results['reference_accuracy'] = float(np.mean(reference_preds == targets))
+        results['candidate_accuracy'] = float(np.mean(candidate_preds == targets))
+        metrics[backend] = results
+        print('{:<14} agreement: {:.2f}%, accuracy: {:.2f}% (fp32 {:.2f}%), latency: {:.1f} ms (fp32 {:.1f} ms)'.format(
+            backend, results['agreement'] * 100, results['candidate_accuracy'] * 100,
+            results['reference_accuracy'] * 100, results['candidate_latency_ms'], results['reference_latency_ms']
+        ))
+
+    # Store the metrics in a JSON file
+    metrics_path = 'metrics'
+    os.makedirs(metrics_path, exist_ok=True)
+    with open(os.path.join(metrics_path, "ct_net-backends.json"), 'w') as file:
+        json.dump(metrics, file, indent=4)
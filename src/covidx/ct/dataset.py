@@ -5,6 +5,7 @@ import pandas as pd
 
 from PIL import Image as pil
 from PIL import ImageOps as pilops
+from .preprocessing import normalize
 
 
 class CTDataset(torch.utils.data.Dataset):
@@ -16,10 +17,11 @@ class CTDataset(torch.utils.data.Dataset):
         self.filenames = dataframe['filename'].to_numpy()
         self.targets = dataframe['class'].to_numpy()
 
-        # Initialize data transforms
-        transforms = [torchvision.transforms.ToTensor()]
+        # Initialize data augmentation transforms
+        # Notice that the images are already normalized to (-1, 1), hence the affine transformation fills with -1
+        self.transform = None
         if augment:
-            transforms.extend([
+            self.transform = torchvision.transforms.Compose([
                 torchvision.transforms.RandomHorizontalFlip(),
                 torchvision.transforms.RandomVerticalFlip(),
                 torchvision.transforms.GaussianBlur(7, sigma=(0.05, 2.0)),
@@ -28,11 +30,10 @@ class CTDataset(torch.utils.data.Dataset):
                     translate=(0.1, 0.1),
                     scale=(0.9, 1.1),
                     shear=20.0,
-                    interpolation=torchvision.transforms.InterpolationMode.BILINEAR  # use bilinear interpolation
+                    interpolation=torchvision.transforms.InterpolationMode.BILINEAR,  # use bilinear interpolation
+                    fill=-1.0
                 )
             ])
-        transforms.append(torchvision.transforms.Normalize((0.5,), (0.5,)))  # normalize to (-1, 1)
-        self.transform = torchvision.transforms.Compose(transforms)
 
     def __len__(self):
         return len(self.filenames)
@@ -42,11 +43,13 @@ class CTDataset(torch.utils.data.Dataset):
         filename = self.filenames[i]
         target = self.targets[i]
 
-        # Load and transform the image
+        # Load, normalize and transform the image
         with pil.open(os.path.join(self.path, filename)) as img:
             if self.equalize:
                 img = pilops.equalize(img)
-            data = self.transform(img)
+            data = normalize(img.convert(mode='L'))
+        if self.transform is not None:
+            data = self.transform(data)
         return data, target
 
     def get_targets(self):
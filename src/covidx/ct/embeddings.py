@@ -0,0 +1,197 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from .models import CTNet
+from ..utils.checkpoint import load_flat_checkpoint
+
+# The files of an embedding index directory
+EMBEDDINGS_FILENAME = 'embeddings.npy'
+CASES_FILENAME = 'cases.csv'
+METADATA_FILENAME = 'metadata.json'
+
+# The embeddings captured by the hooked classifiers, in the threads requesting them
+_CAPTURE = threading.local()
+_HOOK_LOCK = threading.Lock()
+
+
+def load_embedding_model(filepath):
+    """
+    Load a CTNet model returning the attention-pooled embeddings (i.e. without the linear classifier) from a
+    checkpoint, either a PyTorch one or a flat one.
+
+    :param filepath: The checkpoint filepath.
+    :return: The model, set to evaluation mode.
+    """
+    if os.path.splitext(filepath)[1] == '.weights':
+        state_dict = load_flat_checkpoint(filepath)
+    else:
+        state_dict = torch.load(filepath, map_location='cpu')['model']
+
+    # The parameters of the linear classifier are not needed
+    state_dict = {k: v for (k, v) in state_dict.items() if not k.startswith('fc.')}
+    model = CTNet(embeddings=True, pretrained=False)
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def find_classifier(model):
+    """
+    Find the linear classifier of a model, e.g. of a CTNet model prepared for inference.
+
+    :param model: The model.
+    :return: The classifier module, or None if the model has none (e.g. an ONNX Runtime session).
+    """
+    if not isinstance(model, torch.nn.Module):
+        return None
+    for name, module in model.named_modules():
+        if name == 'fc' or name.endswith('.fc'):
+            return module
+    return None
+
+
+def forward_embeddings(model, inputs):
+    """
+    Compute the embeddings of a batch by a model with a linear classifier, i.e. the inputs of its classifier, so
+    that a served model gives the embeddings without loading another copy of it. The classifier is hooked once,
+    and the embeddings are captured only in the calling thread, so that the model can be shared with other threads.
+
+    :param model: The model, e.g. a CTNet model prepared for inference.
+    :param inputs: The batch of input tensors.
+    :return: The (N, D) single-precision embeddings and the outputs of the model.
+    """
+    classifier = find_classifier(model)
+    if classifier is None:
+        raise ValueError("The model has no linear classifier whose inputs are the embeddings")
+    with _HOOK_LOCK:
+        if not getattr(classifier, 'embeddings_hooked', False):
+            classifier.register_forward_pre_hook(_capture_embeddings)
+            classifier.embeddings_hooked = True
+
+    _CAPTURE.embeddings = captured = []
+    try:
+        outputs = model(inputs)
+    finally:
+        _CAPTURE.embeddings = None
+    embeddings = captured[-1]
+    if embeddings.is_quantized:
+        embeddings = embeddings.dequantize()
+    return embeddings.float(), outputs
+
+
+def _capture_embeddings(module, inputs):  # pylint: disable=unused-argument
+    captured = getattr(_CAPTURE, 'embeddings', None)
+    if captured is not None:
+        captured.append(inputs[0])
+
+
+def normalize_embeddings(embeddings):
+    """
+    Normalize embeddings to unit length, so that their dot products are cosine similarities.
+
+    :param embeddings: A (N, D) array of embeddings.
+    :return: The (N, D) array of normalized single-precision embeddings.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def build_embedding_index(model, dataset, cases, path, model_name, batch_size=64, device='cpu'):
+    """
+    Compute the embeddings of a data set in batches, and store them in an embedding index directory, i.e. a
+    memory-mappable half-precision matrix of normalized embeddings, a CSV of the cases and a JSON of metadata.
+    The files are written atomically, as they may be memory-mapped by a running service.
+
+    :param model: The model returning the embeddings, e.g. loaded by load_embedding_model.
+    :param dataset: The data set of (image, target) pairs.
+    :param cases: The data frame describing the cases of the data set (e.g. filename and class), in the same order.
+    :param path: The embedding index directory.
+    :param model_name: The name of the model, so that the queries are embedded by the same model.
+    :param batch_size: The batch size.
+    :param device: The device to use.
+    :return: The number of embedded cases.
+    """
+    if len(cases) != len(dataset):
+        raise ValueError("The number of cases must match the size of the data set")
+    os.makedirs(path, exist_ok=True)
+    filepath = os.path.join(path, EMBEDDINGS_FILENAME)
+    tmp_filepath = filepath + '.tmp'
+
+    # Write the normalized embeddings batch by batch, so that the whole matrix is never in memory
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    matrix = np.lib.format.open_memmap(
+        tmp_filepath, mode='w+', dtype=np.float16, shape=(len(dataset), model.out_features)
+    )
+    offset = 0
+    with torch.no_grad():
+        for inputs, _ in tqdm(loader):
+            embeddings = normalize_embeddings(model(inputs.to(device)).cpu().numpy())
+            matrix[offset:offset + len(embeddings)] = embeddings
+            offset += len(embeddings)
+    matrix.flush()
+    del matrix
+    os.replace(tmp_filepath, filepath)
+
+    # Write the cases and the metadata
+    cases.to_csv(os.path.join(path, CASES_FILENAME + '.tmp'), index=False)
+    os.replace(os.path.join(path, CASES_FILENAME + '.tmp'), os.path.join(path, CASES_FILENAME))
+    with open(os.path.join(path, METADATA_FILENAME + '.tmp'), 'w') as f:
+        json.dump({'model': model_name, 'size': offset, 'dim': model.out_features}, f)
+    os.replace(os.path.join(path, METADATA_FILENAME + '.tmp'), os.path.join(path, METADATA_FILENAME))
+    return offset
+
+
+class EmbeddingIndex:
+    """Index of the embeddings of reference cases, searched by cosine similarity over a memory-mapped matrix."""
+    def __init__(self, path, chunk_size=4096):
+        """
+        Load an embedding index directory. The embeddings matrix is memory-mapped, so that it is read lazily and
+        it is shared by the processes loading the same index.
+
+        :param path: The embedding index directory.
+        :param chunk_size: The number of embeddings converted to single precision at once, when searching.
+        """
+        with open(os.path.join(path, METADATA_FILENAME), 'r') as f:
+            metadata = json.load(f)
+        self.path = path
+        self.model = metadata['model']
+        self.chunk_size = chunk_size
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILENAME), mmap_mode='r')
+        self.cases = pd.read_csv(os.path.join(path, CASES_FILENAME)).to_dict('records')
+        if len(self.embeddings) == 0:
+            raise ValueError("The embedding index {} is empty".format(path))
+        if len(self.cases) != len(self.embeddings):
+            raise ValueError("The number of cases does not match the number of embeddings in {}".format(path))
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search(self, queries, k=5):
+        """
+        Find the reference cases most similar to some query embeddings.
+
+        :param queries: A (Q, D) array of query embeddings, not necessarily normalized.
+        :param k: The number of similar cases of each query.
+        :return: The (Q, k) array of indices of the similar cases and the (Q, k) array of their cosine similarities,
+                 sorted by decreasing similarity.
+        """
+        queries = normalize_embeddings(queries)
+        k = min(k, len(self))
+
+        # Compute the similarities by a matrix product for each chunk of the embeddings, converted to single
+        # precision as half-precision products are not vectorized on CPU
+        similarities = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), self.chunk_size):
+            chunk = np.asarray(self.embeddings[start:start + self.chunk_size], dtype=np.float32)
+            similarities[:, start:start + len(chunk)] = np.dot(queries, chunk.T)
+
+        # Select the top-k similarities in linear time, then sort only them
+        indices = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(similarities, indices, axis=1)
+        order = np.argsort(-top, axis=1, kind='stable')
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top, order, axis=1)
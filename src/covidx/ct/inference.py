@@ -0,0 +1,225 @@
+import os
+import time
+import warnings
+import numpy as np
+import torch
+
+from .layers import LinearAttention2d
+
+# The available CPU inference backends
+BACKENDS = ('fp32', 'channels_last', 'bf16', 'dynamic', 'static')
+
+# The names of the inputs and outputs of the exported ONNX graphs
+ONNX_INPUT_NAMES = ['image']
+ONNX_OUTPUT_NAMES = ['logits', 'att1', 'att2']
+
+
+class AttentionOutputs(torch.nn.Module):
+    """Wrap a CTNet model, so that its forward always returns both the predictions and the attention maps."""
+    def __init__(self, model):
+        super(AttentionOutputs, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, attention=True)
+
+
+class InferenceModel(torch.nn.Module):
+    """Inference adapter of a model returning the predictions and the attention maps, with the CTNet interface."""
+    def __init__(self, model, memory_format=None, autocast_dtype=None):
+        """
+        Instantiate an inference model.
+
+        :param model: The model, mapping an input tensor to the predictions and the attention maps.
+        :param memory_format: The memory format of the input tensors. If None, inputs are not converted.
+        :param autocast_dtype: The data type of CPU autocasting. If None, autocasting is disabled.
+        """
+        super(InferenceModel, self).__init__()
+        self.model = model
+        self.memory_format = memory_format
+        self.autocast_dtype = autocast_dtype
+
+    def forward(self, x, attention=False):
+        if self.memory_format is not None:
+            x = x.contiguous(memory_format=self.memory_format)
+        if self.autocast_dtype is not None:
+            with torch.autocast('cpu', dtype=self.autocast_dtype):
+                outputs = self.model(x)
+        else:
+            outputs = self.model(x)
+
+        # Always return single-precision contiguous outputs
+        outputs = tuple(o.float().contiguous() for o in outputs)
+        if attention:
+            return outputs
+        return outputs[0]
+
+
+def is_bf16_supported():
+    """
+    Check if the CPU natively supports bfloat16 operations.
+
+    :return: True if bfloat16 is supported, False otherwise.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())  # pylint: disable=protected-access
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def prepare_model(model, backend='fp32', calibration_data=None):
+    """
+    Prepare a CTNet model for CPU inference. The model may be modified in place.
+
+    :param model: The CTNet model.
+    :param backend: The inference backend. It can be either 'fp32' (no optimization), 'channels_last' (channels last
+                    memory format), 'bf16' (bfloat16 autocasting), 'dynamic' (dynamic INT8 quantization of the linear
+                    layers) or 'static' (static INT8 quantization of the convolutional and linear layers).
+    :param calibration_data: A batch of input tensors used to calibrate the static quantization.
+    :return: The inference model, with the same interface of CTNet.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown inference backend {}".format(backend))
+    model.eval()
+
+    if backend == 'channels_last':
+        model = model.to(memory_format=torch.channels_last)
+        return InferenceModel(AttentionOutputs(model), memory_format=torch.channels_last)
+
+    if backend == 'bf16':
+        if not is_bf16_supported():
+            warnings.warn("The CPU does not support bfloat16 natively, falling back to fp32")
+            return InferenceModel(AttentionOutputs(model))
+        return InferenceModel(AttentionOutputs(model), autocast_dtype=torch.bfloat16)
+
+    if backend in ('dynamic', 'static'):
+        if any(p.device.type != 'cpu' for p in model.parameters()):
+            raise ValueError("Quantized models are supported on CPU only")
+
+    if backend == 'dynamic':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return InferenceModel(AttentionOutputs(model))
+
+    if backend == 'static':
+        if calibration_data is None:
+            raise ValueError("The static quantization requires calibration data")
+        # pylint: disable=import-outside-toplevel
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        # The attention layers are kept in floating point, as their softmax normalization is not traceable
+        custom_config = PrepareCustomConfig().set_non_traceable_module_classes([LinearAttention2d])
+        prepared = prepare_fx(
+            AttentionOutputs(model), get_default_qconfig_mapping('x86'),
+            example_inputs=(calibration_data[:1],), prepare_custom_config=custom_config
+        )
+
+        # Calibrate the activations quantization parameters
+        with torch.no_grad():
+            for inputs in torch.split(calibration_data, 8):
+                prepared(inputs)
+        return InferenceModel(convert_fx(prepared))
+
+    return InferenceModel(AttentionOutputs(model))
+
+
+def compare_models(reference, candidate, inputs, batch_size=8):
+    """
+    Compare the outputs and the latency of a candidate model against a reference model.
+
+    :param reference: The reference model, e.g. the fp32 CTNet.
+    :param candidate: The candidate model, e.g. a quantized CTNet.
+    :param inputs: The input tensors.
+    :param batch_size: The batch size.
+    :return: A dictionary containing the predictions agreement, the maximum absolute difference of the class
+             probabilities and the predictions and the mean latency (in milliseconds) of both models.
+    """
+    outputs = {'reference': [], 'candidate': []}
+    latency = {'reference': 0.0, 'candidate': 0.0}
+    with torch.no_grad():
+        for x in torch.split(inputs, batch_size):
+            for key, model in [('reference', reference), ('candidate', candidate)]:
+                start_time = time.perf_counter()
+                outputs[key].append(torch.softmax(model(x).float(), dim=1))
+                latency[key] += time.perf_counter() - start_time
+    reference_probs = torch.cat(outputs['reference'])
+    candidate_probs = torch.cat(outputs['candidate'])
+    reference_preds = torch.argmax(reference_probs, dim=1)
+    candidate_preds = torch.argmax(candidate_probs, dim=1)
+    return {
+        'agreement': torch.eq(reference_preds, candidate_preds).float().mean().item(),
+        'max_abs_diff': torch.max(torch.abs(reference_probs - candidate_probs)).item(),
+        'reference_latency_ms': 1000.0 * latency['reference'] / len(inputs),
+        'candidate_latency_ms': 1000.0 * latency['candidate'] / len(inputs),
+        'reference_predictions': reference_preds.tolist(),
+        'candidate_predictions': candidate_preds.tolist()
+    }
+
+
+class OnnxModel:
+    """ONNX Runtime CPU inference session of an exported CTNet model, with the CTNet interface."""
+    def __init__(self, filepath, num_threads=0):
+        """
+        Load an exported CTNet model.
+
+        :param filepath: The ONNX graph filepath.
+        :param num_threads: The number of threads used by each forward pass. If zero, it is chosen by ONNX Runtime.
+        """
+        import onnxruntime  # pylint: disable=import-outside-toplevel
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            filepath, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.nbytes = os.path.getsize(filepath)
+
+    def __call__(self, x, attention=False):
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(x, dtype=np.float32)})
+        outputs = tuple(torch.from_numpy(o) for o in outputs)
+        if attention:
+            return outputs
+        return outputs[0]
+
+
+def export_onnx(model, filepath, opset_version=13, verify=True, rtol=1e-3, atol=1e-5):
+    """
+    Export a CTNet model to an ONNX graph returning both the predictions and the attention maps,
+    with a dynamic batch size.
+
+    :param model: The CTNet model.
+    :param filepath: The ONNX graph filepath.
+    :param opset_version: The ONNX opset version.
+    :param verify: Whether to check the ONNX Runtime outputs are numerically equivalent to the PyTorch ones.
+    :param rtol: The relative tolerance of the equivalence check.
+    :param atol: The absolute tolerance of the equivalence check.
+    :return: The maximum absolute difference of each output, if verify is True.
+    """
+    model.eval()
+    wrapper = AttentionOutputs(model)
+    example_inputs = torch.rand(2, 1, 224, 224, device=next(model.parameters()).device)
+    dynamic_axes = {name: {0: 'batch_size'} for name in ONNX_INPUT_NAMES + ONNX_OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper, (example_inputs,), filepath, opset_version=opset_version,
+            input_names=ONNX_INPUT_NAMES, output_names=ONNX_OUTPUT_NAMES, dynamic_axes=dynamic_axes
+        )
+    if not verify:
+        return None
+
+    # Check the equivalence on a batch size different from the one used for exporting
+    inputs = torch.rand(3, 1, 224, 224)
+    with torch.no_grad():
+        expected = tuple(o.cpu() for o in wrapper(inputs.to(example_inputs.device)))
+    actual = OnnxModel(filepath)(inputs, attention=True)
+    differences = dict()
+    for name, e, a in zip(ONNX_OUTPUT_NAMES, expected, actual):
+        differences[name] = torch.max(torch.abs(e - a)).item()
+        if e.shape != a.shape or not torch.allclose(e, a, rtol=rtol, atol=atol):
+            raise ValueError("The ONNX output {} differs from the PyTorch one by {}".format(name, differences[name]))
+    return differences
@@ -1,8 +1,6 @@
 import torch
 import torchvision
 
-from torch.hub import load_state_dict_from_url
-from torchvision.models.resnet import model_urls
 from .layers import LinearAttention2d
 
 
@@ -17,8 +15,7 @@ class CTNet(torchvision.models.ResNet):
 
         # Check if use pretrained ResNet50 model (on ImageNet)
         if pretrained:
-            state_dict = load_state_dict_from_url(model_urls['resnet50'], progress=True)
-            self.load_state_dict(state_dict)
+            self.load_state_dict(load_pretrained_state_dict())
 
         # Introduce other bottleneck blocks
         self.layer5 = self._make_layer(
@@ -85,3 +82,20 @@ class CTNet(torchvision.models.ResNet):
 
     def forward(self, x, attention=False):
         return self._forward_impl(x, attention=attention)
+
+
+def load_pretrained_state_dict():
+    """
+    Load the state dictionary of the ResNet50 model pretrained on ImageNet.
+    The imports are deferred, as they are needed only when a pretrained model is instantiated.
+
+    :return: The state dictionary.
+    """
+    # pylint: disable=import-outside-toplevel
+    from torch.hub import load_state_dict_from_url
+    try:
+        from torchvision.models.resnet import model_urls
+        url = model_urls['resnet50']
+    except ImportError:  # Newer versions of torchvision expose the weights URLs by enums
+        url = torchvision.models.ResNet50_Weights.IMAGENET1K_V1.url
+    return load_state_dict_from_url(url, progress=True)
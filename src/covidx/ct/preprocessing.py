@@ -0,0 +1,87 @@
+import math
+import numpy as np
+import torch
+
+from PIL import Image as pil
+
+# The size of the preprocessed images
+IMAGE_SIZE = (224, 224)
+
+# The lookup table mapping the uint8 pixels to their normalized values in (-1, 1), computed by the same operations
+# of torchvision's to_tensor followed by normalize((0.5,), (0.5,)), so that the results are identical
+NORMALIZE_TABLE = ((torch.arange(256, dtype=torch.float32) / 255.0 - 0.5) / 0.5).numpy()
+
+
+def crop_resize(img, bbox=None, size=IMAGE_SIZE, draft=False):
+    """
+    Preprocess a CT image, by cropping it to the bounding box, converting it to grayscale and resizing it
+    (with bicubic interpolation). The crop comes first, so that the conversion only processes the bounding box.
+
+    :param img: The PIL image. If draft is True, it must not be decoded yet.
+    :param bbox: The bounding box (xmin, ymin, xmax, ymax). If None, the image is not cropped.
+    :param size: The size of the preprocessed image.
+    :param draft: Whether to decode JPEG images at a reduced scale (i.e. 1/2, 1/4 or 1/8), as long as the bounding
+                  box stays larger than the preprocessed image. It is faster, but not exactly equivalent.
+    :return: The preprocessed PIL image.
+    """
+    if bbox is None:
+        bbox = (0, 0, img.width, img.height)
+    xmin, ymin, xmax, ymax = bbox
+    if xmax <= xmin or ymax <= ymin:
+        raise ValueError("Invalid bounding box {}".format(bbox))
+
+    scale = 1.0
+    if draft and img.format == 'JPEG':
+        width = img.width
+        img.draft('L', (
+            math.ceil(img.width * size[0] / (xmax - xmin)),
+            math.ceil(img.height * size[1] / (ymax - ymin))
+        ))
+        scale = img.width / width
+
+    # Crop the integer box containing the (possibly rescaled) bounding box, and resize its sub-pixel remainder
+    box = [c * scale for c in bbox]
+    outer_box = (math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+    inner_box = (box[0] - outer_box[0], box[1] - outer_box[1], box[2] - outer_box[0], box[3] - outer_box[1])
+    return img.crop(outer_box).convert(mode='L').resize(size, resample=pil.BICUBIC, box=inner_box)
+
+
+def normalize(img, out=None):
+    """
+    Convert a grayscale uint8 image to a normalized float tensor in (-1, 1), in a single vectorized step.
+
+    :param img: The image, as a (H, W) uint8 array or a grayscale PIL image.
+    :param out: An optional preallocated (1, H, W) float tensor, where to write the normalized image.
+    :return: The normalized (1, H, W) float tensor.
+    """
+    img = np.asarray(img, dtype=np.uint8)
+    if out is None:
+        out = torch.empty((1,) + img.shape, dtype=torch.float32)
+    np.take(NORMALIZE_TABLE, img, out=out.numpy()[0], mode='clip')
+    return out
+
+
+class BatchBuffer:
+    """Preallocated reusable buffer of normalized input batches, collating grayscale uint8 images."""
+    def __init__(self, max_batch_size, size=IMAGE_SIZE):
+        """
+        Instantiate a batch buffer.
+
+        :param max_batch_size: The maximum batch size.
+        :param size: The size of the images.
+        """
+        self.buffer = torch.empty(max_batch_size, 1, size[1], size[0], dtype=torch.float32)
+
+    def __call__(self, images):
+        """
+        Normalize a list of images into the buffer. The batch is overwritten by the next call.
+
+        :param images: The list of (H, W) uint8 arrays.
+        :return: The (N, 1, H, W) normalized batch, i.e. a view of the buffer.
+        """
+        if len(images) > len(self.buffer):
+            raise ValueError("The batch size exceeds the buffer size {}".format(len(self.buffer)))
+        batch = self.buffer[:len(images)]
+        for img, out in zip(images, batch):
+            normalize(img, out=out)
+        return batch
@@ -0,0 +1,158 @@
+import os
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# The alignment (in bytes) of the tensors data in the flat checkpoints
+ALIGNMENT = 64
+
+# The data types supported by the flat checkpoints
+DTYPES = {
+    'float64': torch.float64,
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int64': torch.int64,
+    'int32': torch.int32,
+    'int16': torch.int16,
+    'int8': torch.int8,
+    'uint8': torch.uint8,
+    'bool': torch.bool
+}
+
+
+def sidecar_filepath(filepath):
+    """
+    Get the filepath of the metadata sidecar of a flat checkpoint.
+
+    :param filepath: The flat checkpoint filepath.
+    :return: The sidecar filepath.
+    """
+    return os.path.splitext(filepath)[0] + '.json'
+
+
+def save_flat_checkpoint(state_dict, filepath, metadata=None):
+    """
+    Save a state dictionary as a flat checkpoint, i.e. a little-endian 8-bytes header size, a JSON header
+    describing the tensors and the aligned raw tensors data, so that it can be memory-mapped.
+    The file is written atomically, as it may be memory-mapped by running processes.
+
+    :param state_dict: The state dictionary.
+    :param filepath: The flat checkpoint filepath.
+    :param metadata: A JSON-serializable dictionary (e.g. the training history) to save in the sidecar file.
+    """
+    dtype_names = {v: k for k, v in DTYPES.items()}
+    header, tensors, offset = dict(), [], 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in dtype_names:
+            raise ValueError("Unsupported data type {} of tensor {}".format(tensor.dtype, name))
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.element_size() * tensor.nelement()
+        header[name] = {'dtype': dtype_names[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset}
+        tensors.append((offset, tensor))
+        offset += nbytes + (-nbytes) % ALIGNMENT
+
+    # Pad the header, so that the tensors data is aligned
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * ((-(8 + len(header))) % ALIGNMENT)
+    data_offset = 8 + len(header)
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for tensor_offset, tensor in tensors:
+            f.seek(data_offset + tensor_offset)
+            f.write(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.nelement() > 0 else b'')
+        f.truncate(data_offset + offset)
+    os.replace(tmp_filepath, filepath)
+
+    if metadata is not None:
+        with open(sidecar_filepath(filepath), 'w') as f:
+            json.dump(metadata, f)
+
+
+def load_flat_checkpoint(filepath):
+    """
+    Load a flat checkpoint, by memory-mapping it. The tensors share the memory of the mapped file, copy-on-write,
+    so their data is read lazily and it is shared by the processes loading the same checkpoint.
+
+    :param filepath: The flat checkpoint filepath.
+    :return: The state dictionary.
+    """
+    with open(filepath, 'rb') as f:
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_offset = 8 + header_size
+
+    buffer = torch.from_numpy(np.memmap(filepath, dtype=np.uint8, mode='c'))
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        dtype, shape = DTYPES[info['dtype']], info['shape']
+        nbytes = int(np.prod(shape, dtype=np.int64)) * torch.tensor([], dtype=dtype).element_size()
+        start = data_offset + info['offset']
+        state_dict[name] = buffer[start:start + nbytes].view(dtype).view(shape)
+    return state_dict
+
+
+def load_checkpoint_metadata(filepath):
+    """
+    Load the metadata of a flat checkpoint, from its sidecar file.
+
+    :param filepath: The flat checkpoint filepath.
+    :return: The metadata dictionary, or None if there is no sidecar file.
+    """
+    filepath = sidecar_filepath(filepath)
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Replace the parameters and the buffers of a model with the tensors of a state dictionary, without copying them.
+
+    :param model: The model.
+    :param state_dict: The state dictionary. It must contain all and only the model's parameters and buffers.
+    """
+    expected_keys = set(model.state_dict().keys())
+    if set(state_dict.keys()) != expected_keys:
+        missing = sorted(expected_keys - set(state_dict.keys()))
+        unexpected = sorted(set(state_dict.keys()) - expected_keys)
+        raise KeyError("Missing keys {}, unexpected keys {}".format(missing, unexpected))
+
+    for name, tensor in state_dict.items():
+        module_name, _, attr = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        # pylint: disable=protected-access
+        if attr in module._parameters:
+            param = module._parameters[attr]
+            if param.shape != tensor.shape:
+                raise ValueError("Size mismatch of {}: {} and {}".format(name, param.shape, tensor.shape))
+            module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=param.requires_grad)
+        else:
+            module._buffers[attr] = tensor
+
+
+def load_flat_model(model_fn, filepath):
+    """
+    Instantiate a model whose parameters and buffers are the memory-mapped tensors of a flat checkpoint.
+    If supported, the model is instantiated on the meta device, so that its parameters are neither
+    allocated nor initialized before being replaced.
+
+    :param model_fn: A function mapping the state dictionary to a new model, e.g. to infer the number of classes.
+    :param filepath: The flat checkpoint filepath.
+    :return: The model.
+    """
+    state_dict = load_flat_checkpoint(filepath)
+    if hasattr(torch.device, '__enter__'):
+        with torch.device('meta'):
+            model = model_fn(state_dict)
+    else:
+        model = model_fn(state_dict)
+    assign_state_dict(model, state_dict)
+    return model
@@ -0,0 +1,137 @@
+import sys
+import ctypes
+import ctypes.util
+import threading
+
+import torch
+
+# The highest peak RSS (in bytes) read so far, as the peak RSS of the kernel can be reset
+_PEAK_RSS = 0
+_PEAK_LOCK = threading.Lock()
+
+
+class _MallInfo2(ctypes.Structure):
+    # The glibc mallinfo2 structure, see man 3 mallinfo
+    _fields_ = [(name, ctypes.c_size_t) for name in (
+        'arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost'
+    )]
+
+
+def _load_mallinfo2():
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        mallinfo2 = ctypes.CDLL(libc_name).mallinfo2
+    except (OSError, AttributeError):
+        return None
+    mallinfo2.restype = _MallInfo2
+    return mallinfo2
+
+
+_MALLINFO2 = _load_mallinfo2()
+
+
+def _read_status():
+    # Read the current and peak resident set sizes of the process, in bytes
+    rss, hwm = None, None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if hwm is None:
+        import resource  # pylint: disable=import-outside-toplevel
+        # The maximum RSS is in kilobytes on Linux, and in bytes on macOS
+        hwm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return rss if rss is not None else hwm, hwm
+
+
+def _update_peak(hwm):
+    global _PEAK_RSS
+    with _PEAK_LOCK:
+        _PEAK_RSS = max(_PEAK_RSS, hwm)
+        return _PEAK_RSS
+
+
+def process_memory():
+    """
+    Get the resident set size (RSS) of the process.
+
+    :return: A dictionary of the current and the peak RSS, in bytes.
+    """
+    rss, hwm = _read_status()
+    return {'rss': rss, 'peak_rss': _update_peak(hwm)}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process (supported on Linux only), e.g. to measure the peak of a request or an epoch.
+    The highest peak is still reported by process_memory.
+
+    :return: The peak RSS in bytes since the previous reset.
+    """
+    _, hwm = _read_status()
+    _update_peak(hwm)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return hwm
+
+
+def module_memory(model):
+    """
+    Get the memory occupied by the parameters and the buffers of a model.
+
+    :param model: The module, or a model exposing its size by the nbytes attribute (e.g. an ONNX Runtime session),
+                  whose size is then reported as parameters.
+    :return: A dictionary of the parameters and buffers sizes, in bytes.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return {'parameters': getattr(model, 'nbytes', 0), 'buffers': 0}
+    return {
+        'parameters': sum(p.element_size() * p.nelement() for p in model.parameters()),
+        'buffers': sum(b.element_size() * b.nelement() for b in model.buffers())
+    }
+
+
+def allocator_memory():
+    """
+    Get the statistics of the memory allocators. PyTorch allocates the CPU tensors through the C allocator, whose
+    statistics are read by glibc's mallinfo2 (if available). The CUDA caching allocator statistics are included
+    if CUDA is available.
+
+    :return: A dictionary mapping the (allocator, statistic) pairs to bytes, e.g. ('malloc', 'allocated').
+    """
+    stats = dict()
+    if _MALLINFO2 is not None:
+        info = _MALLINFO2()
+        stats[('malloc', 'allocated')] = info.uordblks + info.hblkhd
+        stats[('malloc', 'free')] = info.fordblks
+        stats[('malloc', 'mapped')] = info.hblkhd
+    if torch.cuda.is_available():
+        stats[('cuda', 'allocated')] = torch.cuda.memory_allocated()
+        stats[('cuda', 'reserved')] = torch.cuda.memory_reserved()
+        stats[('cuda', 'peak_allocated')] = torch.cuda.max_memory_allocated()
+    return stats
+
+
+def memory_readout(model=None):
+    """
+    Get a flat summary of the memory usage of the process, e.g. to record it in a training history.
+
+    :param model: An optional model, whose parameters and buffers sizes are included.
+    :return: A dictionary of sizes in bytes.
+    """
+    readout = process_memory()
+    if model is not None:
+        readout.update(module_memory(model))
+    for (allocator, stat), value in allocator_memory().items():
+        readout['{}_{}'.format(allocator, stat)] = value
+    return readout
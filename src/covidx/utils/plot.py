@@ -1,11 +1,20 @@
-import matplotlib.pyplot as plt
+import functools
 import numpy as np
 import torch
-import cv2
-import torchvision.utils
+
+# Notice that matplotlib, cv2 and torchvision are imported by the functions using them,
+# as they are slow to import and they are not needed before the first plot
+
+# The image encodings supported by encode_image
+IMAGE_ENCODINGS = {
+    'png': ('.png', 'image/png'),
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp')
+}
 
 
 def save_history(history, filepath):
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
     fig, axs = plt.subplots(2, tight_layout=True)
     axs[0].set_title('loss')
     axs[0].plot(history['train']['loss'], label='train')
@@ -19,6 +28,9 @@ def save_history(history, filepath):
 
 
 def save_binary_attention_map(filepath_or_stream, img, att1, att2):
+    import cv2  # pylint: disable=import-outside-toplevel
+    import torchvision.utils  # pylint: disable=import-outside-toplevel
+
     # Move on CPU
     img = img.cpu()
     att1 = att1.cpu()
@@ -57,7 +69,115 @@ def save_binary_attention_map(filepath_or_stream, img, att1, att2):
     torchvision.utils.save_image(img_grid, filepath_or_stream, padding=4, nrow=2, pad_value=0, format='png')
 
 
+@functools.lru_cache(maxsize=8)
+def _interpolation_matrix(in_size, out_size):
+    # Build the (out_size, in_size) matrix of bilinear interpolation weights with aligned corners,
+    # i.e. the same upsampling of torch.nn.functional.interpolate(..., mode='bilinear', align_corners=True)
+    pos = np.linspace(0.0, in_size - 1.0, out_size)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, in_size - 1)
+    weights = (pos - lo).astype(np.float32)
+    matrix = np.zeros((out_size, in_size), dtype=np.float32)
+    rows = np.arange(out_size)
+    matrix[rows, lo] += 1.0 - weights
+    matrix[rows, hi] += weights
+    return matrix
+
+
+def _upsample(att, height, width):
+    # Upsample a 2D attention map by bilinear interpolation, as two small matrix products
+    rows = _interpolation_matrix(att.shape[0], height)
+    cols = _interpolation_matrix(att.shape[1], width)
+    return rows @ att @ cols.T
+
+
+def binary_attention_map(img, att1, att2, padding=4):
+    """
+    Render the image and the image blended with the binarized attention maps side by side,
+    working directly on uint8 buffers.
+
+    :param img: The image, as a (H, W) uint8 array.
+    :param att1: The first attention map, as a (1, 1, H / 16, W / 16) tensor or array.
+    :param att2: The second attention map, as a (1, 1, H / 32, W / 32) tensor or array.
+    :param padding: The padding between the images.
+    :return: The images grid, as a (H + 2 * padding, 2 * W + 3 * padding, 3) uint8 array in BGR order.
+    """
+    import cv2  # pylint: disable=import-outside-toplevel
+    height, width = img.shape
+    if isinstance(att1, torch.Tensor):
+        att1 = att1.detach().cpu().numpy()
+    if isinstance(att2, torch.Tensor):
+        att2 = att2.detach().cpu().numpy()
+
+    # Upsample and combine the attention maps
+    att = _upsample(np.asarray(att1, dtype=np.float32).reshape(att1.shape[-2:]), height, width)
+    att *= _upsample(np.asarray(att2, dtype=np.float32).reshape(att2.shape[-2:]), height, width)
+    np.sqrt(att, out=att)
+
+    # Rescale the attention map in [0, 255]
+    att_min, att_max = att.min(), att.max()
+    att -= att_min
+    if att_max > att_min:
+        att *= 255.0 / (att_max - att_min)
+    att = att.astype(np.uint8)
+
+    # Apply OTZU Method
+    _, att = cv2.threshold(att, 0, 255, type=cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Write the image and the image blended with the red heatmap in the grid
+    grid = np.zeros((height + 2 * padding, 2 * width + 3 * padding, 3), dtype=np.uint8)
+    left = grid[padding:padding + height, padding:padding + width]
+    right = grid[padding:padding + height, 2 * padding + width:2 * padding + 2 * width]
+    left[...] = img[:, :, np.newaxis]
+    right[:, :, 0] = right[:, :, 1] = cv2.addWeighted(img, 0.7, att, 0.0, 0.0)
+    right[:, :, 2] = cv2.addWeighted(img, 0.7, att, 0.3, 0.0)
+    return grid
+
+
+def encode_image(img, encoding='png', compression=1, quality=90):
+    """
+    Encode an image.
+
+    :param img: The image, as a uint8 array in BGR order.
+    :param encoding: The image encoding, it can be either 'png', 'jpeg' or 'webp'.
+    :param compression: The PNG compression level, from 0 (fastest) to 9 (smallest).
+    :param quality: The JPEG or WebP quality, from 0 to 100.
+    :return: The encoded image bytes.
+    """
+    if encoding not in IMAGE_ENCODINGS:
+        raise ValueError("Unknown image encoding {}".format(encoding))
+    import cv2  # pylint: disable=import-outside-toplevel
+    if encoding == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    elif encoding == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    else:
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    ok, buffer = cv2.imencode(IMAGE_ENCODINGS[encoding][0], np.ascontiguousarray(img), params)
+    if not ok:
+        raise RuntimeError("Failed to encode the image as {}".format(encoding))
+    return buffer.tobytes()
+
+
+def render_binary_attention_map(img, att1, att2, encoding='png', **kwargs):
+    """
+    Render and encode the image and the image blended with the binarized attention maps side by side.
+    This is a faster equivalent of save_binary_attention_map.
+
+    :param img: The image, as a (H, W) uint8 array.
+    :param att1: The first attention map.
+    :param att2: The second attention map.
+    :param encoding: The image encoding, it can be either 'png', 'jpeg' or 'webp'.
+    :param kwargs: Additional parameters of encode_image.
+    :return: The encoded image bytes.
+    """
+    return encode_image(binary_attention_map(img, att1, att2), encoding=encoding, **kwargs)
+
+
 def save_attention_map(filepath, img, att1, att2):
+    import cv2  # pylint: disable=import-outside-toplevel
+    import torchvision.utils  # pylint: disable=import-outside-toplevel
+
     # Move on CPU
     img = img.cpu()
     att1 = att1.cpu()
@@ -6,6 +6,7 @@ import numpy as np
 
 from tqdm import tqdm
 from .torch import EarlyStopping, RunningAverageMetric, get_optimizer
+from .memory import memory_readout, reset_peak_rss
 
 
 def train_classifier(
@@ -77,12 +78,18 @@ def train_classifier(
 
     history = {
         'train': {'loss': [], 'accuracy': []},
-        'validation': {'loss': [], 'accuracy': []}
+        'validation': {'loss': [], 'accuracy': []},
+        'memory': dict()
     }
 
     for epoch in range(epochs):
         start_time = time.time()
 
+        # Reset the peak memory usage, so that it is measured per epoch
+        reset_peak_rss()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+
         # Initialize the tqdm train data loader, if verbose is enabled
         if verbose:
             tk_train = tqdm(
@@ -160,6 +167,14 @@ def train_classifier(
         history['validation']['loss'].append(val_loss)
         history['validation']['accuracy'].append(val_accuracy)
 
+        # Append the memory usage (in bytes) to history data, with the peak RSS of the epoch, and print it
+        memory = memory_readout(model)
+        memory['peak_rss'] = reset_peak_rss()
+        for key, value in memory.items():
+            history['memory'].setdefault(key, []).append(value)
+        if verbose:
+            print('Memory - ' + ', '.join('%s: %.1fMiB' % (k, v / 2 ** 20) for (k, v) in memory.items()))
+
         # Check if training should stop according to early stopping
         early_stopping(val_loss)
         if early_stopping.should_stop:
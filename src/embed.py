@@ -0,0 +1,54 @@
+import os
+import argparse
+import pandas as pd
+import torch
+from covidx.ct.dataset import CTDataset, load_datasets_labels
+from covidx.ct.embeddings import load_embedding_model, build_embedding_index
+
+SPLITS = ('train', 'valid', 'test')
+
+# Usage examples:
+#   python src/embed.py models/ct_net.pt
+#   python src/embed.py --splits train valid --dest embeddings models/ct_net.weights
+#
+if __name__ == '__main__':
+    # Instantiate the command line arguments parser
+    parser = argparse.ArgumentParser(description='CTNet Reference Cases Embedder.')
+    parser.add_argument('src', type=str, help='The checkpoint of the CTNet model.')
+    parser.add_argument('--data-path', type=str, default=os.path.join('data', 'ct'), help='The data set directory.')
+    parser.add_argument(
+        '--splits', type=str, nargs='+', choices=SPLITS, default=['train'],
+        help='The splits of the data set used as reference cases.'
+    )
+    parser.add_argument('--dest', type=str, default='embeddings', help='The embedding index directory.')
+    parser.add_argument('--batch-size', type=int, default=64, help='The batch size.')
+    args = parser.parse_args()
+
+    # Get the device to use
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('Embedding using device: ' + str(device))
+
+    # Load the model returning the embeddings, named as the model served by the api
+    model = load_embedding_model(args.src)
+    model.to(device)
+    model_name = os.path.splitext(os.path.basename(args.src))[0]
+
+    # Concatenate the reference splits, describing each case by its image path (relative to the data set
+    # directory) and its class
+    labels = dict(zip(SPLITS, load_datasets_labels(args.data_path, num_classes=3)))
+    datasets, cases = [], []
+    for split in args.splits:
+        df = labels[split]
+        datasets.append(CTDataset(os.path.join(args.data_path, split), df))
+        cases.append(pd.DataFrame({
+            'filename': [os.path.join(split, filename) for filename in df['filename']],
+            'class': df['class'].to_numpy(),
+        }))
+    dataset = torch.utils.data.ConcatDataset(datasets)
+    cases = pd.concat(cases, ignore_index=True)
+
+    # Compute and store the embeddings
+    size = build_embedding_index(
+        model, dataset, cases, args.dest, model_name, batch_size=args.batch_size, device=device
+    )
+    print("Embedded {} cases of {} into {}".format(size, ', '.join(args.splits), args.dest))
@@ -0,0 +1,318 @@
+import queue
+import asyncio
+import threading
+import time
+import functools
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+
+class EngineOverloadedError(RuntimeError):
+    """Raised when the inference engine cannot admit more work."""
+
+
+class BoundedExecutor:
+    """Thread pool executor for blocking work, which rejects requests beyond a maximum concurrency."""
+    def __init__(self, max_workers=2, max_pending=16):
+        """
+        Instantiate a bounded executor.
+
+        :param max_workers: The number of worker threads.
+        :param max_pending: The maximum number of requests admitted at the same time.
+        """
+        if max_workers <= 0:
+            raise ValueError("The number of workers must be positive")
+        if max_pending <= 0:
+            raise ValueError("The maximum number of pending requests must be positive")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='blocking-worker')
+
+    @contextlib.contextmanager
+    def admit(self):
+        """
+        Admit a request for the duration of the context, or raise an error if the executor is saturated.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise EngineOverloadedError("Too many pending requests, retry later")
+            self.pending += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run a blocking function on the executor threads, without blocking the event loop.
+
+        :param fn: The function to run.
+        :return: The result of the function.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+
+class BatchScheduler:
+    """Dynamic micro-batching scheduler, grouping concurrent inference requests into batched forward passes."""
+    def __init__(self, forward_fn, max_batch_size=8, max_wait_time=0.005, collate_fn=None):
+        """
+        Instantiate a batch scheduler.
+
+        :param forward_fn: A function mapping a batch of inputs to a tuple of batched outputs.
+        :param max_batch_size: The maximum number of requests to run in a single forward pass.
+        :param max_wait_time: The maximum time (in seconds) to wait for a batch to fill up.
+        :param collate_fn: A function mapping the list of submitted inputs to a batch. If None, the inputs
+                           are tensors concatenated along their batch dimension.
+        """
+        if max_batch_size <= 0:
+            raise ValueError("The maximum batch size must be positive")
+        if max_wait_time < 0.0:
+            raise ValueError("The maximum wait time must be non-negative")
+        self.forward_fn = forward_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.collate_fn = collate_fn if collate_fn is not None else torch.cat
+
+        # The statistics of the scheduler, updated by the worker thread only
+        self.in_flight = 0
+        self.batch_sizes = [0] * (max_batch_size + 1)
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def queue_depth(self):
+        """
+        The number of requests waiting to be collected into a batch.
+        """
+        return self._queue.qsize()
+
+    def start(self):
+        """
+        Start the scheduler worker thread, if not already running.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler worker thread, after the already submitted requests are served.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    def submit_nowait(self, inputs, timer=None):
+        """
+        Submit a single input example to the scheduler.
+
+        :param inputs: The input example, e.g. a tensor having a batch dimension of size one.
+        :param timer: An optional stage timer, where to add the time spent in queue and in the forward pass.
+        :return: A future which resolves to the tuple of outputs, each one having a batch dimension of size one.
+        """
+        self.start()
+        future = Future()
+        self._queue.put((inputs, future, timer, time.perf_counter()))
+        return future
+
+    async def submit(self, inputs, timer=None):
+        """
+        Submit a single input example to the scheduler and wait for its outputs.
+
+        :param inputs: The input example, e.g. a tensor having a batch dimension of size one.
+        :param timer: An optional stage timer, where to add the time spent in queue and in the forward pass.
+        :return: The tuple of outputs, each one having a batch dimension of size one.
+        """
+        return await asyncio.wrap_future(self.submit_nowait(inputs, timer=timer))
+
+    def _collect(self, item):
+        # Collect pending requests until the batch is full or the wait time expires
+        batch, stop = [item], False
+        deadline = time.monotonic() + self.max_wait_time
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0.0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch, stop = self._collect(item)
+
+            # Discard the requests that have been cancelled in the meanwhile
+            batch = [(x, f, t, s) for (x, f, t, s) in batch if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            # Run a single forward pass and send each caller its own slice of the outputs
+            start_time = time.perf_counter()
+            self.in_flight += 1
+            try:
+                inputs = self.collate_fn([x for (x, _, _, _) in batch])
+                collate_time = time.perf_counter()
+                outputs = self.forward_fn(inputs)
+            except Exception as e:  # pylint: disable=broad-except
+                for _, future, _, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.in_flight -= 1
+            end_time = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            self.wait_time += sum(start_time - s for (_, _, _, s) in batch)
+            self.compute_time += end_time - start_time
+            for i, (_, future, timer, submit_time) in enumerate(batch):
+                if timer is not None:
+                    timer.add('queue', start_time - submit_time)
+                    timer.add('collate', collate_time - start_time)
+                    timer.add('forward', end_time - collate_time)
+                future.set_result(tuple(o[i:i + 1] for o in outputs))
+
+
+class LoadShedder:
+    """Adaptive controller of the service level, degrading the responses when the recent latency exceeds a budget."""
+    NORMAL, DEGRADED, SHEDDING = 0, 1, 2
+
+    def __init__(self, latency_budget=2.0, wait_budget=0.5, shed_factor=2.0, recovery_factor=0.5, smoothing=0.1,
+                 min_duration=5.0, half_life=5.0):
+        """
+        Instantiate a load shedder.
+
+        :param latency_budget: The budget (in seconds) of the moving average of the predictions latency.
+                               If not positive, the latency is not tracked.
+        :param wait_budget: The budget (in seconds) of the moving average of the time spent in the inference queue.
+                            If not positive, the queue wait is not tracked.
+        :param shed_factor: The pressure, i.e. the largest ratio between a moving average and its budget, beyond
+                            which the lowest priority requests are rejected. The responses are degraded beyond 1.
+        :param recovery_factor: The fraction of the threshold of the current level below which the pressure must
+                                drop to restore the previous level, so that the level does not flap.
+        :param smoothing: The weight of each new observation in the moving averages.
+        :param min_duration: The minimum time (in seconds) spent in a level before restoring the previous one.
+        :param half_life: The time (in seconds) in which the moving averages halve, while no prediction is observed.
+                          If not positive, the moving averages change only by the observations.
+        """
+        if shed_factor < 1.0:
+            raise ValueError("The shed factor must be at least 1")
+        if not 0.0 < recovery_factor <= 1.0:
+            raise ValueError("The recovery factor must be in (0, 1]")
+        if not 0.0 < smoothing <= 1.0:
+            raise ValueError("The smoothing must be in (0, 1]")
+        self.latency_budget = latency_budget
+        self.wait_budget = wait_budget
+        self.shed_factor = shed_factor
+        self.recovery_factor = recovery_factor
+        self.smoothing = smoothing
+        self.min_duration = min_duration
+        self.half_life = half_life
+        self.latency = 0.0
+        self.wait = 0.0
+        self.pressure = 0.0
+        self.level = LoadShedder.NORMAL
+        self.degraded = 0
+        self.shed = 0
+        self._changed = float('-inf')
+        self._observed = float('-inf')
+        self._decayed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, latency, wait=0.0):
+        """
+        Observe a served prediction, and update the service level.
+
+        :param latency: The latency (in seconds) of the prediction.
+        :param wait: The time (in seconds) spent in the inference queue.
+        :return: The service level.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._decay(now)
+            self.latency += self.smoothing * (latency - self.latency)
+            self.wait += self.smoothing * (wait - self.wait)
+            self._observed = now
+            return self._update(now)
+
+    def degrade(self):
+        """
+        Check whether a response must be degraded, i.e. served without its optional parts.
+
+        :return: Whether the response must be degraded.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._decay(now)
+            if self._update(now) < LoadShedder.DEGRADED:
+                return False
+            self.degraded += 1
+            return True
+
+    def admit_low_priority(self):
+        """
+        Admit a low priority request, or raise an error if the lowest priority requests are being rejected.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._decay(now)
+            if self._update(now) >= LoadShedder.SHEDDING:
+                self.shed += 1
+                raise EngineOverloadedError("The service is overloaded, low priority requests are rejected")
+
+    def _decay(self, now):
+        # Decay the moving averages by the time elapsed since the last update, so that the level is restored also
+        # when no prediction is computed, e.g. after an idle period or if only low priority requests are received
+        if self.half_life > 0.0:
+            factor = 0.5 ** ((now - self._decayed) / self.half_life)
+            self.latency *= factor
+            self.wait *= factor
+        self._decayed = now
+
+    def _update(self, now):
+        self.pressure = max(
+            self.latency / self.latency_budget if self.latency_budget > 0.0 else 0.0,
+            self.wait / self.wait_budget if self.wait_budget > 0.0 else 0.0
+        )
+        if self.pressure >= self.shed_factor:
+            target = LoadShedder.SHEDDING
+        elif self.pressure >= 1.0:
+            target = LoadShedder.DEGRADED
+        else:
+            target = LoadShedder.NORMAL
+
+        # Raise the level immediately, but restore the previous one only once the pressure is well below
+        # the threshold of the current level, and the current level has lasted long enough
+        # Without observations since the last change, a restored level is deemed to start as early as possible,
+        # so that more levels are restored at once after an idle period
+        if target > self.level:
+            self.level, self._changed = target, now
+        while target < self.level and now - self._changed >= self.min_duration:
+            threshold = self.shed_factor if self.level == LoadShedder.SHEDDING else 1.0
+            if self.pressure >= threshold * self.recovery_factor:
+                break
+            self.level, self._changed = self.level - 1, max(self._observed, self._changed + self.min_duration)
+            if self._changed <= self._observed:
+                break
+        return self.level
@@ -0,0 +1,47 @@
+import os
+import argparse
+import torch
+from covidx.ct.models import CTNet
+from covidx.ct.inference import export_onnx
+from covidx.utils.checkpoint import save_flat_checkpoint
+
+# Usage examples:
+#   python src/export.py --format onnx models/ct_net.pt
+#   python src/export.py --format weights models/ct_net.pt
+#
+if __name__ == '__main__':
+    # Instantiate the command line arguments parser
+    parser = argparse.ArgumentParser(description='CTNet Model Exporter.')
+    parser.add_argument('src', type=str, help='The source checkpoint of the CTNet model.')
+    parser.add_argument(
+        '--dest', type=str, default=None,
+        help='The destination filepath of the exported model. By default, it is the source one with a new extension.'
+    )
+    parser.add_argument(
+        '--format', type=str, choices=['onnx', 'weights'], default='onnx',
+        help='The format of the exported model, either an ONNX graph or a flat memory-mappable checkpoint.'
+    )
+    parser.add_argument('--opset', type=int, default=13, help='The ONNX opset version.')
+    args = parser.parse_args()
+    dest = args.dest if args.dest is not None else os.path.splitext(args.src)[0] + '.' + args.format
+
+    # Load the checkpoint, map_location makes it work also on CPU
+    checkpoint = torch.load(args.src, map_location='cpu')
+    model_params = checkpoint['model']
+
+    if args.format == 'weights':
+        # Save the weights in a flat memory-mappable checkpoint, and the other data (e.g. the history) in its sidecar
+        metadata = {k: v for k, v in checkpoint.items() if k != 'model'}
+        save_flat_checkpoint(model_params, dest, metadata=metadata)
+        print("Exported {} to {}".format(args.src, dest))
+    else:
+        # Instantiate the model, the number of classes is given by the checkpoint
+        model = CTNet(num_classes=model_params['fc.weight'].shape[0], pretrained=False)
+        model.load_state_dict(model_params)
+        model.eval()
+
+        # Export the model and check the exported outputs match the PyTorch ones
+        differences = export_onnx(model, dest, opset_version=args.opset)
+        print("Exported {} to {}".format(args.src, dest))
+        for name, diff in differences.items():
+            print("Max absolute difference of {}: {:.2e}".format(name, diff))
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+import traceback
+import contextlib
+
+# The statuses of the items of a job
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    filename TEXT,
+    path TEXT NOT NULL,
+    bbox TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker INTEGER,
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, job_id, idx);
+"""
+
+
+class JobStore:
+    """Persistent queue of prediction jobs and of their results, stored in a SQLite database and a directory."""
+    def __init__(self, path):
+        """
+        Instantiate a job store, creating it if needed.
+
+        :param path: The directory of the database and of the uploaded images.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db_path = os.path.join(path, 'jobs.db')
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')  # Let the api read while the workers write
+            conn.executescript(_SCHEMA)
+
+    def create(self, model, items):
+        """
+        Create a job, storing the uploaded images on disk.
+
+        :param model: The name of the model to use.
+        :param items: An iterable of dictionaries of filename, bounding box and either the uploaded file contents
+                      (contents) or the path of an image already on disk (path).
+        :return: The job identifier.
+        """
+        job_id = uuid.uuid4().hex
+        job_path = os.path.join(self.path, job_id)
+        os.makedirs(job_path)
+        rows = []
+        try:
+            for i, item in enumerate(items):
+                path = item.get('path')
+                if path is None:
+                    path = os.path.join(job_path, str(i))
+                    with open(path, 'wb') as f:
+                        f.write(item['contents'])
+                rows.append((job_id, i, item.get('filename'), path, json.dumps(list(item['bbox'])), PENDING))
+            if not rows:
+                raise ValueError("A job must have at least one image")
+            with self._connect() as conn, self._transaction(conn):
+                conn.execute('INSERT INTO jobs (id, model, created) VALUES (?, ?, ?)', (job_id, model, time.time()))
+                conn.executemany(
+                    'INSERT INTO items (job_id, idx, filename, path, bbox, status) VALUES (?, ?, ?, ?, ?, ?)', rows
+                )
+        except BaseException:
+            shutil.rmtree(job_path, ignore_errors=True)
+            raise
+        return job_id
+
+    def get(self, job_id):
+        """
+        Get the status of a job.
+
+        :param job_id: The job identifier.
+        :return: A dictionary of model, creation time, status and number of items by status, or None if the job
+                 does not exist.
+        """
+        with self._connect() as conn:
+            job = conn.execute('SELECT model, created FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(conn.execute(
+                'SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status', (job_id,)
+            ).fetchall())
+        counts = {status: counts.get(status, 0) for status in (PENDING, RUNNING, DONE, FAILED)}
+        if counts[PENDING] + counts[RUNNING] == 0:
+            status = 'done'
+        elif counts[RUNNING] + counts[DONE] + counts[FAILED] == 0:
+            status = 'queued'
+        else:
+            status = 'running'
+        return dict(id=job_id, model=job[0], created=job[1], status=status, items=sum(counts.values()), **counts)
+
+    def results(self, job_id, after=-1):
+        """
+        Get the results of the finished items of a job.
+
+        :param job_id: The job identifier.
+        :param after: Only the items whose index is greater than this one are returned, e.g. to resume polling.
+        :return: The list of dictionaries of index, filename, status and result (i.e. the prediction, or the error),
+                 sorted by index.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT idx, filename, status, result FROM items WHERE job_id = ? AND idx > ? AND status IN (?, ?)'
+                ' ORDER BY idx', (job_id, after, DONE, FAILED)
+            ).fetchall()
+        return [dict(index=idx, filename=filename, status=status, **json.loads(result))
+                for (idx, filename, status, result) in rows]
+
+    def delete(self, job_id):
+        """
+        Delete a job, its pending items and its results.
+
+        :param job_id: The job identifier.
+        :return: Whether the job existed.
+        """
+        with self._connect() as conn, self._transaction(conn):
+            conn.execute('DELETE FROM items WHERE job_id = ?', (job_id,))
+            deleted = conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,)).rowcount > 0
+        shutil.rmtree(os.path.join(self.path, job_id), ignore_errors=True)
+        return deleted
+
+    def claim(self, worker, batch_size):
+        """
+        Claim the oldest pending items, all of them of jobs using the same model.
+
+        :param worker: The identifier of the claiming worker, e.g. its process identifier.
+        :param batch_size: The maximum number of items.
+        :return: The model name and the list of dictionaries of job identifier, index, path and bounding box of the
+                 claimed items, or (None, []) if there are no pending items.
+        """
+        with self._connect() as conn, self._transaction(conn):
+            first = conn.execute(
+                'SELECT jobs.model FROM items JOIN jobs ON jobs.id = items.job_id WHERE items.status = ?'
+                ' ORDER BY jobs.created, items.idx LIMIT 1', (PENDING,)
+            ).fetchone()
+            if first is None:
+                return None, []
+            rows = conn.execute(
+                'SELECT items.job_id, items.idx, items.path, items.bbox FROM items JOIN jobs ON jobs.id = items.job_id'
+                ' WHERE items.status = ? AND jobs.model = ? ORDER BY jobs.created, items.idx LIMIT ?',
+                (PENDING, first[0], batch_size)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE items SET status = ?, worker = ? WHERE job_id = ? AND idx = ?',
+                [(RUNNING, worker, job_id, idx) for (job_id, idx, _, _) in rows]
+            )
+        return first[0], [dict(job_id=job_id, index=idx, path=path, bbox=tuple(json.loads(bbox)))
+                          for (job_id, idx, path, bbox) in rows]
+
+    def finish(self, items, results):
+        """
+        Store the results of claimed items. The results of items of deleted jobs are discarded.
+
+        :param items: The list of claimed items.
+        :param results: The list of results, i.e. JSON-serializable dictionaries. The items whose result has an
+                        error key are marked as failed.
+        """
+        with self._connect() as conn, self._transaction(conn):
+            conn.executemany(
+                'UPDATE items SET status = ?, result = ? WHERE job_id = ? AND idx = ? AND status = ?',
+                [(FAILED if 'error' in result else DONE, json.dumps(result), item['job_id'], item['index'], RUNNING)
+                 for (item, result) in zip(items, results)]
+            )
+
+    def recover(self, worker=None):
+        """
+        Requeue the items claimed by a worker which stopped before finishing them.
+
+        :param worker: The identifier of the worker. If None, the items claimed by any worker are requeued,
+                       e.g. when no worker is running yet.
+        :return: The number of requeued items.
+        """
+        with self._connect() as conn, self._transaction(conn):
+            if worker is None:
+                cursor = conn.execute('UPDATE items SET status = ?, worker = NULL WHERE status = ?', (PENDING, RUNNING))
+            else:
+                cursor = conn.execute(
+                    'UPDATE items SET status = ?, worker = NULL WHERE status = ? AND worker = ?',
+                    (PENDING, RUNNING, worker)
+                )
+            return cursor.rowcount
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection for each operation, so that the store can be shared among threads and processes
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(conn):
+        # Take the write lock immediately, so that concurrent workers never claim the same items
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+class JobWorker:
+    """Worker predicting the pending items of a job store in batches, in a background thread or in the caller."""
+    def __init__(self, store, predict_fn, batch_size=16, poll_interval=1.0, worker=None, throttle_fn=None,
+                 throttle_interval=0.05):
+        """
+        Instantiate a job worker.
+
+        :param store: The job store.
+        :param predict_fn: A function mapping a model name and a list of claimed items to their results.
+        :param batch_size: The maximum number of items predicted at once.
+        :param poll_interval: The time (in seconds) between two checks of the queue, when it is empty.
+        :param worker: The identifier of the worker. If None, the identifier of the running process is used,
+                       so that the items claimed by a dead worker process can be requeued.
+        :param throttle_fn: An optional function telling whether the worker must yield to other work (e.g. to the
+                            interactive requests served by the same process), checked before claiming each batch.
+        :param throttle_interval: The time (in seconds) between two checks of the throttle function, while yielding.
+        """
+        if batch_size <= 0:
+            raise ValueError("The batch size must be positive")
+        self.store = store
+        self.predict_fn = predict_fn
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.worker = worker
+        self.throttle_fn = throttle_fn
+        self.throttle_interval = throttle_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """
+        Claim and predict a batch of pending items.
+
+        :return: The number of processed items.
+        """
+        worker = self.worker if self.worker is not None else os.getpid()
+        model, items = self.store.claim(worker, self.batch_size)
+        if not items:
+            return 0
+        try:
+            results = self.predict_fn(model, items)
+        except Exception as e:  # pylint: disable=broad-except
+            # Fail the whole batch, e.g. if the model checkpoint was removed
+            traceback.print_exc()
+            results = [{'error': str(e)} for _ in items]
+        self.store.finish(items, results)
+        return len(items)
+
+    def run(self):
+        """
+        Process the pending items until stopped, yielding to other work if a throttle function is given.
+        """
+        while not self._stop.is_set():
+            if self.throttle_fn is not None and self.throttle_fn():
+                self._stop.wait(self.throttle_interval)
+            elif self.run_once() == 0:
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        """
+        Start processing the pending items in a background thread, if not already running.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='job-worker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop processing the pending items, after the current batch.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
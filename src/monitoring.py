@@ -1,7 +1,13 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 from typing import Callable
 import prometheus_fastapi_instrumentator as pinst
 from prometheus_fastapi_instrumentator.metrics import Info
-from prometheus_client import Histogram
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from covidx.utils.memory import process_memory, reset_peak_rss, module_memory, allocator_memory
 
 
 # A dictionary mapping names to Prometheus FastAPI metrics
@@ -74,3 +80,327 @@ def model_output(
 
 
 METRICS['model_output'] = model_output
+
+
+class StageTimer:
+    """Timer of the stages of a request, reported by the Server-Timing response header."""
+    def __init__(self):
+        self.durations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        """
+        Add the duration of a stage, accumulating it if the stage has been already timed.
+
+        :param stage: The stage name.
+        :param seconds: The duration in seconds.
+        """
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Time a stage, as a context manager.
+
+        :param stage: The stage name.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def server_timing(self):
+        """
+        Format the durations of the stages as a Server-Timing header value.
+
+        :return: The header value, e.g. 'decode;dur=12.345, forward;dur=81.024' (in milliseconds).
+        """
+        with self._lock:
+            return ', '.join('{};dur={:.3f}'.format(k, 1000.0 * v) for (k, v) in self.durations.items())
+
+
+def parse_server_timing(header):
+    """
+    Parse a Server-Timing header value.
+
+    :param header: The header value.
+    :return: A dictionary mapping the stage names to their durations in seconds.
+    """
+    durations = dict()
+    for metric in header.split(','):
+        name, *params = [p.strip() for p in metric.split(';')]
+        for param in params:
+            key, _, value = param.partition('=')
+            if name and key == 'dur':
+                try:
+                    durations[name] = float(value) / 1000.0
+                except ValueError:
+                    pass
+    return durations
+
+
+def stage_latency(
+    metric_name: str = "stage_latency_seconds",
+    metric_doc: str = "Latency of the stages of the requests",
+    metric_namespace: str = "",
+    metric_subsystem: str = "",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0), **kwargs
+) -> Callable[[Info], None]:
+    metric = Histogram(
+        metric_name,
+        metric_doc,
+        labelnames=('handler', 'stage'),
+        buckets=buckets,
+        namespace=metric_namespace,
+        subsystem=metric_subsystem,
+    )
+
+    def instrumentation(info: Info) -> None:
+        if info.response and hasattr(info.response, "headers"):
+            header = info.response.headers.get("Server-Timing")
+            if header is not None:
+                for stage, seconds in parse_server_timing(header).items():
+                    metric.labels(info.modified_handler, stage).observe(seconds)
+
+    return instrumentation
+
+
+METRICS['stage_latency'] = stage_latency
+
+
+def request_peak_memory(
+    metric_name: str = "request_peak_rss_bytes",
+    metric_doc: str = "Peak resident set size of the process while serving the requests",
+    metric_namespace: str = "",
+    metric_subsystem: str = "",
+    buckets=tuple(2 ** i * 1024 * 1024 for i in range(7, 14)), **kwargs
+) -> Callable[[Info], None]:
+    metric = Histogram(
+        metric_name,
+        metric_doc,
+        labelnames=('handler',),
+        buckets=buckets,
+        namespace=metric_namespace,
+        subsystem=metric_subsystem,
+    )
+
+    def instrumentation(info: Info) -> None:
+        # The peak is reset at the end of each request, so that it covers the time since the previous one ended,
+        # hence it is shared by the overlapping requests
+        metric.labels(info.modified_handler).observe(reset_peak_rss())
+
+    return instrumentation
+
+
+METRICS['request_peak_memory'] = request_peak_memory
+
+
+# A dictionary mapping names to the registered cache collectors
+CACHE_COLLECTORS = dict()
+
+
+class CacheCollector:
+    """Prometheus collector of the hit, miss and eviction counters of a cache."""
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def collect(self):
+        yield CounterMetricFamily('{}_hits'.format(self.name), 'Number of cache hits', value=self.cache.hits)
+        yield CounterMetricFamily('{}_misses'.format(self.name), 'Number of cache misses', value=self.cache.misses)
+        yield CounterMetricFamily(
+            '{}_evictions'.format(self.name), 'Number of cache evictions', value=self.cache.evictions
+        )
+        yield GaugeMetricFamily('{}_size'.format(self.name), 'Total size of the cache entries', value=self.cache.size)
+        yield GaugeMetricFamily('{}_entries'.format(self.name), 'Number of cache entries', value=len(self.cache))
+
+
+def register_cache_metrics(cache, name, registry=REGISTRY):
+    """
+    Expose the metrics of a cache to Prometheus.
+
+    :param cache: The cache.
+    :param name: The metrics name prefix.
+    :param registry: The Prometheus registry.
+    """
+    # Register the collector only once, as the application startup may happen more than once
+    if name in CACHE_COLLECTORS:
+        CACHE_COLLECTORS[name].cache = cache
+        return
+    CACHE_COLLECTORS[name] = CacheCollector(cache, name)
+    registry.register(CACHE_COLLECTORS[name])
+
+
+# A dictionary mapping names to the registered engine collectors
+ENGINE_COLLECTORS = dict()
+
+
+class EngineCollector:
+    """Prometheus collector of the saturation metrics of the inference engine, i.e. its schedulers and models."""
+    def __init__(self, schedulers, models, executor, name, shedder=None):
+        self.schedulers = schedulers
+        self.models = models
+        self.executor = executor
+        self.name = name
+        self.shedder = shedder
+
+    def collect(self):
+        schedulers = list(self.schedulers.items())
+        queue_depth = GaugeMetricFamily(
+            '{}_queue_depth'.format(self.name), 'Number of requests waiting for a batch', labels=['model']
+        )
+        in_flight = GaugeMetricFamily(
+            '{}_in_flight'.format(self.name), 'Number of running forward passes', labels=['model']
+        )
+        batch_size = HistogramMetricFamily(
+            '{}_batch_size'.format(self.name), 'Size of the batched forward passes', labels=['model']
+        )
+        wait_time = CounterMetricFamily(
+            '{}_wait_seconds'.format(self.name), 'Time spent by the requests waiting for a batch', labels=['model']
+        )
+        compute_time = CounterMetricFamily(
+            '{}_compute_seconds'.format(self.name), 'Time spent computing the batched forward passes', labels=['model']
+        )
+        for model, scheduler in schedulers:
+            queue_depth.add_metric([model], scheduler.queue_depth)
+            in_flight.add_metric([model], scheduler.in_flight)
+            counts = list(scheduler.batch_sizes)
+            buckets, total = [], 0
+            for size, count in enumerate(counts[1:], start=1):
+                total += count
+                buckets.append((str(float(size)), total))
+            buckets.append(('+Inf', total))
+            batch_size.add_metric([model], buckets, sum(size * count for size, count in enumerate(counts)))
+            wait_time.add_metric([model], scheduler.wait_time)
+            compute_time.add_metric([model], scheduler.compute_time)
+        yield queue_depth
+        yield in_flight
+        yield batch_size
+        yield wait_time
+        yield compute_time
+
+        # The admission control of the blocking work, i.e. its saturation
+        yield GaugeMetricFamily(
+            '{}_pending_requests'.format(self.name), 'Number of admitted requests', value=self.executor.pending
+        )
+        yield GaugeMetricFamily(
+            '{}_max_pending_requests'.format(self.name), 'Maximum number of admitted requests',
+            value=self.executor.max_pending
+        )
+
+        # The loaded models and their lifecycle events
+        yield GaugeMetricFamily(
+            '{}_loaded_models'.format(self.name), 'Number of loaded models', value=len(self.models.loaded())
+        )
+        yield GaugeMetricFamily(
+            '{}_models_memory_bytes'.format(self.name), 'Memory occupied by the loaded models', value=self.models.memory
+        )
+        events = CounterMetricFamily(
+            '{}_model_events'.format(self.name), 'Number of model load, reload and eviction events',
+            labels=['model', 'event']
+        )
+        for (model, event), count in sorted(self.models.events().items()):
+            events.add_metric([model, event], count)
+        yield events
+
+        # The service level of the load shedding, i.e. 0 (normal), 1 (degraded) or 2 (shedding)
+        if self.shedder is not None:
+            yield GaugeMetricFamily(
+                '{}_service_level'.format(self.name), 'Degradation level of the load shedding',
+                value=self.shedder.level
+            )
+            yield GaugeMetricFamily(
+                '{}_load_pressure'.format(self.name), 'Largest ratio between the moving average latency or queue'
+                ' wait and its budget', value=self.shedder.pressure
+            )
+            yield CounterMetricFamily(
+                '{}_degraded_responses'.format(self.name), 'Number of responses served without their optional parts',
+                value=self.shedder.degraded
+            )
+            yield CounterMetricFamily(
+                '{}_shed_requests'.format(self.name), 'Number of low priority requests rejected by the load shedding',
+                value=self.shedder.shed
+            )
+
+
+def register_engine_metrics(schedulers, models, executor, shedder=None, name='engine', registry=REGISTRY):
+    """
+    Expose the saturation metrics of the inference engine to Prometheus.
+
+    :param schedulers: The dictionary mapping the model names to their batch schedulers. As the schedulers are
+                       created lazily, the dictionary is read at each collection.
+    :param models: The model registry.
+    :param executor: The bounded executor of the blocking work.
+    :param shedder: The optional load shedder.
+    :param name: The metrics name prefix.
+    :param registry: The Prometheus registry.
+    """
+    # Register the collector only once, as the application startup may happen more than once
+    if name in ENGINE_COLLECTORS:
+        collector = ENGINE_COLLECTORS[name]
+        collector.schedulers, collector.models, collector.executor = schedulers, models, executor
+        collector.shedder = shedder
+        return
+    ENGINE_COLLECTORS[name] = EngineCollector(schedulers, models, executor, name, shedder=shedder)
+    registry.register(ENGINE_COLLECTORS[name])
+
+
+# A dictionary mapping names to the registered memory collectors
+MEMORY_COLLECTORS = dict()
+
+
+class MemoryCollector:
+    """Prometheus collector of the memory usage of the process, broken down by models, caches and allocators."""
+    def __init__(self, models, caches, name):
+        self.models = models
+        self.caches = caches
+        self.name = name
+
+    def collect(self):
+        memory = process_memory()
+        yield GaugeMetricFamily('{}_rss_bytes'.format(self.name), 'Resident set size', value=memory['rss'])
+        yield GaugeMetricFamily(
+            '{}_peak_rss_bytes'.format(self.name), 'Peak resident set size', value=memory['peak_rss']
+        )
+
+        # The parameters and buffers of the loaded models, and the contents of the caches
+        models = GaugeMetricFamily(
+            '{}_model_bytes'.format(self.name), 'Memory occupied by the loaded models', labels=['model', 'kind']
+        )
+        for model_name, model in self.models.items():
+            for kind, size in module_memory(model).items():
+                models.add_metric([model_name, kind], size)
+        yield models
+        caches = GaugeMetricFamily(
+            '{}_cache_bytes'.format(self.name), 'Memory occupied by the cache entries', labels=['cache']
+        )
+        for cache_name, cache in self.caches.items():
+            caches.add_metric([cache_name], cache.size)
+        yield caches
+
+        # The statistics of the C allocator (used by PyTorch for CPU tensors) and of the CUDA allocator
+        allocators = GaugeMetricFamily(
+            '{}_allocator_bytes'.format(self.name), 'Memory allocator statistics', labels=['allocator', 'stat']
+        )
+        for (allocator, stat), size in allocator_memory().items():
+            allocators.add_metric([allocator, stat], size)
+        yield allocators
+
+
+def register_memory_metrics(models, caches, name='memory', registry=REGISTRY):
+    """
+    Expose the memory usage of the process to Prometheus.
+
+    :param models: The model registry.
+    :param caches: A dictionary mapping names to caches.
+    :param name: The metrics name prefix.
+    :param registry: The Prometheus registry.
+    """
+    # Register the collector only once, as the application startup may happen more than once
+    if name in MEMORY_COLLECTORS:
+        MEMORY_COLLECTORS[name].models, MEMORY_COLLECTORS[name].caches = models, caches
+        return
+    MEMORY_COLLECTORS[name] = MemoryCollector(models, caches, name)
+    registry.register(MEMORY_COLLECTORS[name])
@@ -3,6 +3,7 @@ import argparse
 import pandas as pd
 from tqdm import tqdm
 from PIL import Image as pil
+from covidx.ct.preprocessing import crop_resize
 
 # Usage example:
 #   python covidx/ct/preprocessing.py --size 224 224 data/raw data/ct
@@ -59,8 +60,8 @@ if __name__ == '__main__':
             dest_filename = '{}.png'.format(os.path.splitext(filename)[0])
             src_filepath = os.path.join(args.src, '2A_images', filename)
             with pil.open(src_filepath) as img:
-                # Preprocess the image
-                img = img.convert(mode='L').crop(box).resize(args.size, resample=pil.BICUBIC)
+                # Preprocess the image, in the same way of the api
+                img = crop_resize(img, box, size=tuple(args.size))
 
             # Save the PNG image
             dest_filepath = os.path.join(args.dest, split, dest_filename)
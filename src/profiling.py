@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import contextlib
+
+import torch
+from torch.profiler import profile, record_function, ProfilerActivity
+
+
+class ProfilerBusyError(RuntimeError):
+    """Raised when a profiling capture is requested while another one is running."""
+
+
+def profiler_config():
+    """
+    Get the experimental profiler configuration recording the operators of all the threads, e.g. the batch
+    scheduler and the blocking workers, and not only the ones of the thread starting the profiler.
+
+    :return: A pair of the configuration (or None if not supported by PyTorch) and whether all threads are recorded.
+    """
+    try:
+        from torch._C._profiler import _ExperimentalConfig  # pylint: disable=import-outside-toplevel
+        return _ExperimentalConfig(profile_all_threads=True), True
+    except (ImportError, TypeError):
+        return None, False
+
+
+class RequestProfiler:
+    """On-demand profiler of the serving process, capturing a bounded number of requests or seconds."""
+    def __init__(self, max_depth=2):
+        """
+        Instantiate a request profiler.
+
+        :param max_depth: The maximum depth of the submodules recorded as named ranges, e.g. 'layer5.0'
+                          (i.e. a Bottleneck of CTNet) has depth 2.
+        """
+        self.max_depth = max_depth
+        self.active = False
+        self._busy = False
+        self._remaining = None
+        self._completed = 0
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._ranges = threading.local()
+
+    def record(self, name):
+        """
+        Record a named range in the trace, if capturing. It is meant for the work that is not made of PyTorch
+        operators, e.g. decoding and rendering images.
+
+        :param name: The range name.
+        :return: A context manager.
+        """
+        return record_function(name) if self.active else contextlib.nullcontext()
+
+    def request_done(self):
+        """
+        Notify the profiler that a request has been served.
+        """
+        with self._lock:
+            if not self.active:
+                return
+            self._completed += 1
+            if self._remaining is not None:
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._done.set()
+
+    def capture(self, duration, n_requests=None, models=(), row_limit=25, trace=True):
+        """
+        Profile the process until the given number of requests have been served, or the duration expires.
+
+        :param duration: The maximum duration (in seconds) of the capture.
+        :param n_requests: The number of requests to capture. If None, the capture lasts for the whole duration.
+        :param models: The models whose submodules are recorded as named ranges.
+        :param row_limit: The number of operators of the aggregated table.
+        :param trace: Whether to include the Chrome trace.
+        :return: A dictionary of the capture duration, the served requests, the top operators by self CPU time
+                 and the Chrome trace (i.e. the JSON object of chrome://tracing or Perfetto).
+        """
+        with self._lock:
+            if self._busy:
+                raise ProfilerBusyError("A profiling capture is already running")
+            self._busy = True
+            self._remaining = n_requests
+            self._completed = 0
+            self._done.clear()
+
+        config, all_threads = profiler_config()
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        handles = []
+        try:
+            for model in models:
+                handles.extend(self._record_modules(model))
+            start_time = time.perf_counter()
+            with profile(activities=activities, experimental_config=config) as prof:
+                # Count the requests only once the profiler is recording
+                self.active = True
+                try:
+                    self._done.wait(duration)
+                finally:
+                    self.active = False
+            elapsed = time.perf_counter() - start_time
+        finally:
+            for handle in handles:
+                handle.remove()
+            with self._lock:
+                self._busy = False
+
+        # Aggregate the operators and the named ranges by their self CPU time
+        events = sorted(prof.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)
+        top = [{
+            'name': e.key,
+            'calls': e.count,
+            'self_cpu_time_ms': e.self_cpu_time_total / 1000.0,
+            'cpu_time_ms': e.cpu_time_total / 1000.0
+        } for e in events[:row_limit]]
+        result = {'duration': elapsed, 'requests': self._completed, 'all_threads': all_threads, 'top': top}
+
+        if trace:
+            fd, filepath = tempfile.mkstemp(suffix='.json')
+            os.close(fd)
+            try:
+                prof.export_chrome_trace(filepath)
+                with open(filepath, 'r') as f:
+                    result['trace'] = json.load(f)
+            finally:
+                os.remove(filepath)
+        return result
+
+    def _record_modules(self, model):
+        # Record the forward pass of the submodules as named ranges, e.g. 'attention1 (LinearAttention2d)'
+        if not isinstance(model, torch.nn.Module):
+            return []
+
+        # Skip the inference adapters wrapping the network, so that the depth is relative to the network itself
+        children = list(model.children())
+        while len(children) == 1:
+            model = children[0]
+            children = list(model.children())
+
+        handles = []
+        for name, module in model.named_modules():
+            if name and name.count('.') >= self.max_depth:
+                continue
+            label = '{} ({})'.format(name, type(module).__name__) if name else type(module).__name__
+            handles.append(module.register_forward_pre_hook(self._enter_hook(label)))
+            handles.append(module.register_forward_hook(self._exit_hook))
+        return handles
+
+    def _enter_hook(self, label):
+        def hook(module, inputs):  # pylint: disable=unused-argument
+            if not hasattr(self._ranges, 'stack'):
+                self._ranges.stack = []
+            rf = record_function(label)
+            rf.__enter__()
+            self._ranges.stack.append((module, rf))
+        return hook
+
+    def _exit_hook(self, module, inputs, outputs):  # pylint: disable=unused-argument
+        # Close the range of the module, and the ones left open by failed forward passes
+        stack = getattr(self._ranges, 'stack', [])
+        if any(m is module for (m, _) in stack):
+            while True:
+                m, rf = stack.pop()
+                rf.__exit__(None, None, None)
+                if m is module:
+                    break
@@ -0,0 +1,277 @@
+import os
+import threading
+import traceback
+from collections import OrderedDict, Counter
+
+import torch
+
+
+def module_size(model):
+    """
+    Compute the memory occupied by the parameters and buffers of a module, including the packed parameters of
+    quantized modules.
+
+    :param model: The module, or a model exposing its size by the nbytes attribute (e.g. an ONNX Runtime session).
+    :return: The size in bytes.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return getattr(model, 'nbytes', 0)
+    size = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        size += sum(t.element_size() * t.nelement() for t in tensors if isinstance(t, torch.Tensor))
+    return size
+
+
+class ModelRegistry:
+    """Registry of the model checkpoints in a directory, loading them lazily and evicting the least recently used."""
+    def __init__(self, path, load_fn, max_memory=None, extensions=('.pt',), sizeof=module_size):
+        """
+        Instantiate a model registry.
+
+        :param path: The directory containing the model checkpoints.
+        :param load_fn: A function mapping a checkpoint filepath to a model.
+        :param max_memory: The maximum memory (in bytes) occupied by the loaded models. If None, it is unbounded.
+        :param extensions: The file extensions of the checkpoints. If a model has checkpoints with different
+                           extensions, the one whose extension comes first is used.
+        :param sizeof: A function returning the memory occupied by a model.
+        """
+        self.path = path
+        self.load_fn = load_fn
+        self.max_memory = max_memory
+        self.extensions = extensions
+        self.sizeof = sizeof
+        self.memory = 0
+        self._events = Counter()
+        self._models = OrderedDict()
+        self._failed = dict()
+        self._lock = threading.Lock()
+        self._load_locks = dict()
+
+    def keys(self):
+        """
+        Get the names of the available models, i.e. the checkpoint filenames without extension.
+
+        :return: The sorted list of model names.
+        """
+        return sorted(self._checkpoints().keys())
+
+    def loaded(self):
+        """
+        Get the names of the loaded models, from the least to the most recently used.
+
+        :return: The list of model names.
+        """
+        with self._lock:
+            return list(self._models.keys())
+
+    def items(self):
+        """
+        Get the loaded models, from the least to the most recently used, without marking them as used.
+
+        :return: The list of (model name, model) pairs.
+        """
+        with self._lock:
+            return [(name, model) for (name, (model, _, _)) in self._models.items()]
+
+    def events(self):
+        """
+        Get the number of events (i.e. 'load', 'load_failure', 'reload', 'reload_failure' and 'evict') of the models.
+
+        :return: A dictionary mapping the (model name, event) pairs to their number of occurrences.
+        """
+        with self._lock:
+            return dict(self._events)
+
+    def __contains__(self, name):
+        return name in self._checkpoints()
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def filepath(self, name):
+        """
+        Get the checkpoint filepath of a model.
+
+        :param name: The model name.
+        :return: The checkpoint filepath.
+        """
+        checkpoints = self._checkpoints()
+        if name not in checkpoints:
+            raise KeyError(name)
+        return checkpoints[name]
+
+    def identity(self, name):
+        """
+        Identify the checkpoint of a model, without loading it.
+
+        :param name: The model name.
+        :return: A string identifying the checkpoint file and the version of the loaded model, if any.
+        """
+        with self._lock:
+            if name in self._models:
+                return self._models[name][2]
+        return self._file_identity(self.filepath(name))
+
+    def get(self, name):
+        """
+        Get a model, loading it if needed, and mark it as the most recently used.
+
+        :param name: The model name.
+        :return: The model.
+        """
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name][0]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Load the model only once, even if requested concurrently
+        with load_lock:
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name][0]
+            filepath = self.filepath(name)
+            identity = self._file_identity(filepath)
+            try:
+                model = self.load_fn(filepath)
+            except Exception:
+                self._count(name, 'load_failure')
+                raise
+            self.put(name, model, identity)
+            self._count(name, 'load')
+        return model
+
+    def put(self, name, model, identity=None):
+        """
+        Insert or atomically replace a loaded model, evicting the least recently used models if needed.
+
+        :param name: The model name.
+        :param model: The model.
+        :param identity: The identity of the model checkpoint.
+        """
+        size = self.sizeof(model)
+        with self._lock:
+            if name in self._models:
+                self.memory -= self._models.pop(name)[1]
+            self._models[name] = (model, size, identity)
+            self.memory += size
+
+            # Evict the least recently used models, but never the one just inserted
+            while self.max_memory is not None and self.memory > self.max_memory and len(self._models) > 1:
+                evicted_name, (_, evicted_size, _) = self._models.popitem(last=False)
+                self.memory -= evicted_size
+                self._events[(evicted_name, 'evict')] += 1
+
+    def evict(self, name):
+        """
+        Unload a model. Requests still using the model keep their own reference to it.
+
+        :param name: The model name.
+        """
+        with self._lock:
+            if name in self._models:
+                self.memory -= self._models.pop(name)[1]
+                self._events[(name, 'evict')] += 1
+
+    def reload(self, warmup_fn=None):
+        """
+        Reload the loaded models whose checkpoint changed, and unload the ones whose checkpoint was removed.
+        Each new model is loaded and warmed up before replacing the old one, so that the requests keep being
+        served in the meanwhile. Requests already using the old model finish with it.
+
+        :param warmup_fn: A function called on each new model before replacing the old one.
+        :return: The names of the reloaded models.
+        """
+        reloaded = []
+        checkpoints = self._checkpoints()
+        for name in self.loaded():
+            if name not in checkpoints:
+                self.evict(name)
+                continue
+            identity = self._file_identity(checkpoints[name])
+            if identity in (self.identity(name), self._failed.get(name)):
+                continue
+
+            # Load the new model, keeping the old one if it fails (e.g. the checkpoint is still being written)
+            with self._load_locks.setdefault(name, threading.Lock()):
+                try:
+                    model = self.load_fn(checkpoints[name])
+                    if warmup_fn is not None:
+                        warmup_fn(model)
+                except Exception:  # pylint: disable=broad-except
+                    print("Failed to reload model {}".format(name))
+                    traceback.print_exc()
+                    self._failed[name] = identity
+                    self._count(name, 'reload_failure')
+                    continue
+                self.put(name, model, identity)
+            self._count(name, 'reload')
+            reloaded.append(name)
+            print("Reloaded model {}".format(name))
+        return reloaded
+
+    def _count(self, name, event):
+        with self._lock:
+            self._events[(name, event)] += 1
+
+    @staticmethod
+    def _file_identity(filepath):
+        stat = os.stat(filepath)
+        return '{}:{}:{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+    def _checkpoints(self):
+        if not os.path.isdir(self.path):
+            return dict()
+        checkpoints = dict()
+        for f in sorted(os.listdir(self.path), key=lambda f: self._priority(f)):
+            name, ext = os.path.splitext(f)
+            if ext in self.extensions and name not in checkpoints:
+                checkpoints[name] = os.path.join(self.path, f)
+        return checkpoints
+
+    def _priority(self, filename):
+        ext = os.path.splitext(filename)[1]
+        return self.extensions.index(ext) if ext in self.extensions else len(self.extensions)
+
+
+class ModelWatcher:
+    """Background thread periodically reloading the models of a registry whose checkpoint changed."""
+    def __init__(self, registry, interval=10.0, warmup_fn=None):
+        """
+        Instantiate a model watcher.
+
+        :param registry: The model registry.
+        :param interval: The time (in seconds) between two checks of the checkpoints.
+        :param warmup_fn: A function called on each new model before replacing the old one.
+        """
+        if interval <= 0.0:
+            raise ValueError("The interval must be positive")
+        self.registry = registry
+        self.interval = interval
+        self.warmup_fn = warmup_fn
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start watching the checkpoints, if not already watching.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='model-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching the checkpoints.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.registry.reload(warmup_fn=self.warmup_fn)
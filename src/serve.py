@@ -0,0 +1,279 @@
+import os
+import math
+import time
+import signal
+import socket
+import functools
+import torch
+import uvicorn
+
+import api
+
+# Some global variables
+HOST = os.environ.get('CT_COVID_HOST', '0.0.0.0')
+PORT = int(os.environ.get('CT_COVID_PORT', 5000))
+METRICS_PORT = int(os.environ.get('CT_COVID_METRICS_PORT', PORT + 1))
+RESTART_DELAY = 1.0
+POLL_INTERVAL = 0.1
+ROLLING_RESTART_DELAY = float(os.environ.get('CT_COVID_ROLLING_RESTART_DELAY', 10))
+JOB_WORKERS = int(os.environ.get('CT_COVID_JOB_WORKERS', 1))
+JOB_THREADS = int(os.environ.get('CT_COVID_JOB_THREADS', 1))
+JOB_NICENESS = int(os.environ.get('CT_COVID_JOB_NICENESS', 10))
+
+
+def available_cpus():
+    """
+    Get the number of CPUs available to the process, given by its CPU affinity and its cgroup CPU quota (if any).
+
+    :return: The number of available CPUs.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    # Read the CPU quota of cgroup v2, or of cgroup v1 as fallback
+    quota, period = None, None
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+                period = f.read().strip()
+        except OSError:
+            pass
+    if quota is not None and quota not in ('max', '-1'):
+        cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    return max(1, cpus)
+
+
+def create_socket(host, port):
+    """
+    Create the listening socket shared by the worker processes.
+
+    :param host: The host address.
+    :param port: The port.
+    :return: The bound socket.
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def preload_models():
+    """
+    Load the default model before forking, and move its weights to shared memory, so that
+    the worker processes use them without copying.
+    """
+    api.DEVICE = torch.device('cpu')
+    share_model(api.DEFAULT_MODEL, api.MODEL_WRAPPERS.get(api.DEFAULT_MODEL))
+
+
+def share_model(name, model):
+    """
+    Move the weights of a loaded model to shared memory.
+
+    :param name: The model name.
+    :param model: The model.
+    """
+    # The weights of flat checkpoints are memory-mapped, hence they are already shared
+    flat = os.path.splitext(api.MODEL_WRAPPERS.filepath(name))[1] == '.weights'
+    if isinstance(model, torch.nn.Module) and not flat:
+        model.share_memory()
+
+
+def checkpoint_identities():
+    """
+    Identify the checkpoints of the models, the loaded ones by the version of the loaded model.
+
+    :return: A dictionary of model names and checkpoint identities.
+    """
+    identities = dict()
+    for name in api.MODEL_WRAPPERS.keys():
+        try:
+            identities[name] = api.MODEL_WRAPPERS.identity(name)
+        except (KeyError, OSError):
+            pass  # The checkpoint has just been removed
+    return identities
+
+
+def reload_models(identities):
+    """
+    Reload the preloaded models whose checkpoint changed, sharing their weights as before forking.
+    The new models are not warmed up, as the workers warm up the default model when they start.
+
+    :param identities: The checkpoint identities of the models, as given by the previous check.
+    :return: The new checkpoint identities and the names of the changed models, i.e. the ones to reload in the
+             workers (whether they were preloaded or loaded by the workers on demand).
+    """
+    for name in api.MODEL_WRAPPERS.reload():
+        share_model(name, api.MODEL_WRAPPERS.get(name))
+    new_identities = checkpoint_identities()
+    changed = [name for name in new_identities if name in identities and new_identities[name] != identities[name]]
+    return new_identities, changed
+
+
+def run_worker(sock, num_threads, metrics_address):
+    """
+    Serve the api in a worker process.
+
+    :param sock: The listening socket.
+    :param num_threads: The number of threads used by the forward passes.
+    :param metrics_address: The host address and the port of the Prometheus metrics of the worker.
+    """
+    torch.set_num_threads(num_threads)
+    api.METRICS_ADDRESS = metrics_address
+    config = uvicorn.Config(api.app, log_level='info')
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def run_job_worker(num_threads, niceness):
+    """
+    Process the jobs in a worker process, with a lower priority than the api workers, so that the interactive
+    requests are isolated from the jobs throughput.
+
+    :param num_threads: The number of threads used by the forward passes.
+    :param niceness: The increment of the niceness of the process.
+    """
+    os.nice(niceness)
+    torch.set_num_threads(num_threads)
+    api.JOB_WORKER.run()
+
+
+def serve(host, port, n_workers, n_job_workers=0, metrics_port=None):
+    """
+    Serve the api using pre-forked worker processes, restarting the ones that die.
+    The CPUs are split evenly among the workers. The checkpoints are watched by the supervisor only, and the workers
+    are restarted one at a time when a checkpoint changes, so that they keep sharing the weights of the default model.
+
+    :param host: The host address.
+    :param port: The port.
+    :param n_workers: The number of worker processes.
+    :param n_job_workers: The number of job worker processes, processing the jobs in place of the api workers.
+    :param metrics_port: The port of the Prometheus metrics of the first worker, the following workers use the
+                         following ports. If None, it is the port following the api one.
+    """
+    metrics_port = metrics_port if metrics_port is not None else port + 1
+    num_threads = max(1, available_cpus() // n_workers)
+    sock = create_socket(host, port)
+    preload_models()
+
+    # The items left running by a previous run are requeued, before any job worker starts
+    # The workers do not watch the checkpoints, as each one would reload its own copy of the changed models
+    api.JOB_THREAD = False
+    api.MODEL_WATCHER = None
+    api.open_jobs()
+    api.JOBS.recover()
+
+    workers, job_workers = dict(), set()
+    stopping = False
+
+    def spawn_worker(index):
+        pid = os.fork()
+        if pid == 0:
+            # Restore the default signal handlers, as uvicorn installs its own ones
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(sock, num_threads, (host, metrics_port + index))
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        workers[pid] = index
+
+    def spawn_job_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_job_worker(JOB_THREADS, JOB_NICENESS)
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        job_workers.add(pid)
+
+    def stop_workers(signum, frame):  # pylint: disable=unused-argument
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers) + list(job_workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    print("Serving on {}:{} with {} workers of {} threads and {} job workers, with metrics on ports {}-{}".format(
+        host, port, n_workers, num_threads, n_job_workers, metrics_port, metrics_port + n_workers - 1
+    ))
+    for index in range(n_workers):
+        spawn_worker(index)
+    for _ in range(n_job_workers):
+        spawn_job_worker()
+
+    # Wait for the workers, and restart the ones that died unexpectedly
+    # The items claimed by a dead job worker are requeued, before restarting it
+    # A restarted worker exposes its metrics on the port of the dead one
+    identities = checkpoint_identities()
+    next_check = time.monotonic() + api.RELOAD_INTERVAL if api.RELOAD_INTERVAL > 0 else math.inf
+    restarting, restarted = [], set()
+    next_restart = math.inf
+    while workers or job_workers:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            # Restart the workers one at a time, leaving some time to each new worker to warm up before stopping the
+            # next one, so that the other workers keep serving the requests in the meanwhile
+            now = time.monotonic()
+            if stopping:
+                pass
+            elif restarting and now >= next_restart:
+                pid = restarting.pop(0)
+                if pid in workers or pid in job_workers:
+                    os.kill(pid, signal.SIGTERM)
+                    restarted.add(pid)
+                    next_restart = math.inf
+            elif not restarting and now >= next_check:
+                identities, changed = reload_models(identities)
+                if changed:
+                    print("Checkpoints of {} changed, restarting the workers".format(', '.join(changed)))
+                    restarting, next_restart = list(workers) + list(job_workers), now
+                next_check = now + api.RELOAD_INTERVAL
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        if pid in job_workers:
+            job_workers.discard(pid)
+            api.JOBS.recover(pid)
+            respawn = spawn_job_worker
+        else:
+            respawn = functools.partial(spawn_worker, workers.pop(pid))
+        if stopping:
+            continue
+        if pid in restarted:
+            restarted.discard(pid)
+            next_restart = time.monotonic() + ROLLING_RESTART_DELAY
+        else:
+            print("Worker {} died with status {}, restarting it".format(pid, status))
+            time.sleep(RESTART_DELAY)
+        respawn()
+    sock.close()
+
+
+# Usage example:
+#   CT_COVID_WORKERS=4 python src/serve.py
+#
+if __name__ == '__main__':
+    # By default, serve in a single process, so that a single metrics endpoint describes the whole api
+    # The pre-forked workers expose their metrics on a port each, which must be scraped separately
+    workers = int(os.environ.get('CT_COVID_WORKERS', 1))
+
+    # Fall back to a single process if forking is not possible, or if the models run on GPU
+    # The jobs are then processed by a background thread of the api
+    if workers <= 1 or not hasattr(os, 'fork') or torch.cuda.is_available():
+        uvicorn.run(api.app, host=HOST, port=PORT)
+    else:
+        serve(HOST, PORT, workers, n_job_workers=JOB_WORKERS, metrics_port=METRICS_PORT)
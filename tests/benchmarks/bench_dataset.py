@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from PIL import Image as pil
+from covidx.ct.dataset import CTDataset
+from utils_test import random_image
+from utils_bench import measure, parse_args, report
+
+# The number of synthetic images, i.e. the length of the loop over the dataset
+N_IMAGES = 32
+
+
+def make_dataset_files(path, random_state, size=224):
+    # Write synthetic grayscale PNG images, with the size of the CT scans preprocessed by src/preprocessing.py
+    filenames = []
+    for i in range(N_IMAGES):
+        filename = 'image-{}.png'.format(i)
+        data = np.asarray(pil.fromarray(random_image(random_state)).resize((size, size), resample=pil.BILINEAR))
+        pil.fromarray(data).save(os.path.join(path, filename))
+        filenames.append(filename)
+    return pd.DataFrame({'filename': filenames, 'class': random_state.randint(3, size=N_IMAGES)})
+
+
+def iterate(dataset):
+    for i in range(len(dataset)):
+        dataset[i]  # pylint: disable=pointless-statement
+
+
+# Usage example:
+#   PYTHONPATH=src:tests python tests/benchmarks/bench_dataset.py
+#
+if __name__ == '__main__':
+    args = parse_args("Benchmark a loop over the CT dataset, with synthetic images.")
+    random_state = np.random.RandomState(42)
+    path = tempfile.mkdtemp()
+    dataframe = make_dataset_files(path, random_state)
+
+    results = dict()
+    for name, kwargs in {
+        'ct_dataset': dict(), 'ct_dataset[equalize]': dict(equalize=True), 'ct_dataset[augment]': dict(augment=True)
+    }.items():
+        dataset = CTDataset(path, dataframe, **kwargs)
+        results[name] = measure(lambda: iterate(dataset), repeat=5, warmup=1)
+    sys.exit(report('dataset', results, args))
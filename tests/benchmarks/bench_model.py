@@ -0,0 +1,38 @@
+import sys
+import torch
+from covidx.ct.models import CTNet
+from covidx.ct.layers import LinearAttention2d
+from utils_bench import measure, parse_args, report
+
+# The batch sizes of the forward passes, i.e. a single request, a full micro-batch of the api and a training batch
+BATCH_SIZES = [1, 8, 32]
+
+
+# Usage example:
+#   PYTHONPATH=src:tests python tests/benchmarks/bench_model.py
+#
+if __name__ == '__main__':
+    args = parse_args("Benchmark the forward passes of CTNet and of its attention layers, with random weights.")
+    torch.manual_seed(42)
+    model = CTNet(num_classes=3, pretrained=False).eval()
+
+    results = dict()
+    with torch.no_grad():
+        for batch_size in BATCH_SIZES:
+            x = torch.randn(batch_size, 1, 224, 224)
+            repeat = max(3, 32 // batch_size)
+            results['ctnet[{}]'.format(batch_size)] = measure(lambda: model(x), repeat=repeat, warmup=2)
+            results['ctnet_attention[{}]'.format(batch_size)] = measure(
+                lambda: model(x, attention=True), repeat=repeat, warmup=2
+            )
+
+        # The attention layers, with the shapes of the local and global features of CTNet
+        for name, (in_features, out_features, size) in {
+            'attention1': (2048, 1024, 14), 'attention2': (2048, 2048, 7)
+        }.items():
+            layer = LinearAttention2d(in_features, out_features).eval()
+            for batch_size in BATCH_SIZES:
+                x = torch.randn(batch_size, out_features, size, size)
+                g = torch.randn(batch_size, in_features, 1, 1)
+                results['{}[{}]'.format(name, batch_size)] = measure(lambda: layer(x, g))
+    sys.exit(report('model', results, args))
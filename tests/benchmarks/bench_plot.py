@@ -0,0 +1,42 @@
+import io
+import os
+import sys
+import tempfile
+import numpy as np
+import torch
+from covidx.utils.plot import save_binary_attention_map, save_attention_map, render_binary_attention_map
+from utils_bench import measure, parse_args, report
+
+# Usage example:
+#   PYTHONPATH=src python tests/benchmarks/bench_plot.py
+#
+if __name__ == '__main__':
+    args = parse_args("Benchmark the rendering of the attention maps.")
+    torch.manual_seed(42)
+    if args.threads is None:
+        torch.set_num_threads(1)
+    height, width = 224, 224
+    img = torch.rand(1, 1, height, width)
+    att1 = torch.softmax(torch.rand(1, 1, (height // 16) * (width // 16)), dim=2).view(1, 1, height // 16, width // 16)
+    att2 = torch.softmax(torch.rand(1, 1, (height // 32) * (width // 32)), dim=2).view(1, 1, height // 32, width // 32)
+    img_u8 = (255.0 * img).squeeze().numpy().astype(np.uint8)
+
+    filepath = os.path.join(tempfile.mkdtemp(), 'attention.png')
+
+    results = {
+        'save_binary_attention_map': measure(lambda: save_binary_attention_map(io.BytesIO(), img, att1, att2)),
+        'save_attention_map': measure(lambda: save_attention_map(filepath, img, att1, att2)),
+        'render_binary_attention_map[png-1]': measure(
+            lambda: render_binary_attention_map(img_u8, att1, att2, encoding='png', compression=1)
+        ),
+        'render_binary_attention_map[png-6]': measure(
+            lambda: render_binary_attention_map(img_u8, att1, att2, encoding='png', compression=6)
+        ),
+        'render_binary_attention_map[jpeg]': measure(
+            lambda: render_binary_attention_map(img_u8, att1, att2, encoding='jpeg')
+        ),
+        'render_binary_attention_map[webp]': measure(
+            lambda: render_binary_attention_map(img_u8, att1, att2, encoding='webp')
+        )
+    }
+    sys.exit(report('plot', results, args))
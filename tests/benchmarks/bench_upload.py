@@ -0,0 +1,39 @@
+import io
+import sys
+import numpy as np
+from PIL import Image as pil
+from api import upload_file
+from utils_test import random_image, random_bbox
+from utils_bench import measure, parse_args, report
+
+
+def full_decode(bbox, contents):
+    # The reference preprocessing, decoding and converting the whole image before cropping it
+    with pil.open(io.BytesIO(contents)) as img:
+        return img.convert(mode='L').crop(bbox).resize((224, 224), resample=pil.BICUBIC)
+
+
+def encode(data, fmt):
+    image_bytes = io.BytesIO()
+    pil.fromarray(data).save(image_bytes, format=fmt)
+    return image_bytes.getvalue()
+
+
+# Usage example:
+#   PYTHONPATH=src:tests python tests/benchmarks/bench_upload.py
+#
+if __name__ == '__main__':
+    args = parse_args("Benchmark the decoding and preprocessing of the uploaded images.")
+    random_state = np.random.RandomState(42)
+    results = dict()
+    for size in [1024, 2048, 4096]:
+        # The 1024x1024 inputs are the ones of the API tests, the larger ones are upsampled from them
+        data = random_image(random_state)
+        if size > 1024:
+            data = np.asarray(pil.fromarray(data).resize((size, size), resample=pil.BILINEAR))
+        bbox = tuple(c * size // 1024 for c in random_bbox(random_state))
+        for fmt in ['png', 'jpeg']:
+            contents = encode(data, fmt)
+            results['full_decode[{}-{}]'.format(fmt, size)] = measure(lambda: full_decode(bbox, contents), repeat=20)
+            results['upload_file[{}-{}]'.format(fmt, size)] = measure(lambda: upload_file(bbox, contents), repeat=20)
+    sys.exit(report('upload', results, args))
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+import torch
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(fn, repeat=50, warmup=5):
+    """
+    Measure the latency of a function.
+
+    :param fn: The function to call, without arguments.
+    :param repeat: The number of measured calls.
+    :param warmup: The number of calls to make before measuring.
+    :return: A dictionary of latency statistics, in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    timings = np.empty(repeat, dtype=np.float64)
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        timings[i] = time.perf_counter() - start_time
+    timings *= 1000.0
+    return {
+        'mean_ms': float(np.mean(timings)),
+        'median_ms': float(np.median(timings)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'min_ms': float(np.min(timings)),
+        'repeat': repeat
+    }
+
+
+def print_results(results):
+    """
+    Print a table of latency statistics.
+
+    :param results: A dictionary mapping benchmark names to latency statistics.
+    """
+    width = max(map(len, results.keys()))
+    print('{:<{w}}  {:>10}  {:>10}  {:>10}'.format('benchmark', 'mean [ms]', 'median', 'p95', w=width))
+    for name, stats in results.items():
+        print('{:<{w}}  {:>10.3f}  {:>10.3f}  {:>10.3f}'.format(
+            name, stats['mean_ms'], stats['median_ms'], stats['p95_ms'], w=width
+        ))
+
+
+def processor_name():
+    """
+    Get the processor model name, which is not given by the platform module on Linux.
+
+    :return: The processor model name.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def environment_metadata():
+    """
+    Describe the environment of the benchmarks, so that results from different environments are not mixed up.
+
+    :return: A dictionary of the environment metadata.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_PATH, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': processor_name(),
+        'cpus': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Compare latency statistics against a baseline, i.e. the median latencies must not increase beyond the tolerance.
+
+    :param results: A dictionary mapping benchmark names to latency statistics.
+    :param baseline: A dictionary mapping benchmark names to the baseline latency statistics.
+    :param tolerance: The relative tolerance.
+    :return: The list of regressions, as human-readable strings.
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name in baseline and stats['median_ms'] > baseline[name]['median_ms'] * (1.0 + tolerance):
+            regressions.append('{}: median {:.3f} ms > {:.3f} ms'.format(
+                name, stats['median_ms'], baseline[name]['median_ms']
+            ))
+    return regressions
+
+
+def parse_args(description):
+    """
+    Parse the command line arguments of a benchmark.
+
+    :param description: The benchmark description.
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--output-path', default='benchmark-results', help="The directory of the JSON results.")
+    parser.add_argument('--baseline-path', default=os.path.join(BENCHMARKS_PATH, 'baselines'))
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--require-baseline', action='store_true', help="Fail if there is no baseline.")
+    parser.add_argument('--threads', type=int, default=None, help="The number of PyTorch threads.")
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    return args
+
+
+def report(name, results, args):
+    """
+    Print the results of a benchmark, save them as JSON and compare them against the stored baseline, if any.
+
+    :param name: The benchmark name, i.e. the JSON filename without extension.
+    :param results: A dictionary mapping benchmark names to latency statistics.
+    :param args: The parsed command line arguments.
+    :return: The exit code, i.e. 1 if there are regressions (or no baseline, if required), 0 otherwise.
+    """
+    print_results(results)
+    data = {'environment': environment_metadata(), 'results': results}
+    os.makedirs(args.output_path, exist_ok=True)
+    with open(os.path.join(args.output_path, '{}.json'.format(name)), 'w') as f:
+        json.dump(data, f, indent=2)
+
+    baseline_filepath = os.path.join(args.baseline_path, '{}.json'.format(name))
+    if args.update_baseline:
+        os.makedirs(args.baseline_path, exist_ok=True)
+        with open(baseline_filepath, 'w') as f:
+            json.dump(data, f, indent=2)
+        print("Updated the baseline {}".format(baseline_filepath))
+        return 0
+    # A missing baseline fails only if required (e.g. in CI), as the baselines are made per environment
+    if not os.path.isfile(baseline_filepath):
+        print("{}: no baseline {}, create it by --update-baseline on the reference environment".format(
+            'Error' if args.require_baseline else 'Warning', baseline_filepath
+        ), file=sys.stderr)
+        return 1 if args.require_baseline else 0
+
+    with open(baseline_filepath, 'r') as f:
+        baseline = json.load(f)
+    for key in ['processor', 'cpus', 'threads', 'torch']:
+        if baseline['environment'].get(key) != data['environment'][key]:
+            print("Warning: the baseline has {} {}, but the results have {}".format(
+                key, baseline['environment'].get(key), data['environment'][key]
+            ), file=sys.stderr)
+    regressions = compare_results(results, baseline['results'], tolerance=args.tolerance)
+    for regression in regressions:
+        print("Regression - {}".format(regression))
+    return 1 if regressions else 0
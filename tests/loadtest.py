@@ -0,0 +1,274 @@
+# Locust patches the standard library for gevent, so it must be imported first
+from locust import constant
+from locust.env import Environment
+from locust.stats import StatsEntry
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import itertools
+import platform
+import subprocess
+from http import HTTPStatus
+
+import gevent
+import numpy as np
+import requests
+from tests.locust import RandomUser
+from tests.utils_test import get_image_bytes
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BASELINE_PATH = os.path.join(ROOT_PATH, 'tests', 'baselines', 'loadtest.json')
+
+# The number of seeded images encoded before running the scenarios, sampled by the users
+N_IMAGES = 16
+
+# The percentiles of the response times in the report
+PERCENTILES = {'p50_ms': 0.5, 'p95_ms': 0.95, 'p99_ms': 0.99}
+
+# The maximum increase of the error rate over the baseline, regardless of the tolerance
+ERROR_RATE_TOLERANCE = 0.01
+
+
+class PredictUser(RandomUser):
+    # Request back to back, notice that the tasks are filtered by the tags of the scenario
+    wait_time = constant(0)
+
+
+class MixedUser(RandomUser):
+    # The traffic of the interactive swarm, with a think time between the requests
+    wait_time = constant(0.5)
+
+
+# The scenarios, i.e. the users classes, the tags of their tasks (if None, all of them), the number of users,
+# their spawn rate (per second) and the duration (in seconds)
+SCENARIOS = {
+    'predict': {'users': [PredictUser], 'tags': ['prediction'], 'n_users': 4, 'spawn_rate': 4, 'duration': 60},
+    'mixed': {'users': [MixedUser], 'tags': None, 'n_users': 16, 'spawn_rate': 4, 'duration': 60},
+    'burst': {'users': [PredictUser], 'tags': ['prediction'], 'n_users': 32, 'spawn_rate': 32, 'duration': 30},
+    'soak': {'users': [MixedUser], 'tags': None, 'n_users': 8, 'spawn_rate': 1, 'duration': 900}
+}
+
+
+def start_server(n_workers, env=None):
+    """
+    Start the api locally, on a free port.
+
+    :param n_workers: The number of worker processes.
+    :param env: Additional environment variables, e.g. the configuration of the api.
+    :return: The server process and its url.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, **(env or {}),
+               CT_COVID_WORKERS=str(n_workers), CT_COVID_HOST='127.0.0.1', CT_COVID_PORT=str(port))
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(ROOT_PATH, 'src'), env.get('PYTHONPATH', '')])
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_PATH, 'src', 'serve.py')], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def wait_ready(url, timeout=120.0):
+    """
+    Wait for the api to be ready.
+
+    :param url: The api url.
+    :param timeout: The maximum time to wait, in seconds.
+    :return: Whether the api is ready.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url + '/ready').status_code == HTTPStatus.OK:
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def summarize(entry, duration):
+    """
+    Summarize the statistics of the requests.
+
+    :param entry: The Locust statistics entry.
+    :param duration: The duration of the scenario, in seconds.
+    :return: A dictionary of the number of requests, the error rate, the throughput and the latency percentiles.
+    """
+    summary = {
+        'requests': entry.num_requests,
+        'failures': entry.num_failures,
+        'error_rate': entry.num_failures / max(entry.num_requests, 1),
+        'throughput': (entry.num_requests - entry.num_failures) / duration
+    }
+    for key, percentile in PERCENTILES.items():
+        summary[key] = entry.get_response_time_percentile(percentile) if entry.num_requests > 0 else None
+    return summary
+
+
+def run_scenario(url, scenario, duration=None, seed=42, images=None):
+    """
+    Run a scenario headless.
+
+    :param url: The api url.
+    :param scenario: The scenario.
+    :param duration: The duration in seconds, overriding the one of the scenario.
+    :param seed: The seed of the inputs, offset by the user index.
+    :param images: The pool of encoded images.
+    :return: The report of the scenario, i.e. the statistics of all the requests, of each endpoint and
+             of each stage of the predictions.
+    """
+    duration = duration if duration is not None else scenario['duration']
+    RandomUser._counter = itertools.count()  # pylint: disable=protected-access
+    for user_class in scenario['users']:
+        user_class.seed, user_class.images = seed, images
+    env = Environment(user_classes=scenario['users'], tags=scenario['tags'], host=url)
+    runner = env.create_local_runner()
+    runner.start(scenario['n_users'], spawn_rate=scenario['spawn_rate'])
+    gevent.spawn_later(duration, runner.quit)
+    runner.greenlet.join()
+
+    # The stages of the predictions are reported as requests of type STAGE
+    total = StatsEntry(env.stats, 'Aggregated', None)
+    endpoints, stages = dict(), dict()
+    for (name, method), entry in sorted(env.stats.entries.items()):
+        if method == 'STAGE':
+            stages[name] = summarize(entry, duration)
+        else:
+            total.extend(entry)
+            endpoints['{} {}'.format(method, name)] = summarize(entry, duration)
+    return dict(summarize(total, duration), duration=duration, users=scenario['n_users'],
+                endpoints=endpoints, stages=stages)
+
+
+def environment_metadata(n_workers):
+    """
+    Describe the environment of the benchmark, so that reports from different environments are not mixed up.
+
+    :param n_workers: The number of worker processes of the api.
+    :return: A dictionary of the environment metadata.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_PATH, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+        'workers': n_workers,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compare a report against a baseline, i.e. the latency percentiles must not increase and the throughput
+    must not decrease beyond the tolerance, and the error rate must not increase.
+
+    :param report: The report.
+    :param baseline: The baseline report.
+    :param tolerance: The relative tolerance.
+    :return: The list of regressions, as human-readable strings.
+    """
+    regressions = []
+    for name, scenario in report['scenarios'].items():
+        expected = baseline['scenarios'].get(name)
+        if expected is None:
+            continue
+        for key in PERCENTILES:
+            if scenario[key] is not None and expected[key] is not None and \
+                    scenario[key] > expected[key] * (1.0 + tolerance):
+                regressions.append('{}: {} {:.0f} > {:.0f}'.format(name, key, scenario[key], expected[key]))
+        if scenario['throughput'] < expected['throughput'] * (1.0 - tolerance):
+            regressions.append('{}: throughput {:.2f} < {:.2f} req/s'.format(
+                name, scenario['throughput'], expected['throughput']
+            ))
+        if scenario['error_rate'] > expected['error_rate'] + ERROR_RATE_TOLERANCE:
+            regressions.append('{}: error rate {:.3f} > {:.3f}'.format(
+                name, scenario['error_rate'], expected['error_rate']
+            ))
+    return regressions
+
+
+def main(args):
+    # Encode the seeded images once, so that the users do not compete for the CPU with the api by encoding them
+    random_state = np.random.RandomState(args.seed)
+    images = [get_image_bytes(random_state).getvalue() for _ in range(N_IMAGES)]
+
+    process, url = None, args.host
+    if url is None:
+        process, url = start_server(args.workers)
+    try:
+        if not wait_ready(url):
+            print("The api at {} is not ready".format(url))
+            return 1
+        report = {'environment': environment_metadata(args.workers), 'scenarios': dict()}
+        for name in args.scenarios:
+            print("Running scenario {} ...".format(name))
+            report['scenarios'][name] = result = run_scenario(
+                url, SCENARIOS[name], duration=args.duration, seed=args.seed, images=images
+            )
+            print("{}: {:.2f} req/s, p50 {} ms, p95 {} ms, p99 {} ms, error rate {:.2%}".format(
+                name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['error_rate']
+            ))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=60)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Updated the baseline {}".format(args.baseline))
+        return 0
+
+    # Compare the report against the baseline, from the same environment
+    # A missing baseline fails only if required (e.g. in CI), as the baselines are made per environment
+    if not os.path.isfile(args.baseline):
+        print("{}: no baseline {}, create it by --update-baseline on the reference environment".format(
+            'Error' if args.require_baseline else 'Warning', args.baseline
+        ), file=sys.stderr)
+        return 1 if args.require_baseline else 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    for key in ['cpus', 'workers']:
+        if baseline['environment'].get(key) != report['environment'][key]:
+            print("Warning: the baseline has {} {}, but the report has {}".format(
+                key, baseline['environment'].get(key), report['environment'][key]
+            ))
+    regressions = compare(report, baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        print("Regression - {}".format(regression))
+    return 1 if regressions else 0
+
+
+# Usage example:
+#   python -m tests.loadtest --scenarios predict mixed burst
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless load test of the api, compared against a baseline.")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS.keys()), default=['predict', 'mixed', 'burst'])
+    parser.add_argument('--host', default=None, help="The url of a running api. If None, the api is started locally.")
+    parser.add_argument('--workers', type=int, default=1, help="The number of worker processes of the local api.")
+    parser.add_argument('--duration', type=float, default=None, help="Override the duration of the scenarios.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', default='loadtest-report.json')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--require-baseline', action='store_true', help="Fail if there is no baseline.")
+    sys.exit(main(parser.parse_args()))
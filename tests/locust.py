@@ -1,12 +1,22 @@
+import itertools
 import numpy as np
 from locust import HttpUser, task, tag
 from tests.utils_test import get_formatted_params, get_image_bytes
 
 
 class RandomUser(HttpUser):
+    # The seed of the random inputs, offset by the user index, or None for non-reproducible inputs
+    seed = None
+
+    # An optional pool of encoded images to sample from, instead of encoding a new image for each request
+    images = None
+
+    _counter = itertools.count()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.random_state = np.random.RandomState()
+        index = next(RandomUser._counter)
+        self.random_state = np.random.RandomState(None if self.seed is None else self.seed + index)
 
     @task(1)
     @tag('welcome')
@@ -27,8 +37,24 @@ class RandomUser(HttpUser):
     @tag('prediction')
     def prediction(self):
         params = get_formatted_params(self.random_state)
-        image_bytes = get_image_bytes(self.random_state)
-        self.client.post(
+        response = self.client.post(
             '/predict?' + '&'.join(params),
-            files=[('file', ('input-image', image_bytes, 'image/png'))]
+            files=[('file', ('input-image', self.image_bytes(), 'image/png'))], name='/predict'
         )
+        self.report_stages(response)
+
+    def image_bytes(self):
+        # Sample an image from the pool, if any, otherwise encode a new one
+        if self.images:
+            return self.images[self.random_state.randint(len(self.images))]
+        return get_image_bytes(self.random_state)
+
+    def report_stages(self, response):
+        # Report the time spent in each stage of the request, given by the Server-Timing header
+        for metric in response.headers.get('Server-Timing', '').split(','):
+            name, _, duration = metric.strip().partition(';dur=')
+            if name and duration:
+                self.environment.events.request.fire(
+                    request_type='STAGE', name=name, response_time=float(duration),
+                    response_length=0, exception=None, context={}
+                )
@@ -1,10 +1,27 @@
+import io
+import json
+import base64
+import time
+import tempfile
+import threading
 import pytest
+from PIL import Image
 from fastapi.testclient import TestClient
 from http import HTTPStatus
+import api
 from api import app
 from api import PREDICTION_TAGS
-from utils_test import get_formatted_params, get_image_bytes
+from engine import LoadShedder
+from jobs import JobStore, JobWorker
+from covidx.ct.embeddings import EmbeddingIndex, build_embedding_index, load_embedding_model
+from covidx.ct.preprocessing import normalize
+from monitoring import parse_server_timing
+from utils_test import get_formatted_params, get_image_bytes, random_bbox, random_image
 import numpy as np
+import pandas as pd
+
+# Do not create the job store in the working directory, when the application starts
+api.JOBS_PATH = tempfile.mkdtemp()
 
 with TestClient(app) as client:
 
@@ -16,6 +33,16 @@ with TestClient(app) as client:
         assert type(response.json()['message']) == str
 
 
+    @pytest.mark.api
+    def test_ready(monkeypatch):
+        monkeypatch.setattr(api, 'READY', False)
+        response = client.get("/ready")
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        monkeypatch.setattr(api, 'READY', True)
+        response = client.get("/ready")
+        assert response.status_code == HTTPStatus.OK
+
+
     @pytest.mark.api
     def test_docs():
         response = client.get("/docs")
@@ -30,6 +57,7 @@ with TestClient(app) as client:
         response_models = response.json()['models']
         assert type(response_models) == list
         assert all(map(lambda x: isinstance(x, str), response_models))
+        assert response.json()['default'] in response_models
 
 
     @pytest.mark.api
@@ -43,3 +71,311 @@ with TestClient(app) as client:
         )
         assert response.status_code == HTTPStatus.OK
         assert response.headers['prediction'] in PREDICTION_TAGS.values()
+        stages = parse_server_timing(response.headers['Server-Timing'])
+        assert {'read', 'decode', 'queue', 'forward', 'render', 'encode'}.issubset(stages.keys())
+
+        response = client.post(
+            '/predict?' + '&'.join(params + ['model=unknown']),
+            files=[('file', ('input-image', image_bytes, 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+    @pytest.mark.api
+    def test_predict_batch():
+        random_state = np.random.RandomState()
+        n_files = 3
+        bboxes = [random_bbox(random_state) for _ in range(n_files)]
+        params = ['{}={}'.format(k, v) for bbox in bboxes for (k, v) in zip(['xmin', 'ymin', 'xmax', 'ymax'], bbox)]
+        files = [('files', ('input-image-{}'.format(i), get_image_bytes(random_state), 'image/png'))
+                 for i in range(n_files)]
+        response = client.post('/predict/batch?' + '&'.join(params), files=files)
+        assert response.status_code == HTTPStatus.OK
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line['index'] for line in lines] == list(range(n_files))
+        for line in lines:
+            assert line['prediction'] in PREDICTION_TAGS.values()
+            with Image.open(io.BytesIO(base64.b64decode(line['heatmap']))) as img:
+                assert img.format == 'PNG'
+
+        response = client.post('/predict/batch?' + '&'.join(params[:4]), files=files)
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+    @pytest.mark.api
+    def test_load_shedding(monkeypatch):
+        random_state = np.random.RandomState()
+        params = get_formatted_params(random_state)
+        image_bytes = get_image_bytes(random_state)
+
+        # Any prediction exceeds the tiny budgets, so the heatmaps are skipped and then the batches are shed
+        monkeypatch.setattr(api, 'SHEDDER', LoadShedder(
+            latency_budget=1e-6, wait_budget=0.0, min_duration=0.5, half_life=0.02
+        ))
+        response = client.post(
+            '/predict?' + '&'.join(params),
+            files=[('file', ('input-image', image_bytes, 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['X-Degraded'] == 'heatmap'
+        assert response.headers['content-type'] == 'application/json'
+        prediction = response.json()
+        assert prediction['prediction'] in PREDICTION_TAGS.values()
+        assert api.SHEDDER.level == LoadShedder.SHEDDING and api.SHEDDER.degraded == 1
+
+        response = client.get('/predictions/{}/heatmap'.format(prediction['prediction_id']))
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        assert 'Retry-After' in response.headers
+        response = client.post(
+            '/predict/batch?' + '&'.join(params),
+            files=[('files', ('input-image', image_bytes, 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+        # The full responses are restored once the load drops, even without predictions
+        time.sleep(1.5)
+        response = client.get('/predictions/{}/heatmap'.format(prediction['prediction_id']))
+        assert response.status_code == HTTPStatus.OK
+        assert api.SHEDDER.level == LoadShedder.NORMAL
+        response = client.post(
+            '/predict?' + '&'.join(params),
+            files=[('file', ('input-image', image_bytes, 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['content-type'] == 'image/png' and 'X-Degraded' not in response.headers
+
+
+    @pytest.mark.api
+    def test_predict_json():
+        random_state = np.random.RandomState()
+        params = get_formatted_params(random_state)
+        image_bytes = get_image_bytes(random_state)
+        response = client.post(
+            '/predictions?' + '&'.join(params),
+            files=[('file', ('input-image', image_bytes, 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.OK
+        prediction = response.json()
+        assert prediction['prediction'] in PREDICTION_TAGS.values()
+        assert sum(prediction['probabilities'].values()) == pytest.approx(1.0)
+
+        response = client.get('/predictions/{}/heatmap'.format(prediction['prediction_id']))
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['content-type'] == 'image/png'
+
+        response = client.get('/predictions/unknown/heatmap')
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+    @pytest.mark.api
+    def test_predict_invalid_upload(monkeypatch):
+        random_state = np.random.RandomState()
+        params = get_formatted_params(random_state)
+        image_bytes = get_image_bytes(random_state).getvalue()
+
+        def post(params, contents):
+            return client.post(
+                '/predictions?' + '&'.join(params),
+                files=[('file', ('input-image', contents, 'image/png'))]
+            )
+
+        assert post(params, b'not an image').status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        assert post(params, image_bytes[:len(image_bytes) // 2]).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        assert post(['xmin=10', 'ymin=10', 'xmax=5', 'ymax=50'], image_bytes).status_code == \
+               HTTPStatus.UNPROCESSABLE_ENTITY
+
+        monkeypatch.setattr(api, 'MAX_IMAGE_PIXELS', 512 * 512)
+        assert post(params, image_bytes).status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        monkeypatch.setattr(api, 'MAX_UPLOAD_SIZE', len(image_bytes) - 1)
+        assert post(params, image_bytes).status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+        # The bodies exceeding the files accepted by the endpoint are rejected before being parsed
+        monkeypatch.setattr(api, 'MAX_UPLOAD_SIZE', 0)
+        response = post(params, image_bytes + bytes(api.MULTIPART_OVERHEAD))
+        assert response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        assert response.json()['detail'] == "The body exceeds {} bytes".format(api.MULTIPART_OVERHEAD)
+
+
+    @pytest.mark.api
+    def test_predict_raw():
+        random_state = np.random.RandomState()
+        images = random_state.randint(0, 256, size=(3, 224, 224), dtype=np.uint8)
+        headers = {'Content-Type': 'application/octet-stream'}
+        response = client.post('/predictions/raw', content=images[0].tobytes(), headers=headers)
+        assert response.status_code == HTTPStatus.OK
+        predictions = response.json()['predictions']
+        assert len(predictions) == 1 and predictions[0]['prediction'] in PREDICTION_TAGS.values()
+        assert sum(predictions[0]['probabilities'].values()) == pytest.approx(1.0)
+        response = client.get('/predictions/{}/heatmap'.format(predictions[0]['prediction_id']))
+        assert response.status_code == HTTPStatus.OK
+
+        # A batch of images gives the same predictions of the single images
+        response = client.post(
+            '/predictions/raw', content=images.tobytes(), headers=dict(headers, **{'X-Tensor-Shape': '3,224,224'})
+        )
+        assert response.status_code == HTTPStatus.OK
+        batch = response.json()['predictions']
+        assert [p['index'] for p in batch] == [0, 1, 2]
+        assert batch[0]['prediction_id'] == predictions[0]['prediction_id']
+        assert batch[0]['probabilities'] == pytest.approx(predictions[0]['probabilities'], abs=1e-5)
+
+        # The cached images do not keep the whole body alive
+        cached = api.PREDICTIONS.get(batch[1]['prediction_id'])['image']
+        assert cached.base is None and cached.nbytes == 224 * 224
+
+        assert client.post('/predictions/raw', content=images.tobytes(), headers=dict(
+            headers, **{'X-Tensor-Shape': '2,224,224'}
+        )).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        assert client.post('/predictions/raw', content=images[0].tobytes(), headers=dict(
+            headers, **{'X-Tensor-Shape': '112,448'}
+        )).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        assert client.post('/predictions/raw', content=images[0].tobytes(), headers=dict(
+            headers, **{'X-Tensor-Dtype': 'float32'}
+        )).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+    @pytest.mark.api
+    def test_similar(monkeypatch, tmp_path):
+        random_state = np.random.RandomState()
+        params = get_formatted_params(random_state)
+        image_bytes = get_image_bytes(random_state)
+        files = [('file', ('input-image', image_bytes, 'image/png'))]
+        monkeypatch.setattr(api, 'EMBEDDINGS', None)
+        response = client.post('/similar?' + '&'.join(params), files=files)
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+        # Index the uploaded image among other reference cases, so that it is the most similar to itself
+        bbox = tuple(int(p.split('=')[1]) for p in params)
+        images = [api.load_image(bbox, image_bytes.getvalue())]
+        images += [random_image(random_state)[:224, :224] for _ in range(3)]
+        dataset = [(normalize(image), 0) for image in images]
+        cases = pd.DataFrame({'filename': ['{}.png'.format(i) for i in range(4)], 'class': [2, 0, 1, 0]})
+        model = load_embedding_model(api.MODEL_WRAPPERS.filepath(api.DEFAULT_MODEL))
+        build_embedding_index(model, dataset, cases, str(tmp_path), api.DEFAULT_MODEL)
+        monkeypatch.setattr(api, 'EMBEDDINGS', EmbeddingIndex(str(tmp_path)))
+
+        response = client.post('/similar?' + '&'.join(params + ['k=3', 'embedding=true']), files=files)
+        assert response.status_code == HTTPStatus.OK
+        result = response.json()
+        assert result['model'] == api.DEFAULT_MODEL and len(result['embedding']) == model.out_features
+        assert [case['index'] for case in result['cases']][0] == 0 and len(result['cases']) == 3
+        assert result['cases'][0]['label'] == PREDICTION_TAGS[2] and result['cases'][0]['similarity'] > 0.99
+        stages = parse_server_timing(response.headers['Server-Timing'])
+        assert {'read', 'decode', 'embed', 'search'}.issubset(stages.keys())
+
+        response = client.post('/similar?' + '&'.join(params + ['k=0']), files=files)
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+    @pytest.mark.api
+    def test_jobs(monkeypatch, tmp_path):
+        store = JobStore(str(tmp_path / 'jobs'))
+        monkeypatch.setattr(api, 'JOBS', store)
+        monkeypatch.setattr(api, 'JOB_WORKER', JobWorker(store, api.predict_job_items, batch_size=api.JOB_BATCH_SIZE))
+        random_state = np.random.RandomState()
+        n_files = 3
+        bboxes = [random_bbox(random_state) for _ in range(n_files)]
+        params = ['{}={}'.format(k, v) for bbox in bboxes for (k, v) in zip(['xmin', 'ymin', 'xmax', 'ymax'], bbox)]
+        files = [('files', ('input-image-{}'.format(i), get_image_bytes(random_state), 'image/png'))
+                 for i in range(n_files)]
+        files.append(('files', ('invalid', b'not an image', 'image/png')))
+        params += ['xmin=0', 'ymin=0', 'xmax=8', 'ymax=8']
+        response = client.post('/jobs?' + '&'.join(params), files=files)
+        assert response.status_code == HTTPStatus.ACCEPTED
+        job = response.json()
+        assert job['items'] == n_files + 1 and response.headers['Location'] == '/jobs/' + job['id']
+
+        # Process the queue, as the background worker is stopped with the application
+        assert not api.interactive_pending()
+        while api.JOB_WORKER.run_once() > 0:
+            pass
+        response = client.get('/jobs/{}/results?wait=true'.format(job['id']))
+        assert response.status_code == HTTPStatus.OK
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [r['index'] for r in results] == list(range(n_files + 1))
+        assert all(r['prediction'] in PREDICTION_TAGS.values() for r in results[:n_files])
+        assert results[-1]['status'] == 'failed' and 'error' in results[-1]
+        status = client.get('/jobs/' + job['id']).json()
+        assert status['status'] == 'done' and status['done'] == n_files and status['failed'] == 1
+
+        # The manifest lists images of the archive
+        image_path = tmp_path / 'slice.png'
+        image_path.write_bytes(get_image_bytes(random_state).getvalue())
+        manifest = 'path,xmin,ymin,xmax,ymax\nslice.png,{},{},{},{}\n'.format(*bboxes[0])
+        response = client.post('/jobs', files=[('manifest', ('manifest.csv', manifest, 'text/csv'))])
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        monkeypatch.setattr(api, 'ARCHIVE_PATH', str(tmp_path))
+        response = client.post('/jobs', files=[('manifest', ('manifest.csv', manifest, 'text/csv'))])
+        assert response.status_code == HTTPStatus.ACCEPTED
+        manifest_id = response.json()['id']
+
+        # The stream of a job left pending ends after the maximum wait, without results
+        monkeypatch.setattr(api, 'MAX_JOB_WAIT', 0.5)
+        start_time = time.monotonic()
+        response = client.get('/jobs/{}/results?wait=true&timeout=60'.format(manifest_id))
+        assert response.status_code == HTTPStatus.OK and response.text == ''
+        assert time.monotonic() - start_time < 5.0
+        response = client.get('/jobs/{}/results?wait=true&timeout=0'.format(manifest_id))
+        assert response.status_code == HTTPStatus.OK and response.text == ''
+        response = client.post('/jobs', files=[('manifest', ('manifest.csv', '../' + manifest, 'text/csv'))])
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+        response = client.post(
+            '/jobs', files=[('manifest', ('manifest.csv', manifest.replace('slice', '../slice'), 'text/csv'))]
+        )
+        assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+        assert client.delete('/jobs/' + manifest_id).status_code == HTTPStatus.OK
+        assert client.delete('/jobs/' + job['id']).status_code == HTTPStatus.OK
+        assert client.get('/jobs/' + job['id']).status_code == HTTPStatus.NOT_FOUND
+        assert image_path.exists()
+        assert client.post('/jobs?' + '&'.join(params[:4]), files=files).status_code == \
+               HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+    @pytest.mark.api
+    def test_profile(monkeypatch):
+        response = client.post('/admin/profile?seconds=1')
+        assert response.status_code == HTTPStatus.NOT_FOUND
+        monkeypatch.setattr(api, 'ADMIN_TOKEN', 'secret')
+        response = client.post('/admin/profile?seconds=1', headers={'Authorization': 'Bearer wrong'})
+        assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+        # Capture a single prediction, served while profiling
+        results = []
+        profile = threading.Thread(target=lambda: results.append(client.post(
+            '/admin/profile?seconds=30&requests=1', headers={'Authorization': 'Bearer secret'}
+        )))
+        profile.start()
+        while not api.PROFILER.active and profile.is_alive():
+            profile.join(0.01)
+        random_state = np.random.RandomState()
+        response = client.post(
+            '/predict?' + '&'.join(get_formatted_params(random_state)),
+            files=[('file', ('input-image', get_image_bytes(random_state), 'image/png'))]
+        )
+        assert response.status_code == HTTPStatus.OK
+        profile.join()
+
+        assert results[0].status_code == HTTPStatus.OK
+        result = results[0].json()
+        assert result['requests'] == 1 and result['duration'] < 30
+        assert len(result['top']) == 25 and len(result['trace']['traceEvents']) > 0
+        if result['all_threads']:
+            names = {e['name'] for e in result['trace']['traceEvents']}
+            assert {'decode', 'render', 'attention1 (LinearAttention2d)', 'layer5.0 (Bottleneck)'}.issubset(names)
+
+
+@pytest.mark.api
+def test_upload_file_jpeg_draft():
+    random_state = np.random.RandomState(42)
+    data = np.asarray(Image.fromarray(random_image(random_state)).resize((4096, 4096), resample=Image.BILINEAR))
+    image_bytes = io.BytesIO()
+    Image.fromarray(data).save(image_bytes, format='jpeg', quality=95)
+    bbox = tuple(4 * c for c in random_bbox(random_state))
+
+    # The reduced decoding must be close to the full one
+    img = api.upload_file(bbox, image_bytes.getvalue())
+    with Image.open(image_bytes) as full:
+        expected = full.convert(mode='L').crop(bbox).resize((224, 224), resample=Image.BICUBIC)
+    assert img.size == (224, 224)
+    assert np.abs(np.asarray(img, dtype=np.float32) - np.asarray(expected, dtype=np.float32)).mean() < 4.0
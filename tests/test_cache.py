@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+from cache import LRUCache
+
+
+def test_lru_cache():
+    with pytest.raises(ValueError):
+        LRUCache(max_size=0)
+
+    cache = LRUCache(max_size=10, sizeof=len)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    cache.put('c', b'cccc')  # Evicts 'b', i.e. the least recently used entry
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert cache.size == 8
+    cache.put('d', b'd' * 11)  # Larger than the maximum size, not inserted
+    assert 'd' not in cache
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+
+def test_lru_cache_single_flight():
+    cache = LRUCache(max_size=10)
+    n_calls = []
+
+    async def compute():
+        n_calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def get_all():
+        return await asyncio.gather(*[cache.get_or_compute('key', compute) for _ in range(5)])
+
+    assert asyncio.run(get_all()) == [42] * 5
+    assert len(n_calls) == 1
+    assert cache.get('key') == 42
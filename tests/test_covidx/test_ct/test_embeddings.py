@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from covidx.ct.models import CTNet
+from covidx.ct.inference import prepare_model
+from covidx.ct.embeddings import EmbeddingIndex, build_embedding_index, load_embedding_model, normalize_embeddings, \
+    forward_embeddings
+
+
+def test_embedding_index(tmp_path):
+    n_cases = 6
+    model = CTNet(num_classes=3, pretrained=False)
+    filepath = str(tmp_path / 'ct_net.pt')
+    torch.save({'model': model.state_dict()}, filepath)
+    embedding_model = load_embedding_model(filepath)
+
+    # The embeddings are stored normalized and in half precision
+    inputs = torch.rand(n_cases, 1, 224, 224)
+    dataset = torch.utils.data.TensorDataset(inputs, torch.zeros(n_cases))
+    cases = pd.DataFrame({'filename': ['{}.png'.format(i) for i in range(n_cases)], 'class': [0, 1, 2] * 2})
+    path = str(tmp_path / 'embeddings')
+    assert build_embedding_index(embedding_model, dataset, cases, path, 'ct_net', batch_size=4) == n_cases
+    with pytest.raises(ValueError):
+        build_embedding_index(embedding_model, dataset, cases[:2], path, 'ct_net')
+    index = EmbeddingIndex(path, chunk_size=4)
+    assert len(index) == n_cases and index.model == 'ct_net'
+    assert index.embeddings.dtype == np.float16 and index.embeddings.shape == (n_cases, model.out_features)
+    assert index.cases[1] == {'filename': '1.png', 'class': 1}
+    assert not any(f.endswith('.tmp') for f in os.listdir(path))
+
+    # Each case is the most similar to itself
+    with torch.no_grad():
+        queries = embedding_model(inputs).numpy()
+    indices, similarities = index.search(queries, k=3)
+    assert indices.shape == similarities.shape == (n_cases, 3)
+    assert indices[:, 0].tolist() == list(range(n_cases))
+    np.testing.assert_allclose(similarities[:, 0], 1.0, atol=1e-2)
+    assert np.all(np.diff(similarities, axis=1) <= 0.0)
+    assert index.search(queries[:1], k=100)[0].shape == (1, n_cases)
+
+
+def test_embedding_search():
+    random_state = np.random.RandomState(42)
+    embeddings = normalize_embeddings(random_state.randn(1000, 16))
+    queries = random_state.randn(3, 16)
+
+    # The chunked search matches the brute force one
+    index = EmbeddingIndex.__new__(EmbeddingIndex)
+    index.embeddings, index.chunk_size = embeddings.astype(np.float16), 128
+    indices, similarities = index.search(queries, k=10)
+    expected = np.argsort(-np.dot(normalize_embeddings(queries), embeddings.T), axis=1)[:, :10]
+    assert np.mean(indices == expected) > 0.9
+    np.testing.assert_allclose(similarities, np.take_along_axis(
+        np.dot(normalize_embeddings(queries), embeddings.T), indices, axis=1), atol=1e-2)
+
+
+@pytest.mark.parametrize("backend", ['fp32', 'dynamic'])
+def test_forward_embeddings(backend):
+    reference = CTNet(num_classes=3, pretrained=False).eval()
+    embedding_model = CTNet(embeddings=True, pretrained=False)
+    embedding_model.load_state_dict({k: v for (k, v) in reference.state_dict().items() if not k.startswith('fc.')})
+    model = CTNet(num_classes=3, pretrained=False)
+    model.load_state_dict(reference.state_dict())
+    model = prepare_model(model, backend=backend)
+
+    # The served model gives the same embeddings of the model without classifier
+    inputs = torch.rand(2, 1, 224, 224)
+    with torch.no_grad():
+        embeddings, outputs = forward_embeddings(model, inputs)
+        expected = embedding_model.eval()(inputs)
+        assert outputs.shape == (2, 3) and embeddings.shape == expected.shape
+    similarities = np.sum(normalize_embeddings(embeddings.numpy()) * normalize_embeddings(expected.numpy()), axis=1)
+    assert np.all(similarities > 0.99)
+    with pytest.raises(ValueError):
+        forward_embeddings(lambda x: x, inputs)
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import pytest
+import torch
+from covidx.ct.models import CTNet
+from covidx.ct.inference import prepare_model, compare_models, export_onnx, OnnxModel
+
+
+@pytest.mark.parametrize("backend", ['fp32', 'channels_last', 'bf16', 'dynamic', 'static'])
+def test_prepare_model(backend):
+    batch_size, height, width = 4, 224, 224
+    reference = CTNet(num_classes=3, pretrained=False).eval()
+    candidate = CTNet(num_classes=3, pretrained=False)
+    candidate.load_state_dict(reference.state_dict())
+    calibration_data = torch.rand(8, 1, height, width)
+    candidate = prepare_model(candidate, backend=backend, calibration_data=calibration_data)
+
+    inputs = torch.rand(batch_size, 1, height, width)
+    with torch.no_grad():
+        outputs, att1, att2 = candidate(inputs, attention=True)
+        assert outputs.dtype == torch.float32 and outputs.shape == (batch_size, 3)
+        assert att1.shape == (batch_size, 1, 14, 14) and att2.shape == (batch_size, 1, 7, 7)
+        assert candidate(inputs).shape == (batch_size, 3)
+
+    results = compare_models(reference, candidate, inputs, batch_size=2)
+    assert 0.0 <= results['agreement'] <= 1.0
+    assert len(results['candidate_predictions']) == batch_size
+    if backend == 'fp32':
+        assert results['agreement'] == 1.0
+
+
+def test_prepare_model_errors():
+    model = CTNet(num_classes=3, pretrained=False)
+    with pytest.raises(ValueError):
+        prepare_model(model, backend='fp16')
+    with pytest.raises(ValueError):
+        prepare_model(model, backend='static')
+
+
+def test_export_onnx():
+    pytest.importorskip('onnxruntime')
+    model = CTNet(num_classes=3, pretrained=False)
+    filepath = os.path.join(tempfile.mkdtemp(), 'ct_net.onnx')
+    differences = export_onnx(model, filepath)
+    assert set(differences.keys()) == {'logits', 'att1', 'att2'}
+
+    # The exported graph must accept any batch size
+    onnx_model = OnnxModel(filepath)
+    outputs, att1, att2 = onnx_model(torch.rand(5, 1, 224, 224), attention=True)
+    assert outputs.shape == (5, 3) and att1.shape == (5, 1, 14, 14) and att2.shape == (5, 1, 7, 7)
+    assert onnx_model.nbytes == os.path.getsize(filepath)
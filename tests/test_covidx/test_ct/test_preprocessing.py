@@ -0,0 +1,40 @@
+import io
+import numpy as np
+import pytest
+import torch
+import torchvision
+from PIL import Image as pil
+from covidx.ct.preprocessing import crop_resize, normalize, BatchBuffer
+
+
+def test_crop_resize():
+    random_state = np.random.RandomState(42)
+    data = (random_state.rand(512, 384, 3) * 255).astype(np.uint8)
+    image_bytes = io.BytesIO()
+    pil.fromarray(data).save(image_bytes, format='png')
+    for bbox in [(10, 20, 300, 400), (-10, -10, 400, 600), None]:
+        with pil.open(image_bytes) as img:
+            expected = img.convert(mode='L')
+            if bbox is not None:
+                expected = expected.crop(bbox)
+            expected = expected.resize((224, 224), resample=pil.BICUBIC)
+            assert np.array_equal(np.asarray(crop_resize(img, bbox)), np.asarray(expected))
+    with pytest.raises(ValueError):
+        crop_resize(pil.fromarray(data), (10, 10, 10, 20))
+
+
+def test_normalize():
+    img = (np.random.rand(224, 224) * 255).astype(np.uint8)
+    expected = torchvision.transforms.functional.normalize(
+        torchvision.transforms.functional.to_tensor(img), (0.5,), (0.5,)
+    )
+    assert torch.equal(normalize(img), expected)
+    assert torch.equal(normalize(pil.fromarray(img)), expected)
+
+    buffer = BatchBuffer(max_batch_size=4)
+    batch = buffer([img, np.zeros_like(img)])
+    assert batch.shape == (2, 1, 224, 224)
+    assert batch.data_ptr() == buffer.buffer.data_ptr()
+    assert torch.equal(batch[0], expected) and torch.all(batch[1] == -1.0)
+    with pytest.raises(ValueError):
+        buffer([img] * 5)
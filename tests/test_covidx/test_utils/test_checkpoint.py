@@ -0,0 +1,51 @@
+import os
+import tempfile
+import pytest
+import torch
+from covidx.utils.checkpoint import save_flat_checkpoint, load_flat_checkpoint, load_checkpoint_metadata, \
+    load_flat_model, assign_state_dict
+
+
+@pytest.mark.utils
+def test_flat_checkpoint():
+    state_dict = {
+        'weight': torch.randn(3, 5),
+        'half': torch.randn(7).to(torch.bfloat16),
+        'steps': torch.tensor(42),
+        'mask': torch.rand(2, 3) > 0.5,
+        'empty': torch.zeros(0, 4)
+    }
+    filepath = os.path.join(tempfile.mkdtemp(), 'model.weights')
+    save_flat_checkpoint(state_dict, filepath, metadata={'history': {'loss': [1.0, 0.5]}})
+    assert load_checkpoint_metadata(filepath) == {'history': {'loss': [1.0, 0.5]}}
+
+    loaded = load_flat_checkpoint(filepath)
+    assert list(loaded.keys()) == list(state_dict.keys())
+    for name, tensor in state_dict.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+    # The mapped tensors are copy-on-write, so writing them must not modify the file
+    loaded['weight'].zero_()
+    assert torch.equal(load_flat_checkpoint(filepath)['weight'], state_dict['weight'])
+
+
+@pytest.mark.utils
+def test_load_flat_model():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2)).eval()
+    filepath = os.path.join(tempfile.mkdtemp(), 'model.weights')
+    save_flat_checkpoint(model.state_dict(), filepath)
+    assert load_checkpoint_metadata(filepath) is None
+
+    def model_fn(state_dict):
+        return torch.nn.Sequential(
+            torch.nn.Linear(4, state_dict['0.weight'].shape[0]), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2)
+        )
+
+    loaded = load_flat_model(model_fn, filepath).eval()
+    inputs = torch.randn(5, 4)
+    with torch.no_grad():
+        assert torch.allclose(loaded(inputs), model(inputs))
+
+    with pytest.raises(KeyError):
+        assign_state_dict(model_fn(model.state_dict()), {'0.weight': torch.zeros(8, 4)})
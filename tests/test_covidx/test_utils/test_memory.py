@@ -0,0 +1,33 @@
+import sys
+import mmap
+import pytest
+import torch
+from covidx.utils.memory import process_memory, reset_peak_rss, module_memory, allocator_memory, memory_readout
+
+
+@pytest.mark.utils
+def test_process_memory():
+    memory = process_memory()
+    assert 0 < memory['rss'] <= memory['peak_rss']
+
+    # The peak of a large allocation (of new pages, not reused from the heap) is still reported after freeing it
+    reset_peak_rss()
+    rss = process_memory()['rss']
+    size = 64 * 1024 * 1024
+    data = mmap.mmap(-1, size)
+    data.write(b'x' * size)
+    peak = reset_peak_rss()
+    assert peak >= rss + size // 2 or not sys.platform.startswith('linux')
+    data.close()
+    assert process_memory()['peak_rss'] >= peak
+
+
+@pytest.mark.utils
+def test_module_memory():
+    model = torch.nn.Sequential(torch.nn.Linear(8, 4), torch.nn.BatchNorm1d(4))
+    assert module_memory(model) == {'parameters': (8 * 4 + 4 + 4 + 4) * 4, 'buffers': 4 * 4 + 4 * 4 + 8}
+    readout = memory_readout(model)
+    assert readout['parameters'] == module_memory(model)['parameters']
+    assert all(isinstance(v, int) for v in readout.values())
+    for (allocator, _), value in allocator_memory().items():
+        assert allocator in ('malloc', 'cuda') and value >= 0
@@ -1,10 +1,13 @@
+import io
 import os
 import tempfile
 
+import numpy as np
+import pytest
 import torch
 from tempfile import NamedTemporaryFile
 from PIL import Image
-from covidx.utils.plot import save_attention_map
+from covidx.utils.plot import save_attention_map, save_binary_attention_map, render_binary_attention_map
 
 
 def test_save_attention_map():
@@ -18,3 +21,24 @@ def test_save_attention_map():
     with Image.open(path) as img:
         assert len(img.getbands()), 3
         assert img.size == (width * 3 + padding * 4, height + padding * 2)
+
+
+@pytest.mark.parametrize("encoding, image_format", [('png', 'PNG'), ('jpeg', 'JPEG'), ('webp', 'WEBP')])
+def test_render_binary_attention_map(encoding, image_format):
+    padding = 4
+    height, width = 224, 224
+    img = torch.rand(1, 1, height, width)
+    att1 = torch.softmax(torch.rand(1, 1, (height // 16) * (width // 16)), dim=2).view(1, 1, height // 16, width // 16)
+    att2 = torch.softmax(torch.rand(1, 1, (height // 32) * (width // 32)), dim=2).view(1, 1, height // 32, width // 32)
+    img_u8 = (255.0 * img).squeeze().numpy().astype(np.uint8)
+    data = render_binary_attention_map(img_u8, att1, att2, encoding=encoding)
+    with Image.open(io.BytesIO(data)) as rendered:
+        assert rendered.format == image_format
+        assert rendered.size == (width * 2 + padding * 3, height + padding * 2)
+
+    # The PNG rendering must match the reference implementation
+    if encoding == 'png':
+        stream = io.BytesIO()
+        save_binary_attention_map(stream, img, att1, att2)
+        with Image.open(stream) as expected, Image.open(io.BytesIO(data)) as rendered:
+            assert np.array_equal(np.asarray(expected), np.asarray(rendered))
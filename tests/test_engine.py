@@ -0,0 +1,109 @@
+import time
+import asyncio
+import pytest
+import torch
+from engine import BatchScheduler, BoundedExecutor, EngineOverloadedError, LoadShedder
+
+
+def test_batch_scheduler():
+    batch_sizes = []
+
+    def forward_fn(inputs):
+        batch_sizes.append(len(inputs))
+        return inputs * 2.0, inputs.sum(dim=1)
+
+    async def submit_all(scheduler, inputs):
+        return await asyncio.gather(*[scheduler.submit(x.unsqueeze(0)) for x in inputs])
+
+    scheduler = BatchScheduler(forward_fn, max_batch_size=4, max_wait_time=0.05)
+    inputs = torch.rand(10, 3)
+    outputs = asyncio.run(submit_all(scheduler, inputs))
+    scheduler.stop()
+
+    # Each caller must receive its own slice of the batched outputs
+    for x, (y, z) in zip(inputs, outputs):
+        assert y.shape == (1, 3) and z.shape == (1,)
+        assert torch.allclose(y[0], x * 2.0)
+        assert torch.allclose(z[0], x.sum())
+    assert sum(batch_sizes) == len(inputs)
+    assert max(batch_sizes) <= 4
+    assert len(batch_sizes) < len(inputs)
+
+    # The statistics must account for every batch
+    assert sum(i * n for i, n in enumerate(scheduler.batch_sizes)) == len(inputs)
+    assert sum(scheduler.batch_sizes) == len(batch_sizes)
+    assert scheduler.in_flight == 0 and scheduler.queue_depth == 0
+    assert scheduler.wait_time > 0.0 and scheduler.compute_time > 0.0
+
+
+def test_batch_scheduler_collate():
+    def forward_fn(inputs):
+        return inputs.sum(dim=1),
+
+    async def submit_all(scheduler, inputs):
+        return await asyncio.gather(*[scheduler.submit(x) for x in inputs])
+
+    scheduler = BatchScheduler(forward_fn, max_batch_size=4, collate_fn=lambda xs: torch.tensor(xs))
+    inputs = [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+    outputs = asyncio.run(submit_all(scheduler, inputs))
+    scheduler.stop()
+    assert [y.item() for (y,) in outputs] == [3.0, 7.0, 11.0]
+
+
+def test_batch_scheduler_errors():
+    def forward_fn(inputs):
+        raise RuntimeError("Forward failed")
+
+    with pytest.raises(ValueError):
+        BatchScheduler(forward_fn, max_batch_size=0)
+    with pytest.raises(ValueError):
+        BatchScheduler(forward_fn, max_wait_time=-1.0)
+
+    scheduler = BatchScheduler(forward_fn)
+    with pytest.raises(RuntimeError):
+        asyncio.run(scheduler.submit(torch.rand(1, 3)))
+    scheduler.stop()
+
+
+def test_bounded_executor():
+    executor = BoundedExecutor(max_workers=1, max_pending=2)
+    with executor.admit(), executor.admit():
+        with pytest.raises(EngineOverloadedError):
+            with executor.admit():
+                pass
+    assert executor.pending == 0
+    assert asyncio.run(executor.run(sum, [1, 2, 3])) == 6
+
+
+def test_load_shedder():
+    shedder = LoadShedder(latency_budget=1.0, wait_budget=0.5, shed_factor=2.0, smoothing=0.5, min_duration=0.0)
+    assert shedder.observe(0.5, wait=0.1) == LoadShedder.NORMAL and not shedder.degrade()
+    shedder.admit_low_priority()
+
+    # The queue wait alone degrades the responses, then the latency sheds the low priority requests
+    assert shedder.observe(0.5, wait=1.0) == LoadShedder.DEGRADED and shedder.degrade()
+    assert shedder.observe(4.0, wait=1.0) == LoadShedder.SHEDDING
+    with pytest.raises(EngineOverloadedError):
+        shedder.admit_low_priority()
+    assert shedder.degraded == 1 and shedder.shed == 1
+
+    # The previous levels are restored one at a time, once the pressure is well below their thresholds
+    assert shedder.observe(0.5, wait=0.0) == LoadShedder.SHEDDING
+    assert shedder.observe(0.0, wait=0.0) == LoadShedder.DEGRADED
+    assert shedder.observe(0.6, wait=0.3) == LoadShedder.DEGRADED and 0.5 < shedder.pressure < 1.0
+    assert shedder.observe(0.0, wait=0.0) == LoadShedder.NORMAL
+
+    # A level lasts at least the minimum duration
+    shedder = LoadShedder(latency_budget=1.0, wait_budget=0.0, smoothing=1.0, min_duration=60.0)
+    assert shedder.observe(1.0) == LoadShedder.DEGRADED
+    assert shedder.observe(0.0) == LoadShedder.DEGRADED
+
+    # The moving averages decay while no prediction is observed, so that the levels are restored also if only
+    # low priority requests are received
+    shedder = LoadShedder(latency_budget=1.0, wait_budget=0.0, smoothing=1.0, min_duration=0.05, half_life=0.01)
+    assert shedder.observe(3.0) == LoadShedder.SHEDDING
+    with pytest.raises(EngineOverloadedError):
+        shedder.admit_low_priority()
+    time.sleep(0.2)
+    shedder.admit_low_priority()
+    assert shedder.level == LoadShedder.NORMAL and not shedder.degrade()
@@ -0,0 +1,86 @@
+import os
+import time
+import threading
+import pytest
+from jobs import JobStore, JobWorker
+
+
+def test_job_store(tmp_path):
+    store = JobStore(str(tmp_path))
+    job_id = store.create('first', [
+        {'filename': 'a.png', 'contents': b'a', 'bbox': (0, 0, 8, 8)},
+        {'filename': 'b.png', 'path': str(tmp_path / 'b.png'), 'bbox': (1, 1, 8, 8)}
+    ])
+    other_id = store.create('second', [{'filename': 'c.png', 'contents': b'c', 'bbox': (0, 0, 8, 8)}])
+    with pytest.raises(ValueError):
+        store.create('first', [])
+    assert sorted(os.listdir(str(tmp_path / job_id))) == ['0']
+    status = store.get(job_id)
+    assert status['status'] == 'queued' and status['items'] == status['pending'] == 2
+    assert store.get('unknown') is None
+
+    # The oldest items are claimed first, in batches of the same model
+    model, items = store.claim(1, batch_size=4)
+    assert model == 'first' and [item['index'] for item in items] == [0, 1]
+    assert items[1]['bbox'] == (1, 1, 8, 8) and items[1]['path'] == str(tmp_path / 'b.png')
+    assert store.claim(2, batch_size=4)[0] == 'second'
+    assert store.claim(3, batch_size=4) == (None, [])
+
+    # A dead worker's items are requeued, and the results are stored by index
+    assert store.recover(2) == 1
+    store.finish(items[:1], [{'class': 0}])
+    assert store.get(job_id)['status'] == 'running'
+    assert store.results(job_id) == [{'index': 0, 'filename': 'a.png', 'status': 'done', 'class': 0}]
+    store.finish(items[1:], [{'error': 'invalid'}])
+    assert store.get(job_id)['status'] == 'done' and store.get(job_id)['failed'] == 1
+    assert [r['index'] for r in store.results(job_id, after=0)] == [1]
+
+    # The store persists across instances
+    store = JobStore(str(tmp_path))
+    assert store.get(other_id)['pending'] == 1
+    assert store.delete(job_id) and not store.delete(job_id)
+    assert not os.path.exists(str(tmp_path / job_id)) and store.get(job_id) is None
+
+
+def test_job_worker(tmp_path):
+    store = JobStore(str(tmp_path))
+    batches = []
+
+    def predict_fn(model, items):
+        batches.append((model, len(items)))
+        if model == 'broken':
+            raise RuntimeError("Model not found")
+        return [{'class': item['index']} for item in items]
+
+    job_id = store.create('ok', [{'contents': b'x', 'bbox': (0, 0, 1, 1)} for _ in range(5)])
+    broken_id = store.create('broken', [{'contents': b'x', 'bbox': (0, 0, 1, 1)}])
+    worker = JobWorker(store, predict_fn, batch_size=2, poll_interval=0.01)
+    while worker.run_once() > 0:
+        pass
+    assert batches == [('ok', 2), ('ok', 2), ('ok', 1), ('broken', 1)]
+    assert [r['class'] for r in store.results(job_id)] == list(range(5))
+    assert store.results(broken_id)[0]['error'] == "Model not found"
+
+
+def test_job_worker_throttle(tmp_path):
+    store = JobStore(str(tmp_path))
+    job_id = store.create('ok', [{'contents': b'x', 'bbox': (0, 0, 1, 1)} for _ in range(3)])
+    busy = threading.Event()
+    busy.set()
+    worker = JobWorker(
+        store, lambda model, items: [{'class': 0} for _ in items], batch_size=1, poll_interval=0.01,
+        throttle_fn=busy.is_set, throttle_interval=0.01
+    )
+
+    # No item is claimed while the other work is pending
+    worker.start()
+    try:
+        time.sleep(0.1)
+        assert store.get(job_id)['status'] == 'queued'
+        busy.clear()
+        deadline = time.monotonic() + 10.0
+        while store.get(job_id)['status'] != 'done' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert store.get(job_id)['done'] == 3
+    finally:
+        worker.stop()
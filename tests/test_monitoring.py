@@ -0,0 +1,72 @@
+import time
+import asyncio
+import tempfile
+import torch
+from prometheus_client import CollectorRegistry
+from engine import BatchScheduler, BoundedExecutor, LoadShedder
+from registry import ModelRegistry
+from cache import LRUCache
+from monitoring import StageTimer, parse_server_timing, EngineCollector, MemoryCollector
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    with timer.stage('decode'):
+        time.sleep(0.01)
+    timer.add('forward', 0.05)
+    timer.add('forward', 0.05)
+    stages = parse_server_timing(timer.server_timing())
+    assert list(stages.keys()) == ['decode', 'forward']
+    assert stages['decode'] >= 0.01
+    assert abs(stages['forward'] - 0.1) < 1e-6
+    assert parse_server_timing('cache;desc="hit", db;dur=abc, total;dur=12.5') == {'total': 0.0125}
+
+
+def test_engine_collector():
+    async def submit_all(scheduler, inputs):
+        return await asyncio.gather(*[scheduler.submit(x.unsqueeze(0)) for x in inputs])
+
+    scheduler = BatchScheduler(lambda inputs: (inputs * 2.0,), max_batch_size=4, max_wait_time=0.05)
+    asyncio.run(submit_all(scheduler, torch.rand(6, 3)))
+    scheduler.stop()
+    models = ModelRegistry(tempfile.mkdtemp(), load_fn=lambda filepath: None)
+    models.put('model', torch.nn.Linear(4, 4))
+    models.evict('model')
+
+    shedder = LoadShedder(latency_budget=1.0, smoothing=1.0, half_life=0.0)
+    shedder.observe(1.5)
+    shedder.degrade()
+
+    registry = CollectorRegistry()
+    registry.register(EngineCollector(
+        {'model': scheduler}, models, BoundedExecutor(max_pending=8), 'engine', shedder=shedder
+    ))
+    assert registry.get_sample_value('engine_queue_depth', {'model': 'model'}) == 0
+    assert registry.get_sample_value('engine_in_flight', {'model': 'model'}) == 0
+    assert registry.get_sample_value('engine_batch_size_count', {'model': 'model'}) == sum(scheduler.batch_sizes)
+    assert registry.get_sample_value('engine_batch_size_sum', {'model': 'model'}) == 6
+    assert registry.get_sample_value('engine_batch_size_bucket', {'model': 'model', 'le': '+Inf'}) == \
+        sum(scheduler.batch_sizes)
+    assert registry.get_sample_value('engine_compute_seconds_total', {'model': 'model'}) > 0.0
+    assert registry.get_sample_value('engine_max_pending_requests') == 8
+    assert registry.get_sample_value('engine_loaded_models') == 0
+    assert registry.get_sample_value('engine_model_events_total', {'model': 'model', 'event': 'evict'}) == 1
+    assert registry.get_sample_value('engine_service_level') == LoadShedder.DEGRADED
+    assert registry.get_sample_value('engine_load_pressure') == 1.5
+    assert registry.get_sample_value('engine_degraded_responses_total') == 1
+    assert registry.get_sample_value('engine_shed_requests_total') == 0
+
+
+def test_memory_collector():
+    models = ModelRegistry(tempfile.mkdtemp(), load_fn=lambda filepath: None)
+    models.put('model', torch.nn.BatchNorm2d(4))
+    cache = LRUCache(max_size=1024, sizeof=len)
+    cache.put('key', b'x' * 100)
+
+    registry = CollectorRegistry()
+    registry.register(MemoryCollector(models, {'cache': cache}, 'memory'))
+    rss = registry.get_sample_value('memory_rss_bytes')
+    assert 0 < rss <= registry.get_sample_value('memory_peak_rss_bytes')
+    assert registry.get_sample_value('memory_model_bytes', {'model': 'model', 'kind': 'parameters'}) == 32
+    assert registry.get_sample_value('memory_model_bytes', {'model': 'model', 'kind': 'buffers'}) == 40
+    assert registry.get_sample_value('memory_cache_bytes', {'cache': 'cache'}) == 100
@@ -0,0 +1,39 @@
+import threading
+import pytest
+import torch
+from profiling import RequestProfiler, ProfilerBusyError
+
+
+def test_request_profiler():
+    profiler = RequestProfiler(max_depth=1)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.Sequential(torch.nn.ReLU(), torch.nn.Linear(8, 2)))
+    results = []
+    capture = threading.Thread(target=lambda: results.append(
+        profiler.capture(30.0, n_requests=2, models=[model], row_limit=5)
+    ))
+    capture.start()
+    while not profiler.active:
+        capture.join(0.01)
+    with pytest.raises(ProfilerBusyError):
+        profiler.capture(1.0)
+
+    # Serve two requests while capturing
+    for _ in range(2):
+        with profiler.record('decode'):
+            x = torch.rand(4, 8)
+        model(x)
+        profiler.request_done()
+    capture.join()
+
+    result = results[0]
+    assert not profiler.active
+    assert result['requests'] == 2 and result['duration'] < 30.0
+    assert len(result['top']) == 5
+    assert all(e['self_cpu_time_ms'] >= 0.0 for e in result['top'])
+    if result['all_threads']:
+        names = {e['name'] for e in result['trace']['traceEvents']}
+        assert {'decode', 'Sequential', '0 (Linear)', '1 (Sequential)'}.issubset(names)
+        assert '1.0 (ReLU)' not in names
+
+    # The hooks are removed after the capture
+    assert not model._forward_pre_hooks and not model[1]._forward_hooks  # pylint: disable=protected-access
@@ -0,0 +1,85 @@
+import os
+import time
+import tempfile
+import pytest
+import torch
+from registry import ModelRegistry, module_size
+
+
+def test_model_registry():
+    path = tempfile.mkdtemp()
+    for name in ['small', 'large', 'other']:
+        size = 64 if name == 'large' else 16
+        torch.save({'model': torch.nn.Linear(size, size).state_dict()}, os.path.join(path, '{}.pt'.format(name)))
+    with open(os.path.join(path, 'notes.txt'), 'w') as f:
+        f.write('not a checkpoint')
+
+    n_loads = []
+
+    def load_fn(filepath):
+        n_loads.append(filepath)
+        state = torch.load(filepath)['model']
+        model = torch.nn.Linear(state['weight'].shape[1], state['weight'].shape[0])
+        model.load_state_dict(state)
+        return model
+
+    max_memory = module_size(torch.nn.Linear(64, 64)) + module_size(torch.nn.Linear(16, 16))
+    registry = ModelRegistry(path, load_fn, max_memory=max_memory)
+    assert registry.keys() == ['large', 'other', 'small']
+    assert registry.loaded() == []
+    with pytest.raises(KeyError):
+        registry.get('notes')
+
+    # Checkpoints are chosen by the order of the extensions
+    torch.save({'model': torch.nn.Linear(16, 16).state_dict()}, os.path.join(path, 'small.pth'))
+    assert ModelRegistry(path, load_fn, extensions=('.pth', '.pt')).filepath('small').endswith('small.pth')
+    assert ModelRegistry(path, load_fn, extensions=('.pt', '.pth')).filepath('small').endswith('small.pt')
+
+    # Models are loaded lazily, only once
+    assert registry['small'] is registry['small']
+    assert len(n_loads) == 1
+
+    # Loading the large model evicts the least recently used one
+    registry.get('other')
+    registry.get('small')
+    registry.get('large')
+    assert registry.loaded() == ['small', 'large']
+    assert registry.memory <= max_memory
+    events = registry.events()
+    assert events == {('small', 'load'): 1, ('other', 'load'): 1, ('large', 'load'): 1, ('other', 'evict'): 1}
+
+
+def test_model_registry_reload():
+    path = tempfile.mkdtemp()
+    filepath = os.path.join(path, 'model.pt')
+    torch.save({'model': torch.nn.Linear(4, 4).state_dict()}, filepath)
+
+    def load_fn(filepath):
+        model = torch.nn.Linear(4, 4)
+        model.load_state_dict(torch.load(filepath)['model'])
+        return model
+
+    registry = ModelRegistry(path, load_fn)
+    old_model = registry.get('model')
+    old_identity = registry.identity('model')
+    assert registry.reload() == []
+
+    # Replace the checkpoint, the old model is swapped only after the warm-up
+    warmed_up = []
+    time.sleep(0.01)
+    torch.save({'model': torch.nn.Linear(4, 4).state_dict()}, filepath)
+    assert registry.reload(warmup_fn=warmed_up.append) == ['model']
+    new_model = registry.get('model')
+    assert warmed_up == [new_model] and new_model is not old_model
+    assert registry.identity('model') != old_identity
+
+    # A broken checkpoint keeps the old model
+    with open(filepath, 'wb') as f:
+        f.write(b'broken')
+    assert registry.reload() == []
+    assert registry.get('model') is new_model
+
+    # A removed checkpoint unloads the model
+    os.remove(filepath)
+    registry.reload()
+    assert registry.loaded() == []
@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+import numpy as np
+import pytest
+import requests
+import serve
+from http import HTTPStatus
+from utils_test import get_formatted_params, get_image_bytes
+
+# The maximum time (in seconds) from the process start to the first prediction
+MAX_STARTUP_TIME = float(os.environ.get('CT_COVID_MAX_STARTUP_TIME', 60))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(n_workers, metrics_port=None, cwd=None, **variables):
+    port = free_port()
+    env = dict(os.environ, CT_COVID_WORKERS=str(n_workers), CT_COVID_HOST='127.0.0.1', CT_COVID_PORT=str(port))
+    env['CT_COVID_JOBS_PATH'] = tempfile.mkdtemp()
+    if metrics_port is not None:
+        env['CT_COVID_METRICS_PORT'] = str(metrics_port)
+    env.update(variables)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(serve.__file__), env.get('PYTHONPATH', '')])
+    process = subprocess.Popen([sys.executable, serve.__file__], env=env, cwd=cwd)
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def wait_ready(url, timeout=MAX_STARTUP_TIME):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url + '/ready').status_code == HTTPStatus.OK:
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def get_start_time(metrics_port):
+    response = requests.get('http://127.0.0.1:{}/metrics'.format(metrics_port))
+    for line in response.text.splitlines():
+        if line.startswith('process_start_time_seconds '):
+            return float(line.split()[1])
+    return None
+
+
+def stop_server(process):
+    # Notice that uvicorn may exit by re-raising the signal, once gracefully shut down
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=60) in (0, -signal.SIGTERM)
+
+
+def test_available_cpus():
+    assert 1 <= serve.available_cpus() <= (os.cpu_count() or 1)
+
+
+@pytest.mark.api
+def test_startup_time():
+    start_time = time.monotonic()
+    process, url = start_server(n_workers=1)
+    try:
+        assert wait_ready(url)
+        random_state = np.random.RandomState(42)
+        params = '&'.join(get_formatted_params(random_state))
+        response = requests.post(
+            '{}/predictions?{}'.format(url, params), files={'file': get_image_bytes(random_state)}
+        )
+        elapsed_time = time.monotonic() - start_time
+        assert response.status_code == HTTPStatus.OK
+        print("Time from process start to first prediction: {:.2f} s".format(elapsed_time))
+        assert elapsed_time < MAX_STARTUP_TIME
+    finally:
+        stop_server(process)
+
+
+@pytest.mark.api
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Requires fork")
+def test_serve_workers():
+    metrics_port = free_port()
+    process, url = start_server(n_workers=2, metrics_port=metrics_port)
+    try:
+        assert wait_ready(url)
+        models = requests.get(url + '/models').json()
+        assert models['default'] in models['loaded']
+
+        # Each worker exposes its own metrics on its own port, and none of them on the shared port
+        assert requests.get(url + '/metrics').status_code == HTTPStatus.NOT_FOUND
+        for port in (metrics_port, metrics_port + 1):
+            response = requests.get('http://127.0.0.1:{}/metrics'.format(port))
+            assert response.status_code == HTTPStatus.OK and 'engine_pending_requests' in response.text
+
+        # The jobs are processed by a dedicated worker process
+        random_state = np.random.RandomState(42)
+        params = '&'.join(get_formatted_params(random_state))
+        response = requests.post('{}/jobs?{}'.format(url, params), files={'files': get_image_bytes(random_state)})
+        assert response.status_code == HTTPStatus.ACCEPTED
+        result = requests.get('{}/jobs/{}/results?wait=true'.format(url, response.json()['id'])).json()
+        assert result['status'] == 'done'
+    finally:
+        stop_server(process)
+
+
+@pytest.mark.api
+def test_serve_reload(tmp_path):
+    os.makedirs(str(tmp_path / 'models'))
+    filepath = shutil.copy(os.path.join('models', 'ct_net.pt'), str(tmp_path / 'models'))
+    metrics_port = free_port()
+    process, url = start_server(
+        n_workers=2, metrics_port=metrics_port, cwd=str(tmp_path),
+        CT_COVID_RELOAD_INTERVAL='0.5', CT_COVID_ROLLING_RESTART_DELAY='0.5'
+    )
+    try:
+        assert wait_ready(url)
+        start_times = [get_start_time(metrics_port + i) for i in range(2)]
+
+        # The workers do not reload the changed checkpoint themselves, they are restarted by the supervisor
+        stat = os.stat(filepath)
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        deadline = time.monotonic() + MAX_STARTUP_TIME
+        restarted = False
+        while not restarted and time.monotonic() < deadline:
+            time.sleep(0.5)
+            try:
+                restarted = all(get_start_time(metrics_port + i) > start_times[i] for i in range(2))
+            except (requests.ConnectionError, TypeError):
+                pass
+        assert restarted and wait_ready(url)
+    finally:
+        stop_server(process)
@@ -47,3 +47,5 @@ def test_train_overfit():
         steps_per_epoch=1000, n_workers=0, verbose=False
     )
     assert history['train']['accuracy'][-1] == pytest.approx(1, abs=0.05)
+    assert len(history['memory']['peak_rss']) == len(history['train']['loss'])
+    assert all(r <= p for (r, p) in zip(history['memory']['rss'], history['memory']['peak_rss']))